@@ -23,6 +23,7 @@ def luigid(argv=sys.argv[1:]):
     parser.add_argument(u'--address', help=u'Listening interface')
     parser.add_argument(u'--unix-socket', help=u'Unix socket path')
     parser.add_argument(u'--port', default=8082, help=u'Listening port')
+    parser.add_argument(u'--shard', help=u'Index of this server in the shard_urls of a sharded scheduler')
 
     opts = parser.parse_args(argv)
 
@@ -30,6 +31,10 @@ def luigid(argv=sys.argv[1:]):
         config = luigi.configuration.get_config()
         config.set('scheduler', 'state_path', opts.state_path)
 
+    if opts.shard:
+        config = luigi.configuration.get_config()
+        config.set('scheduler', 'shard', opts.shard)
+
     if opts.background:
         # daemonize sets up logging to spooled log files
         logging.getLogger().setLevel(logging.INFO)
@@ -54,3 +59,35 @@ def luigid(argv=sys.argv[1:]):
                 print("Defaulting to basic logging; consider specifying logging_conf_file in luigi.cfg.")
                 logging.basicConfig(level=logging.INFO, format=luigi.process.get_log_format())
         luigi.server.run(api_port=opts.port, address=opts.address, unix_socket=opts.unix_socket)
+
+
+def luigi_history(argv=sys.argv[1:]):
+    import luigi.configuration
+    from luigi import db_task_history  # Needs sqlalchemy, thus imported here
+    parser = argparse.ArgumentParser(description=u'Maintain the task history database of the central scheduler')
+    subparsers = parser.add_subparsers(dest='command')
+    compact_parser = subparsers.add_parser('compact', help=u'Roll old events up into daily statistics and delete them')
+    compact_parser.add_argument(u'--retention-days', type=int,
+                                help=u'Days of events to keep, defaults to retention_days of [task_history]')
+    stats_parser = subparsers.add_parser('stats', help=u'Print daily statistics of the runs of tasks')
+    stats_parser.add_argument(u'--name', help=u'Only tasks with this name')
+    stats_parser.add_argument(u'--days', type=int, default=30, help=u'Number of days to print')
+
+    opts = parser.parse_args(argv)
+    if opts.command is None:
+        parser.error(u'a command is required')
+
+    history = db_task_history.DbTaskHistory()
+    if opts.command == 'compact':
+        retention_days = opts.retention_days
+        if retention_days is None:
+            retention_days = luigi.configuration.get_config().getint('task_history', 'retention_days', 30)
+        deleted = history.compact(retention_days)
+        print("Rolled up and deleted {} events older than {} days".format(deleted, retention_days))
+    else:
+        row_format = u'{:<40} {:<10} {:>6} {:>8} {:>10} {:>10} {:>10}'
+        print(row_format.format(u'name', u'day', u'runs', u'failures', u'p50 s', u'p95 s', u'max s'))
+        for day_stats in history.find_task_stats(opts.name, opts.days):
+            print(row_format.format(day_stats['name'], day_stats['day'].isoformat(), day_stats['runs'], day_stats['failures'],
+                                    *[u'-' if day_stats[k] is None else u'{:.1f}'.format(day_stats[k])
+                                      for k in ('runtime_p50', 'runtime_p95', 'runtime_max')]))
@@ -35,11 +35,17 @@ See :ref:`TaskHistory` for information about how to turn out the task history fe
 # Author Yeseul Park (yeseul.park@navercorp.com)
 #
 
+import collections
 import datetime
+import hashlib
+import json
 import logging
+import threading
+import time
 from contextlib import contextmanager
 
 from luigi import six
+from luigi.six.moves import queue
 
 from luigi import configuration
 from luigi import task_history
@@ -59,6 +65,12 @@ class DbTaskHistory(task_history.TaskHistory):
     """
     Task History that writes to a database using sqlalchemy.
     Also has methods for useful db queries.
+
+    Unless ``background_writes`` is disabled, events are put on a bounded
+    queue and written in batches by a background thread, so scheduler
+    requests don't wait for the database. Queries may not see the events of
+    the last ``writer_flush_interval`` seconds, call :py:meth:`flush` first
+    when they have to.
     """
     CURRENT_SOURCE_VERSION = 1
 
@@ -79,25 +91,73 @@ class DbTaskHistory(task_history.TaskHistory):
     def __init__(self):
         config = configuration.get_config()
         connection_string = config.get('task_history', 'db_connection')
-        self.engine = sqlalchemy.create_engine(connection_string)
+        url = sqlalchemy.engine.url.make_url(connection_string)
+        if url.drivername.startswith('sqlite') and url.database in (None, '', ':memory:'):
+            # Every connection to :memory: is a new database, so the writer thread has to share ours
+            self.engine = sqlalchemy.create_engine(
+                url, poolclass=sqlalchemy.pool.StaticPool, connect_args={'check_same_thread': False})
+        else:
+            self.engine = sqlalchemy.create_engine(url)
         self.session_factory = sqlalchemy.orm.sessionmaker(bind=self.engine, expire_on_commit=False)
         Base.metadata.create_all(self.engine)
         self.tasks = {}  # task_id -> TaskRecord
 
         _upgrade_schema(self.engine)
 
+        self._batch_size = config.getint('task_history', 'writer_batch_size', 1000)
+        self._flush_interval = config.getfloat('task_history', 'writer_flush_interval', 1.0)
+        self._queue_timeout = config.getfloat('task_history', 'writer_queue_timeout', 5.0)
+        self._flush_timeout = config.getfloat('task_history', 'writer_flush_timeout', 60.0)
+        self._dropping = False  # whether events are dropped until the writer catches up
+        self._stats_lock = threading.Lock()
+        self._stats = {'written': 0, 'dropped': 0, 'failed': 0, 'flushes': 0,
+                       'last_flush_size': 0, 'last_flush_seconds': 0.0, 'lag_seconds': 0.0}
+        if config.getboolean('task_history', 'background_writes', True):
+            # (StoredTask, event name, timestamp, host) tuples, or an Event to set once written
+            self._queue = queue.Queue(config.getint('task_history', 'writer_queue_size', 10000))
+            self._writer = threading.Thread(target=self._run_writer)
+            self._writer.daemon = True
+            self._writer.start()
+        else:
+            self._queue = None
+
     def task_scheduled(self, task):
         htask = self._get_task(task, status=PENDING)
-        self._add_task_event(htask, TaskEvent(event_name=PENDING, ts=datetime.datetime.now()))
+        self._add_task_event(htask, PENDING)
 
     def task_finished(self, task, successful):
         event_name = DONE if successful else FAILED
         htask = self._get_task(task, status=event_name)
-        self._add_task_event(htask, TaskEvent(event_name=event_name, ts=datetime.datetime.now()))
+        self._add_task_event(htask, event_name)
 
     def task_started(self, task, worker_host):
         htask = self._get_task(task, status=RUNNING, host=worker_host)
-        self._add_task_event(htask, TaskEvent(event_name=RUNNING, ts=datetime.datetime.now()))
+        self._add_task_event(htask, RUNNING)
+
+    def flush(self):
+        """
+        Wait until the events recorded so far are written to the database, for up to writer_flush_timeout seconds.
+        """
+        if self._queue is not None and self._writer.is_alive():
+            written = threading.Event()
+            start = time.time()
+            try:
+                self._queue.put(written, timeout=self._flush_timeout)
+            except queue.Full:
+                pass
+            if not written.wait(max(0.0, self._flush_timeout - (time.time() - start))):
+                logger.warning("Task history writer didn't write the events within %ss", self._flush_timeout)
+
+    def writer_stats(self):
+        """
+        Return counters of the background writer, to tell whether it keeps up with the scheduler.
+
+        ``lag_seconds`` is how old the oldest event of the last flush was when it was written.
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize() if self._queue is not None else 0
+        return stats
 
     def _get_task(self, task, status, host=None):
         if task.id in self.tasks:
@@ -109,40 +169,114 @@ class DbTaskHistory(task_history.TaskHistory):
             htask = self.tasks[task.id] = task_history.StoredTask(task, status, host)
         return htask
 
-    def _add_task_event(self, task, event):
-        for (task_record, session) in self._find_or_create_task(task):
-            task_record.events.append(event)
+    def _add_task_event(self, task, event_name):
+        event = (task, event_name, datetime.datetime.now(), task.host)
+        if self._queue is None:
+            self._write_events([event])
+            return
+        if self._dropping and self._queue.qsize() <= self._queue.maxsize // 2:
+            logger.info("Task history writer caught up, recording events again")
+            self._dropping = False
+        try:
+            if self._dropping:
+                raise queue.Full
+            # Blocks the scheduler rather than buffering without bounds when the database can't keep up.
+            # Once an event waited in vain, events are dropped right away until the queue is half empty.
+            self._queue.put(event, timeout=self._queue_timeout)
+        except queue.Full:
+            if not self._dropping:
+                logger.warning("Task history writer is behind, dropping events until it catches up")
+            self._dropping = True
+            with self._stats_lock:
+                self._stats['dropped'] += 1
+            logger.debug("Dropped %s event of %s", event_name, task._task.id)
+
+    def _run_writer(self):
+        while True:
+            events, waiters = [], []
+            item = self._queue.get()
+            deadline = time.time() + self._flush_interval
+            while True:
+                if not isinstance(item, tuple):
+                    waiters.append(item)
+                    break
+                events.append(item)
+                timeout = deadline - time.time()
+                if len(events) >= self._batch_size or timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if events:
+                try:
+                    self._write_events(events)
+                except Exception:
+                    with self._stats_lock:
+                        self._stats['failed'] += len(events)
+                    logger.warning("Error saving Task history", exc_info=True)
+            for waiter in waiters:
+                waiter.set()
+
+    def _write_events(self, events):
+        """
+        Write events in one transaction: a record for every task seen for the first time, and all events in bulk.
+        """
+        start = time.time()
+        tasks = collections.OrderedDict()  # StoredTask -> host of its last event
+        updated = {}  # StoredTask -> time of its last event
+        for (task, event_name, ts, host) in events:
+            tasks[task] = host or tasks.get(task)
+            updated[task] = ts
+        started = set(task for (task, event_name, ts, host) in events if event_name == RUNNING)
 
-    def _find_or_create_task(self, task):
         with self._session() as session:
-            if task.record_id is not None:
-                logger.debug("Finding task with record_id [%d]", task.record_id)
-                task_record = session.query(TaskRecord).get(task.record_id)
-                if not task_record:
-                    raise Exception("Task with record_id, but no matching Task record!")
-                yield (task_record, session)
-            else:
-                task_record = TaskRecord(task_id=task._task.id, name=task.task_family, host=task.host)
-                for (k, v) in six.iteritems(task.parameters):
-                    task_record.parameters[k] = TaskParameter(name=k, value=v)
-                session.add(task_record)
-                yield (task_record, session)
-            if task.host:
-                task_record.host = task.host
-        task.record_id = task_record.id
+            known_ids = [task.record_id for task in tasks if task.record_id is not None]
+            existing = set()
+            for chunk in _chunks(known_ids):
+                existing.update(record_id for (record_id,) in session.query(TaskRecord.id).filter(TaskRecord.id.in_(chunk)))
+            for task in tasks:
+                if task.record_id is not None and task.record_id not in existing:
+                    task.record_id = None  # deleted by compact, so it gets a new record
+            new_records = [(task, TaskRecord(task_id=task._task.id, name=task.task_family, host=host,
+                                             param_hash=_param_hash(task.parameters), updated=updated[task]))
+                           for (task, host) in six.iteritems(tasks) if task.record_id is None]
+            session.add_all([task_record for (task, task_record) in new_records])
+            session.flush()
+            record_ids = dict((task, task_record.id) for (task, task_record) in new_records)
+            for task in tasks:
+                record_ids.setdefault(task, task.record_id)
+
+            session.bulk_insert_mappings(TaskParameter, [
+                dict(task_id=task_record.id, name=k, value=v)
+                for (task, task_record) in new_records for (k, v) in six.iteritems(task.parameters)])
+            record_updates = []
+            for task in tasks:
+                if task.record_id is not None:
+                    record_updates.append(dict(id=task.record_id, updated=updated[task]))
+                    if task in started and tasks[task]:
+                        record_updates[-1]['host'] = tasks[task]
+            session.bulk_update_mappings(TaskRecord, record_updates)
+            session.bulk_insert_mappings(TaskEvent, [
+                dict(task_id=record_ids[task], event_name=event_name, ts=ts)
+                for (task, event_name, ts, host) in events])
+
+        for (task, task_record) in new_records:
+            task.record_id = task_record.id
+        with self._stats_lock:
+            self._stats['written'] += len(events)
+            self._stats['flushes'] += 1
+            self._stats['last_flush_size'] = len(events)
+            self._stats['last_flush_seconds'] = time.time() - start
+            self._stats['lag_seconds'] = (datetime.datetime.now() - events[0][2]).total_seconds()
 
     def find_all_by_parameters(self, task_name, session=None, **task_params):
         """
         Find tasks with the given task_name and the same parameters as the kwargs.
         """
         with self._session(session) as session:
-            query = session.query(TaskRecord).join(TaskEvent).filter(TaskRecord.name == task_name)
-            for (k, v) in six.iteritems(task_params):
-                alias = sqlalchemy.orm.aliased(TaskParameter)
-                query = query.join(alias).filter(alias.name == k, alias.value == v)
-
-            tasks = query.order_by(TaskEvent.ts)
-            for task in tasks:
+            query = self._query_runs(session, task_name, task_params).order_by(TaskRecord.id)
+            for task in query:
                 # Sanity check
                 assert all(k in task.parameters and v == str(task.parameters[k].value) for (k, v) in six.iteritems(task_params))
 
@@ -160,13 +294,156 @@ class DbTaskHistory(task_history.TaskHistory):
         """
         with self._session(session) as session:
             yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
-            return session.query(TaskRecord).\
-                join(TaskEvent).\
-                filter(TaskEvent.ts >= yesterday).\
-                group_by(TaskRecord.id, TaskEvent.event_name, TaskEvent.ts).\
-                order_by(TaskEvent.ts.desc()).\
+            return self._query_runs(session).\
+                filter(TaskRecord.updated >= yesterday).\
+                order_by(TaskRecord.updated.desc(), TaskRecord.id.desc()).\
                 all()
 
+    def find_runs_page(self, task_name=None, params=None, exact=False, since=None, page_size=100, cursor=None,
+                       session=None):
+        """
+        Return the page_size most recently updated tasks that come after the cursor, and the cursor of the next page.
+
+        The next page is fetched by passing the cursor back, until it's None.
+        Tasks can be filtered by name, by the time of their last event and by
+        parameters. With exact, tasks must have these parameters and no others,
+        which is looked up by parameter hash instead of by parameter.
+        Parameters and events are loaded along with the tasks.
+        """
+        if page_size < 1:
+            raise ValueError('page_size must be positive, not %r' % (page_size,))
+        with self._session(session) as session:
+            query = self._query_runs(session, task_name, params, exact).options(
+                sqlalchemy.orm.subqueryload(TaskRecord.parameters),
+                sqlalchemy.orm.subqueryload(TaskRecord.events))
+            if since is not None:
+                query = query.filter(TaskRecord.updated >= since)
+            if cursor is not None:
+                updated, record_id = _parse_cursor(cursor)
+                query = query.filter(sqlalchemy.or_(
+                    TaskRecord.updated < updated,
+                    sqlalchemy.and_(TaskRecord.updated == updated, TaskRecord.id < record_id)))
+            page = query.order_by(TaskRecord.updated.desc(), TaskRecord.id.desc()).limit(page_size + 1).all()
+        if len(page) > page_size:
+            return page[:page_size], _format_cursor(page[page_size - 1])
+        return page, None
+
+    def _query_runs(self, session, task_name=None, params=None, exact=False):
+        query = session.query(TaskRecord)
+        if task_name is not None:
+            query = query.filter(TaskRecord.name == task_name)
+        if exact:
+            query = query.filter(TaskRecord.param_hash == _param_hash(params or {}))
+        elif params:
+            # One lookup for all parameters rather than a join per parameter
+            matching = session.query(TaskParameter.task_id).\
+                filter(sqlalchemy.or_(*[sqlalchemy.and_(TaskParameter.name == k, TaskParameter.value == v)
+                                        for (k, v) in six.iteritems(params)])).\
+                group_by(TaskParameter.task_id).\
+                having(sqlalchemy.func.count(TaskParameter.name) == len(params))
+            query = query.filter(TaskRecord.id.in_(matching))
+        return query
+
+    def compact(self, retention_days):
+        """
+        Roll the events older than retention_days days up into :py:class:`TaskStats` and delete them.
+
+        Tasks left without events are deleted too. The RUNNING event of a run
+        that hasn't finished by then is kept, so the runtime of the run can be
+        rolled up with the day it finishes. Each day is rolled up in its own
+        transaction, so compacting months of history doesn't hold the
+        database for long. Returns the number of events deleted.
+        """
+        cutoff = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=retention_days), datetime.time())
+        deleted = 0
+        day_end = None
+        while True:
+            with self._session() as session:
+                query = session.query(sqlalchemy.func.min(TaskEvent.ts))
+                if day_end is not None:
+                    query = query.filter(TaskEvent.ts >= day_end)
+                first = query.scalar()
+                if first is None or first >= cutoff:
+                    return deleted
+                day_end = datetime.datetime.combine(first.date() + datetime.timedelta(days=1), datetime.time())
+                deleted += self._compact_until(session, day_end)
+
+    def _compact_until(self, session, day_end):
+        events = session.query(TaskEvent.id, TaskEvent.task_id, TaskEvent.event_name, TaskEvent.ts, TaskRecord.name).\
+            outerjoin(TaskRecord, TaskEvent.task_id == TaskRecord.id).\
+            filter(TaskEvent.ts < day_end).\
+            order_by(TaskEvent.ts, TaskEvent.id).\
+            all()
+        runs, unfinished = _runs(events)
+        for ((name, day), stats) in six.iteritems(_daily_stats(runs)):
+            row = session.query(TaskStats).get((name, day))
+            if row is None:
+                session.add(TaskStats(name=name, day=day, **stats))
+            else:
+                # Only when events of the day were written after it was compacted
+                for (k, v) in six.iteritems(_merge_stats(row.as_dict(), stats)):
+                    setattr(row, k, v)
+
+        keep = set(event_id for (event_id, ts) in six.itervalues(unfinished) if ts >= day_end - MAX_RUNTIME)
+        event_ids = [event[0] for event in events if event[0] not in keep]
+        for chunk in _chunks(event_ids):
+            session.query(TaskEvent).filter(TaskEvent.id.in_(chunk)).delete(synchronize_session=False)
+
+        has_events = session.query(TaskEvent.id).filter(TaskEvent.task_id == TaskRecord.id).exists()
+        record_ids = [record_id for (record_id,) in
+                      session.query(TaskRecord.id).filter(TaskRecord.updated < day_end, ~has_events)]
+        for chunk in _chunks(record_ids):
+            session.query(TaskParameter).filter(TaskParameter.task_id.in_(chunk)).delete(synchronize_session=False)
+            session.query(TaskRecord).filter(TaskRecord.id.in_(chunk)).delete(synchronize_session=False)
+        return len(event_ids)
+
+    def find_task_stats(self, task_name=None, days=30, session=None):
+        """
+        Return the daily statistics of the runs of the last days days, by task name and day.
+
+        Days that were compacted are read from :py:class:`TaskStats`, the
+        others are computed from their events. As events are only kept for
+        the retention period, this doesn't take longer as history grows.
+        """
+        since = datetime.date.today() - datetime.timedelta(days=days)
+        with self._session(session) as session:
+            rows = session.query(TaskStats).filter(TaskStats.day >= since)
+            # Runs that finished since then may have started the day before
+            events = session.query(TaskEvent.id, TaskEvent.task_id, TaskEvent.event_name, TaskEvent.ts, TaskRecord.name).\
+                join(TaskRecord, TaskEvent.task_id == TaskRecord.id).\
+                filter(TaskEvent.ts >= datetime.datetime.combine(since - datetime.timedelta(days=1), datetime.time()))
+            if task_name is not None:
+                rows = rows.filter(TaskStats.name == task_name)
+                events = events.filter(TaskRecord.name == task_name)
+            stats = dict(((row.name, row.day), row.as_dict()) for row in rows)
+            runs, unfinished = _runs(events.order_by(TaskEvent.ts, TaskEvent.id))
+        for (key, day_stats) in six.iteritems(_daily_stats(run for run in runs if run[1] >= since)):
+            stats[key] = _merge_stats(stats[key], day_stats) if key in stats else day_stats
+        return [dict(stats[key], name=key[0], day=key[1]) for key in sorted(stats)]
+
+    def runtime_estimates(self, percentile=50, days=30):
+        """
+        Return the median, or 95th percentile, runtime of the tasks of each family over the last days days, by family.
+
+        The percentiles of the days are averaged, weighted by how many runs they're of.
+        """
+        column = 'runtime_p%d' % percentile
+        if column not in _STATS_COLUMNS:
+            raise ValueError('No statistics kept for percentile %r' % (percentile,))
+        totals = collections.defaultdict(lambda: [0.0, 0])
+        for day_stats in self.find_task_stats(days=days):
+            if day_stats[column] is not None:
+                totals[day_stats['name']][0] += day_stats[column] * day_stats['timed_runs']
+                totals[day_stats['name']][1] += day_stats['timed_runs']
+        return dict((name, total / runs) for (name, (total, runs)) in six.iteritems(totals))
+
+    def find_task_names(self, session=None):
+        """
+        Return the names of all tasks, sorted.
+        """
+        with self._session(session) as session:
+            return [name for (name,) in session.query(TaskRecord.name).distinct().order_by(TaskRecord.name)]
+
     def find_all_runs(self, session=None):
         """
         Return all tasks that have been updated.
@@ -212,6 +489,8 @@ class TaskEvent(Base):
     event_name = sqlalchemy.Column(sqlalchemy.String(20))
     ts = sqlalchemy.Column(sqlalchemy.TIMESTAMP, index=True, nullable=False)
 
+    __table_args__ = (sqlalchemy.Index('ix_task_events_task_id_ts', 'task_id', 'ts'),)
+
     def __repr__(self):
         return "TaskEvent(task_id=%s, event_name=%s, ts=%s" % (self.task_id, self.event_name, self.ts)
 
@@ -227,6 +506,10 @@ class TaskRecord(Base):
     task_id = sqlalchemy.Column(sqlalchemy.String(200), index=True)
     name = sqlalchemy.Column(sqlalchemy.String(128), index=True)
     host = sqlalchemy.Column(sqlalchemy.String(128))
+    # Hash of all parameters, see _param_hash
+    param_hash = sqlalchemy.Column(sqlalchemy.String(40))
+    # Time of the last event, so recent tasks can be found without scanning events
+    updated = sqlalchemy.Column(sqlalchemy.DateTime)
     parameters = sqlalchemy.orm.relationship(
         'TaskParameter',
         collection_class=sqlalchemy.orm.collections.attribute_mapped_collection('name'),
@@ -236,10 +519,133 @@ class TaskRecord(Base):
         order_by=(sqlalchemy.desc(TaskEvent.ts), sqlalchemy.desc(TaskEvent.id)),
         backref='task')
 
+    __table_args__ = (
+        sqlalchemy.Index('ix_tasks_name_param_hash', 'name', 'param_hash'),
+        sqlalchemy.Index('ix_tasks_name_updated', 'name', 'updated'),
+        sqlalchemy.Index('ix_tasks_updated', 'updated'),
+    )
+
     def __repr__(self):
         return "TaskRecord(name=%s, host=%s)" % (self.name, self.host)
 
 
+class TaskStats(Base):
+    """
+    Table of daily statistics of the runs of the tasks with a name, rolled up from old events by compact.
+
+    A run goes from a RUNNING event to the DONE or FAILED event that follows,
+    and counts on the day it finishes. Runtimes are in seconds.
+    """
+    __tablename__ = 'task_stats'
+    name = sqlalchemy.Column(sqlalchemy.String(128), primary_key=True)
+    day = sqlalchemy.Column(sqlalchemy.Date, primary_key=True)
+    runs = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    failures = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    timed_runs = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)  # runs with a RUNNING event, so a runtime
+    runtime_p50 = sqlalchemy.Column(sqlalchemy.Float)
+    runtime_p95 = sqlalchemy.Column(sqlalchemy.Float)
+    runtime_max = sqlalchemy.Column(sqlalchemy.Float)
+
+    def as_dict(self):
+        return dict((k, getattr(self, k)) for k in _STATS_COLUMNS)
+
+    def __repr__(self):
+        return "TaskStats(name=%s, day=%s, runs=%s)" % (self.name, self.day, self.runs)
+
+
+_STATS_COLUMNS = ('runs', 'failures', 'timed_runs', 'runtime_p50', 'runtime_p95', 'runtime_max')
+
+# Unfinished runs that started longer ago than this are given up on by compact
+MAX_RUNTIME = datetime.timedelta(days=7)
+
+
+def _runs(events):
+    """
+    Find the runs in (id, task id, event name, ts, task name) events sorted by time.
+
+    Returns a list of (task name, day, successful, runtime) runs, with runtime
+    None when the run has no RUNNING event, and the (event id, ts) of the
+    RUNNING event of every task whose last run hasn't finished.
+    """
+    runs, unfinished = [], {}
+    for (event_id, task_id, event_name, ts, name) in events:
+        if event_name == RUNNING:
+            unfinished[task_id] = (event_id, ts)
+        elif event_name in (DONE, FAILED):
+            started = unfinished.pop(task_id, None)
+            if name is not None:
+                runtime = (ts - started[1]).total_seconds() if started else None
+                runs.append((name, ts.date(), event_name == DONE, runtime))
+    return runs, unfinished
+
+
+def _daily_stats(runs):
+    """
+    Return the statistics of the runs by (task name, day).
+    """
+    grouped = collections.defaultdict(list)
+    for (name, day, successful, runtime) in runs:
+        grouped[(name, day)].append((successful, runtime))
+    stats = {}
+    for (key, day_runs) in six.iteritems(grouped):
+        runtimes = sorted(runtime for (successful, runtime) in day_runs if runtime is not None)
+        stats[key] = dict(
+            runs=len(day_runs),
+            failures=sum(1 for (successful, runtime) in day_runs if not successful),
+            timed_runs=len(runtimes),
+            runtime_p50=_percentile(runtimes, 0.5),
+            runtime_p95=_percentile(runtimes, 0.95),
+            runtime_max=runtimes[-1] if runtimes else None)
+    return stats
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _merge_stats(a, b):
+    """
+    Combine the statistics of two sets of runs of a day. Percentiles are averaged, so only approximate.
+    """
+    merged = dict(runs=a['runs'] + b['runs'], failures=a['failures'] + b['failures'],
+                  timed_runs=a['timed_runs'] + b['timed_runs'])
+    for k in ('runtime_p50', 'runtime_p95'):
+        weighted = [(s[k], s['timed_runs']) for s in (a, b) if s[k] is not None]
+        merged[k] = sum(v * n for (v, n) in weighted) / sum(n for (v, n) in weighted) if weighted else None
+    maxima = [s['runtime_max'] for s in (a, b) if s['runtime_max'] is not None]
+    merged['runtime_max'] = max(maxima) if maxima else None
+    return merged
+
+
+def _chunks(items, size=500):
+    """
+    Split items in lists short enough for an IN clause.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _param_hash(params):
+    """
+    Return a hash of the parameters that doesn't depend on their order.
+    """
+    canonical = json.dumps(dict((k, six.text_type(v)) for (k, v) in six.iteritems(params)), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+_CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _format_cursor(task_record):
+    return '%s_%d' % (task_record.updated.strftime(_CURSOR_FORMAT), task_record.id)
+
+
+def _parse_cursor(cursor):
+    updated, _, record_id = cursor.rpartition('_')
+    return datetime.datetime.strptime(updated, _CURSOR_FORMAT), int(record_id)
+
+
 def _upgrade_schema(engine):
     """
     Ensure the database schema is up to date with the codebase.
@@ -254,3 +660,34 @@ def _upgrade_schema(engine):
         logger.warn('Upgrading DbTaskHistory schema: Adding tasks.task_id')
         conn.execute('ALTER TABLE tasks ADD COLUMN task_id VARCHAR(200)')
         conn.execute('CREATE INDEX ix_task_id ON tasks (task_id)')
+
+    # Upgrade 2.  Add param_hash and updated columns to tasks, and indexes to look tasks up by them
+    columns = [x['name'] for x in inspector.get_columns('tasks')]
+    if 'param_hash' not in columns:
+        logger.warn('Upgrading DbTaskHistory schema: Adding tasks.param_hash')
+        conn.execute('ALTER TABLE tasks ADD COLUMN param_hash VARCHAR(40)')
+        # A few tasks at a time, as the history may be too big to hold in memory
+        tasks, parameters = TaskRecord.__table__, TaskParameter.__table__
+        update = tasks.update().where(tasks.c.id == sqlalchemy.bindparam('record_id')).values(param_hash=sqlalchemy.bindparam('hash'))
+        task_ids = [-1]
+        while True:
+            task_ids = [task_id for (task_id,) in conn.execute(
+                sqlalchemy.select([tasks.c.id]).where(tasks.c.id > task_ids[-1]).order_by(tasks.c.id).limit(500))]
+            if not task_ids:
+                break
+            params = dict((task_id, {}) for task_id in task_ids)
+            for (task_id, name, value) in conn.execute(sqlalchemy.select([parameters.c.task_id, parameters.c.name, parameters.c.value]).
+                                                       where(parameters.c.task_id.in_(task_ids))):
+                params[task_id][name] = value
+            conn.execute(update, [dict(record_id=task_id, hash=_param_hash(params[task_id])) for task_id in task_ids])
+    if 'updated' not in columns:
+        logger.warn('Upgrading DbTaskHistory schema: Adding tasks.updated')
+        conn.execute('ALTER TABLE tasks ADD COLUMN updated %s' % sqlalchemy.DateTime().compile(dialect=engine.dialect))
+        conn.execute('UPDATE tasks SET updated = (SELECT MAX(ts) FROM task_events WHERE task_events.task_id = tasks.id)')
+    new_indexes = ('ix_tasks_name_param_hash', 'ix_tasks_name_updated', 'ix_tasks_updated', 'ix_task_events_task_id_ts')
+    for table in (TaskRecord.__table__, TaskEvent.__table__):
+        existing = [x['name'] for x in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name in new_indexes and index.name not in existing:
+                logger.warn('Upgrading DbTaskHistory schema: Adding index %s', index.name)
+                index.create(engine)
@@ -93,6 +93,11 @@ class core(task.Config):
         description='Full path to remote scheduler',
         config_path=dict(section='core', name='default-scheduler-url'),
     )
+    scheduler_urls = parameter.ListParameter(
+        default=[],
+        description='Full paths to the shards of a sharded remote scheduler',
+        config_path=dict(section='core', name='default-scheduler-urls'),
+    )
     lock_size = parameter.IntParameter(
         default=1,
         description="Maximum number of workers running the same command")
@@ -143,6 +148,9 @@ class _WorkerSchedulerFactory(object):
     def create_remote_scheduler(self, url):
         return rpc.RemoteScheduler(url)
 
+    def create_sharded_remote_scheduler(self, urls):
+        return rpc.ShardedRemoteScheduler([self.create_remote_scheduler(url) for url in urls])
+
     def create_worker(self, scheduler, worker_processes, assistant=False):
         return worker.Worker(
             scheduler=scheduler, worker_processes=worker_processes, assistant=assistant)
@@ -181,6 +189,8 @@ def _schedule_and_run(tasks, worker_scheduler_factory=None, override_defaults=No
 
     if env_params.local_scheduler:
         sch = worker_scheduler_factory.create_local_scheduler()
+    elif env_params.scheduler_urls:
+        sch = worker_scheduler_factory.create_sharded_remote_scheduler(urls=env_params.scheduler_urls)
     else:
         if env_params.scheduler_url != '':
             url = env_params.scheduler_url
@@ -19,17 +19,23 @@ Implementation of the REST interface between the workers and the server.
 rpc.py implements the client side of it, server.py implements the server side.
 See :doc:`/central_scheduler` for more info.
 """
+import collections
 import json
 import logging
+import random
 import socket
+import threading
 import time
+import zlib
 
+from luigi.six.moves import http_client
 from luigi.six.moves.urllib.parse import urljoin, urlencode, urlparse
-from luigi.six.moves.urllib.request import urlopen
-from luigi.six.moves.urllib.error import URLError
+from luigi.six.moves.urllib.error import HTTPError, URLError
 
 from luigi import configuration
-from luigi.scheduler import RPC_METHODS
+from luigi.scheduler import RPC_METHODS, WORKER_STATE_ACTIVE, WORKER_STATE_DISABLED
+from luigi.scheduler_sharding import HashRing
+from luigi.task_status import PENDING, RUNNING
 
 HAS_UNIX_SOCKET = True
 HAS_REQUESTS = True
@@ -67,23 +73,130 @@ class RPCError(Exception):
         self.sub_exception = sub_exception
 
 
+class RPCMethodNotFound(RPCError):
+    """
+    The remote scheduler doesn't know the method called, most likely because it runs an older version.
+    """
+
+
+def _http_status(exception):
+    if isinstance(exception, HTTPError):
+        return exception.code
+    response = getattr(exception, 'response', None)
+    if response is not None:
+        return response.status_code
+    return None
+
+
+GZIP_MIN_SIZE = 1024  # request bodies smaller than this aren't worth compressing
+_GZIP_WBITS = 16 + zlib.MAX_WBITS  # zlib's way of asking for gzip headers
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _gunzip(data):
+    return zlib.decompress(data, _GZIP_WBITS)
+
+
+def _encode_body(body, compress):
+    """
+    Form-encode ``body``, gzipping it when ``compress`` is set and it is large enough.
+
+    Returns the encoded body and the headers to send it with.
+    """
+    data = urlencode(body).encode('utf-8')
+    headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Accept-Encoding': 'gzip'}
+    if compress and len(data) >= GZIP_MIN_SIZE:
+        data = _gzip(data)
+        headers['Content-Encoding'] = 'gzip'
+    return data, headers
+
+
+def _accepts_gzip(headers):
+    # Schedulers that can read gzipped requests say so in their responses (RFC 7694)
+    return 'gzip' in (headers.get('Accept-Encoding') or '')
+
+
 class URLLibFetcher(object):
-    raises = (URLError, socket.timeout)
+    """
+    Fetch with the standard library, keeping the connections to the scheduler open between calls.
+    """
+
+    raises = (URLError, socket.timeout, socket.error, http_client.HTTPException)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}  # (scheme, netloc) -> connections free for the next call
+        self._compress = False
+
+    def _connection(self, scheme, netloc, timeout, reuse):
+        if reuse:
+            with self._lock:
+                idle = self._idle.get((scheme, netloc))
+                if idle:
+                    connection = idle.pop()
+                    connection.timeout = timeout
+                    if connection.sock is not None:
+                        connection.sock.settimeout(timeout)
+                    return connection, True
+        if scheme == 'https':
+            return http_client.HTTPSConnection(netloc, timeout=timeout), False
+        return http_client.HTTPConnection(netloc, timeout=timeout), False
+
+    def _release(self, scheme, netloc, connection):
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(connection)
 
     def fetch(self, full_url, body, timeout):
-        body = urlencode(body).encode('utf-8')
-        return urlopen(full_url, body, timeout).read().decode('utf-8')
+        parsed = urlparse(full_url)
+        path = parsed.path + ('?' + parsed.query if parsed.query else '')
+        data, headers = _encode_body(body, self._compress)
+        reuse = True
+        while True:
+            connection, reused = self._connection(parsed.scheme, parsed.netloc, timeout, reuse)
+            try:
+                connection.request('POST', path, data, headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (socket.error, http_client.HTTPException) as e:
+                connection.close()
+                if reused and not isinstance(e, socket.timeout):
+                    # The scheduler may have closed the idle connection, try again on a new one
+                    reuse = False
+                    continue
+                raise
+            break
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(parsed.scheme, parsed.netloc, connection)
+        if response.status >= 400:
+            raise HTTPError(full_url, response.status, response.reason, response.msg, None)
+        self._compress = _accepts_gzip(response.msg)
+        if response.getheader('Content-Encoding') == 'gzip':
+            content = _gunzip(content)
+        return content.decode('utf-8')
 
 
 class RequestsFetcher(object):
+    """
+    Fetch with requests, whose session keeps the connections to the scheduler open between calls.
+    """
+
     def __init__(self, session):
         from requests import exceptions as requests_exceptions
         self.raises = requests_exceptions.RequestException
         self.session = session
+        self._compress = False
 
     def fetch(self, full_url, body, timeout):
-        resp = self.session.get(full_url, data=body, timeout=timeout)
+        data, headers = _encode_body(body, self._compress)
+        resp = self.session.get(full_url, data=data, headers=headers, timeout=timeout)
         resp.raise_for_status()
+        self._compress = _accepts_gzip(resp.headers)
         return resp.text
 
 
@@ -106,17 +219,43 @@ class RemoteScheduler(object):
 
         self._rpc_retry_attempts = config.getint('core', 'rpc-retry-attempts', 3)
         self._rpc_retry_wait = config.getint('core', 'rpc-retry-wait', 30)
+        self._rpc_retry_max_wait = config.getint('core', 'rpc-retry-max-wait', 300)
+        self._rpc_circuit_breaker_threshold = config.getint('core', 'rpc-circuit-breaker-threshold', 3)
+        self._rpc_circuit_breaker_timeout = config.getfloat('core', 'rpc-circuit-breaker-timeout', 60.0)
 
         if HAS_REQUESTS:
             self._fetcher = RequestsFetcher(requests.Session())
         else:
             self._fetcher = URLLibFetcher()
 
+        self._has_add_tasks = True
+        self._failed_attempts = 0  # fetches failed in a row, for the backoff
+        self._failed_requests = 0  # requests that ran out of attempts in a row, for the circuit breaker
+        self._circuit_open_until = None
+
     def _wait(self):
-        logger.info("Wait for %d seconds" % self._rpc_retry_wait)
-        time.sleep(self._rpc_retry_wait)
+        # Exponential backoff with jitter, so that workers that lost the scheduler together don't come back together
+        wait = min(self._rpc_retry_max_wait, self._rpc_retry_wait * 2 ** max(0, self._failed_attempts - 1))
+        wait = random.uniform(wait / 2.0, wait)
+        logger.info("Wait for %.1f seconds" % wait)
+        time.sleep(wait)
 
-    def _fetch(self, url_suffix, body, log_exceptions=True):
+    def _check_circuit(self):
+        if self._circuit_open_until is None:
+            return
+        remaining = self._circuit_open_until - time.time()
+        if remaining > 0:
+            raise RPCError(
+                "Not connecting to remote scheduler %r for %d more seconds after %d failed requests" %
+                (self._url, remaining, self._failed_requests)
+            )
+        # Let this request through to see if the scheduler is back
+        self._circuit_open_until = None
+
+    def _fetch(self, url_suffix, body, log_exceptions=True, timeout=None):
+        if timeout is None:
+            timeout = self._connect_timeout
+        self._check_circuit()
         full_url = _urljoin(self._url, url_suffix)
         last_exception = None
         attempt = 0
@@ -126,31 +265,209 @@ class RemoteScheduler(object):
                 logger.info("Retrying attempt %r of %r (max)" % (attempt, self._rpc_retry_attempts))
                 self._wait()  # wait for a bit and retry
             try:
-                response = self._fetcher.fetch(full_url, body, self._connect_timeout)
+                response = self._fetcher.fetch(full_url, body, timeout)
                 break
             except self._fetcher.raises as e:
+                if _http_status(e) == 404:
+                    # Asking again won't make the method exist
+                    raise RPCMethodNotFound("Remote scheduler %r has no %s" % (self._url, url_suffix), e)
                 last_exception = e
+                self._failed_attempts += 1
                 if log_exceptions:
                     logger.exception("Failed connecting to remote scheduler %r", self._url)
                 continue
         else:
+            self._failed_requests += 1
+            if 0 < self._rpc_circuit_breaker_threshold <= self._failed_requests:
+                logger.warning("Not connecting to remote scheduler %r for %s seconds after %d failed requests",
+                               self._url, self._rpc_circuit_breaker_timeout, self._failed_requests)
+                self._circuit_open_until = time.time() + self._rpc_circuit_breaker_timeout
             raise RPCError(
                 "Errors (%d attempts) when connecting to remote scheduler %r" %
                 (self._rpc_retry_attempts, self._url),
                 last_exception
             )
+        self._failed_attempts = 0
+        self._failed_requests = 0
         return response
 
-    def _request(self, url, data, log_exceptions=True, attempts=3, allow_null=True):
+    def _request(self, url, data, log_exceptions=True, attempts=3, allow_null=True, timeout=None):
         body = {'data': json.dumps(data)}
 
         for _ in range(attempts):
-            page = self._fetch(url, body, log_exceptions)
+            page = self._fetch(url, body, log_exceptions, timeout)
             response = json.loads(page)["response"]
             if allow_null or response is not None:
                 return response
         raise RPCError("Received null response from remote scheduler %r" % self._url)
 
+    def add_tasks(self, worker, tasks):
+        """
+        Send several ``add_task`` calls in one request, or one by one to schedulers that don't have ``add_tasks``.
+        """
+        if self._has_add_tasks:
+            try:
+                return self._request('/api/add_tasks', {'worker': worker, 'tasks': tasks})
+            except RPCMethodNotFound:
+                logger.info("Remote scheduler %r doesn't have add_tasks, adding tasks one by one", self._url)
+                self._has_add_tasks = False
+        for task_kwargs in tasks:
+            self.add_task(worker=worker, **task_kwargs)
+
+    def get_work(self, host=None, assistant=False, current_tasks=None, worker=None, wait=0, **kwargs):
+        """
+        Ask for work, letting the scheduler hold the request for up to ``wait`` seconds until it has some.
+
+        Schedulers that don't long poll answer right away. Those that do add
+        ``waited`` to their reply.
+        """
+        kwargs.update(host=host, assistant=assistant, current_tasks=current_tasks, worker=worker)
+        if wait:
+            kwargs['wait'] = wait
+        return self._request('/api/get_work', kwargs, allow_null=False, timeout=self._connect_timeout + wait)
+
 
 for method_name, method in RPC_METHODS.items():
-    setattr(RemoteScheduler, method_name, method)
+    if method_name not in vars(RemoteScheduler):
+        setattr(RemoteScheduler, method_name, method)
+
+
+class ShardedRemoteScheduler(object):
+    """
+    Scheduler proxy object for a sharded scheduler, made of one scheduler per shard.
+
+    Calls about a task go to the shard owning it, calls about the worker go to
+    every shard and :py:meth:`get_work` asks the shards in turn, starting with
+    a different one every time, until one of them has something to run.
+    """
+
+    def __init__(self, shards):
+        """
+        :param shards: the :py:class:`RemoteScheduler` of each shard, in the order of ``[scheduler] shard_urls``
+        """
+        self._shards = list(shards)
+        self._ring = HashRing(len(self._shards))
+        self._next_shard = 0
+        self._batch_shards = {}  # batch id -> shard that handed out the batch
+        self._pinned_tasks = {}  # task id -> shard, for the tasks running batches
+
+    def _task_shard(self, task_id):
+        shard = self._pinned_tasks.get(task_id)
+        if shard is None:
+            shard = self._ring.get_shard(task_id)
+        return self._shards[shard]
+
+    def _worker_shard(self, worker):
+        return self._shards[self._ring.get_shard(worker)]
+
+    def _broadcast(self, method_name, *args, **kwargs):
+        return [getattr(shard, method_name)(*args, **kwargs) for shard in self._shards]
+
+    def _add_task_shard(self, task_id, kwargs):
+        # A batch is run as a task that only the shard that handed out the batch knows about
+        batch_id = kwargs.get('batch_id')
+        if batch_id is not None and batch_id in self._batch_shards:
+            self._pinned_tasks[task_id] = self._batch_shards.pop(batch_id)
+        shard = self._task_shard(task_id)
+        if kwargs.get('status', PENDING) not in (PENDING, RUNNING):
+            self._pinned_tasks.pop(task_id, None)
+        return shard
+
+    def add_task(self, task_id=None, **kwargs):
+        return self._add_task_shard(task_id, kwargs).add_task(task_id=task_id, **kwargs)
+
+    def add_tasks(self, worker, tasks):
+        # One request per shard, keeping the order of the calls each shard gets
+        shard_tasks = collections.OrderedDict()
+        for task_kwargs in tasks:
+            shard = self._add_task_shard(task_kwargs.get('task_id'), task_kwargs)
+            shard_tasks.setdefault(shard, []).append(task_kwargs)
+        for shard, shard_task_kwargs in shard_tasks.items():
+            shard.add_tasks(worker, shard_task_kwargs)
+
+    def add_worker(self, worker, info, **kwargs):
+        self._broadcast('add_worker', worker, info, **kwargs)
+
+    def add_task_batcher(self, worker, task_family, batched_args, max_batch_size=float('inf')):
+        self._broadcast('add_task_batcher', worker, task_family, batched_args, max_batch_size)
+
+    def disable_worker(self, worker):
+        self._broadcast('disable_worker', worker)
+
+    def update_resources(self, **resources):
+        self._broadcast('update_resources', **resources)
+
+    def prune(self):
+        self._broadcast('prune')
+
+    def set_worker_processes(self, worker, n):
+        self._worker_shard(worker).set_worker_processes(worker, n)
+
+    def announce_scheduling_failure(self, task_name, family, params, expl, owners, **kwargs):
+        self._worker_shard(kwargs['worker']).announce_scheduling_failure(
+            task_name, family, params, expl, owners, **kwargs)
+
+    def ping(self, **kwargs):
+        rpc_messages = []
+        for reply in self._broadcast('ping', **kwargs):
+            rpc_messages.extend(reply['rpc_messages'])
+        return {'rpc_messages': rpc_messages}
+
+    @staticmethod
+    def _merge_counts(replies):
+        merged = {
+            'n_pending_tasks': 0,
+            'n_unique_pending': 0,
+            'n_pending_last_scheduled': 0,
+            'worker_state': WORKER_STATE_ACTIVE,
+            'running_tasks': [],
+        }
+        for reply in replies:
+            for key in ('n_pending_tasks', 'n_unique_pending', 'n_pending_last_scheduled'):
+                merged[key] += reply.get(key, 0)
+            merged['running_tasks'].extend(reply.get('running_tasks', []))
+            if reply.get('worker_state') == WORKER_STATE_DISABLED:
+                merged['worker_state'] = WORKER_STATE_DISABLED
+        return merged
+
+    def count_pending(self, worker):
+        return self._merge_counts(self._broadcast('count_pending', worker))
+
+    def get_work(self, **kwargs):
+        """
+        Ask the shards in turn for work.
+
+        The counts of pending tasks in the reply only include the shards that
+        were asked, which is all of them unless one of them had work.
+        """
+        # Shards don't long poll, holding the call on one would keep the others from handing out work
+        kwargs.pop('wait', None)
+        first = self._next_shard
+        self._next_shard = (first + 1) % len(self._shards)
+        replies = []
+        for i in range(len(self._shards)):
+            shard = (first + i) % len(self._shards)
+            reply = self._shards[shard].get_work(**kwargs)
+            replies.append(reply)
+            if reply.get('task_id') is not None or reply.get('batch_id') is not None:
+                break
+        else:
+            return dict(self._merge_counts(replies), task_id=None)
+
+        merged = dict(reply, **self._merge_counts(replies))
+        for work in reply.get('tasks', [reply]):
+            if work.get('batch_id') is not None:
+                self._batch_shards[work['batch_id']] = shard
+        return merged
+
+
+def _route_by_task_id(method_name):
+    def route(self, task_id, *args, **kwargs):
+        return getattr(self._task_shard(task_id), method_name)(task_id, *args, **kwargs)
+    route.__name__ = method_name
+    return route
+
+
+for method_name in ('dep_graph', 'inverse_dep_graph', 're_enable_task', 'fetch_error',
+                    'set_task_status_message', 'get_task_status_message'):
+    setattr(ShardedRemoteScheduler, method_name, _route_by_task_id(method_name))
@@ -31,19 +31,27 @@ try:
     import cPickle as pickle
 except ImportError:
     import pickle
+import bisect
 import functools
 import hashlib
+import heapq
 import itertools
 import logging
 import os
 import re
+import sqlite3
 import time
+import uuid
+import weakref
 
 from luigi import six
 
 from luigi import configuration
 from luigi import notifications
 from luigi import parameter
+from luigi import scheduler_journal
+from luigi import scheduler_sharding
+from luigi import scheduler_sqlite
 from luigi import task_history as history
 from luigi.task_status import DISABLED, DONE, FAILED, PENDING, RUNNING, SUSPENDED, UNKNOWN, \
     BATCH_RUNNING
@@ -115,7 +123,16 @@ def rpc_method(**request_args):
             return self._request('/api/{}'.format(fn_name), actual_args, **request_args)
 
         RPC_METHODS[fn_name] = rpc_func
-        return fn
+
+        @functools.wraps(fn)
+        def journaled_fn(self, *args, **kwargs):
+            # Persist whatever the call changed before answering it
+            try:
+                return fn(self, *args, **kwargs)
+            finally:
+                self._state.flush_journal()
+
+        return journaled_fn
 
     return _rpc_method
 
@@ -127,6 +144,18 @@ class scheduler(Config):
     remove_delay = parameter.FloatParameter(default=600.0)
     worker_disconnect_delay = parameter.FloatParameter(default=60.0)
     state_path = parameter.Parameter(default='/var/lib/luigi-server/state.pickle')
+    state_snapshot_interval = parameter.FloatParameter(default=300.0)
+    state_store = parameter.ChoiceParameter(choices=['journal', 'sqlite'], default='journal')
+    state_cache_size = parameter.IntParameter(default=100000)
+
+    # A sharded scheduler is made of one process per url, each owning the tasks hashing to it
+    shard_urls = parameter.ListParameter(default=[])
+    shard = parameter.IntParameter(default=0)
+    shard_sync_interval = parameter.FloatParameter(default=5.0)
+
+    # Answer the visualiser's queries from a copy of the state kept in another thread
+    query_replica = parameter.BoolParameter(default=False)
+    query_replica_staleness = parameter.FloatParameter(default=5.0)
 
     batch_emails = parameter.BoolParameter(default=False, description="Send e-mails in batches rather than immediately")
 
@@ -142,9 +171,19 @@ class scheduler(Config):
                                              config_path=dict(section='scheduler', name='disable-persist-seconds'))
     max_shown_tasks = parameter.IntParameter(default=100000)
     max_graph_nodes = parameter.IntParameter(default=100000)
+    max_graph_changes = parameter.IntParameter(default=100000)
 
     record_task_history = parameter.BoolParameter(default=False)
 
+    # Among tasks of the same priority, favour those with the longest chain of work left downstream
+    critical_path_priority = parameter.BoolParameter(default=False)
+
+    # Hand a second copy of an idempotent task running much longer than it usually does to an idle worker
+    speculative_execution = parameter.BoolParameter(default=False)
+    speculative_runtime_factor = parameter.FloatParameter(default=2.0)
+    speculative_min_runtime = parameter.FloatParameter(default=60.0)
+    speculative_refresh_interval = parameter.FloatParameter(default=3600.0)
+
     prune_on_get_work = parameter.BoolParameter(default=False)
 
     def _get_retry_policy(self):
@@ -159,6 +198,8 @@ class Failures(object):
     the number of failures in a sliding time window ending at the present.
     """
 
+    __slots__ = ('window', 'failures', 'first_failure_time')
+
     def __init__(self, window):
         """
         Initialize with the given window.
@@ -166,9 +207,27 @@ class Failures(object):
         :param window: how long to track failures for, as a float (number of seconds).
         """
         self.window = window
-        self.failures = collections.deque()
+        self.failures = None  # deque of failure timestamps, only created once a failure is added
         self.first_failure_time = None
 
+    def __getstate__(self):
+        return dict((attr, getattr(self, attr)) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        for attr in self.__slots__:
+            setattr(self, attr, state.get(attr))
+
+    def to_record(self):
+        return {'window': self.window, 'failures': list(self.failures or ()), 'first_failure_time': self.first_failure_time}
+
+    @classmethod
+    def from_record(cls, record):
+        failures = cls(record['window'])
+        if record.get('failures'):
+            failures.failures = collections.deque(record['failures'])
+        failures.first_failure_time = record.get('first_failure_time')
+        return failures
+
     def add_failure(self):
         """
         Add a failure event with the current timestamp.
@@ -178,12 +237,17 @@ class Failures(object):
         if not self.first_failure_time:
             self.first_failure_time = failure_time
 
+        if self.failures is None:
+            self.failures = collections.deque()
         self.failures.append(failure_time)
 
     def num_failures(self):
         """
         Return the number of failures in the window.
         """
+        if not self.failures:
+            return 0
+
         min_time = time.time() - self.window
 
         while self.failures and self.failures[0] < min_time:
@@ -195,7 +259,11 @@ class Failures(object):
         """
         Clear the failure queue.
         """
-        self.failures.clear()
+        self.failures = None
+
+
+def _resource_signature(resources):
+    return tuple(sorted(six.iteritems(resources or {})))
 
 
 def _get_default(x, default):
@@ -205,6 +273,71 @@ def _get_default(x, default):
         return default
 
 
+def _intern(value):
+    # Only native strings can be interned, so unicode is left alone on Python 2
+    if type(value) is str:
+        return six.moves.intern(value)
+    return value
+
+
+class _SharedParams(dict):
+    """
+    Params of a task that other tasks with equal params point to as well, never change one in place.
+    """
+    __slots__ = ('__weakref__',)
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+# Hash of the params items -> params, tasks of different families often have the same params
+_shared_params = weakref.WeakValueDictionary()
+
+
+def _intern_params(params):
+    params = _SharedParams((_intern(name), _intern(value)) for name, value in six.iteritems(params))
+    try:
+        key = hash(frozenset(six.iteritems(params)))
+    except TypeError:  # unhashable values, such as the lists of batched params
+        return params
+    shared = _shared_params.get(key)
+    if shared is None:
+        _shared_params[key] = params
+    elif shared == params:
+        return shared
+    return params
+
+
+def _task_list_key(task):
+    return task.status, task.updated, task.id
+
+
+def _worker_list_key(worker):
+    return -worker.started, worker.id
+
+
+def _page(items, key, page_size, cursor):
+    """
+    Return the page_size first items by key that come after the cursor, and the cursor of the next page.
+
+    Cursors are the key of the last item of a page, as a list so that they survive a JSON round trip.
+    """
+    if page_size < 1:
+        raise ValueError('page_size must be positive, not %r' % (page_size,))
+    if cursor is not None:
+        cursor = tuple(cursor)
+        items = (item for item in items if key(item) > cursor)
+    page = heapq.nsmallest(page_size + 1, items, key=key)
+    if len(page) > page_size:
+        return page[:page_size], list(key(page[page_size - 1]))
+    return page, None
+
+
+def _intern_ids(ids):
+    # A sorted tuple is a lot smaller than a set, and tasks rarely have more than a few deps
+    return tuple(sorted(set(_intern(task_id) for task_id in ids)))
+
+
 class OrderedSet(collections.MutableSet):
     """
     Standard Python OrderedSet recipe found at http://code.activestate.com/recipes/576694/
@@ -273,16 +406,147 @@ class OrderedSet(collections.MutableSet):
         return set(self) == set(other)
 
 
+class CompactOrderedSet(collections.MutableSet):
+    """
+    An ordered set which keeps its items in a tuple until it outgrows ``max_tuple_size``.
+
+    Most tasks have zero or one worker and stakeholder, and a tuple that small is a
+    fraction of the size of an :py:class:`OrderedSet` or even a ``set``. Empty sets
+    share the empty tuple. Larger sets are converted to an :py:class:`OrderedSet`.
+    """
+
+    __slots__ = ('_items',)
+
+    max_tuple_size = 8
+
+    def __init__(self, iterable=None):
+        self._items = ()
+        if iterable is not None:
+            for key in iterable:
+                self.add(key)
+
+    def __reduce__(self):
+        return self.__class__, (list(self),)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __reversed__(self):
+        return reversed(self._items)
+
+    def add(self, key):
+        items = self._items
+        if key in items:
+            return
+        if isinstance(items, tuple):
+            if len(items) < self.max_tuple_size:
+                self._items = items + (key,)
+                return
+            self._items = items = OrderedSet(items)
+        items.add(key)
+
+    def discard(self, key):
+        items = self._items
+        if isinstance(items, tuple):
+            if key in items:
+                self._items = tuple(item for item in items if item != key)
+        else:
+            items.discard(key)
+
+    def peek(self, last=True):
+        if not self:
+            raise KeyError('set is empty')
+        items = self._items
+        if isinstance(items, tuple):
+            return items[-1] if last else items[0]
+        return items.peek(last)
+
+    def pop(self, last=True):
+        key = self.peek(last)
+        self.discard(key)
+        return key
+
+    def __repr__(self):
+        if not self:
+            return '%s()' % (self.__class__.__name__,)
+        return '%s(%r)' % (self.__class__.__name__, list(self))
+
+    def __eq__(self, other):
+        if isinstance(other, (OrderedSet, CompactOrderedSet)):
+            return len(self) == len(other) and list(self) == list(other)
+        return set(self) == set(other)
+
+
+class RankedTasks(object):
+    """
+    Tasks kept sorted by a rank key, lowest key first.
+
+    The keys are kept in a list maintained with bisect, so adding or removing a
+    task costs a binary search plus a list shift, and iterating in rank order
+    never requires sorting. Keys must be unique, which is why they end with a
+    sequence number.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._tasks = []
+        self._task_keys = {}  # map from task id to its current key
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, task_id):
+        return task_id in self._task_keys
+
+    def __iter__(self):
+        return iter(self._tasks)
+
+    def items(self):
+        return six.moves.zip(self._keys, self._tasks)
+
+    def add(self, task, key):
+        self.discard(task.id)
+        index = bisect.bisect_left(self._keys, key)
+        self._keys.insert(index, key)
+        self._tasks.insert(index, task)
+        self._task_keys[task.id] = key
+
+    def discard(self, task_id):
+        key = self._task_keys.pop(task_id, None)
+        if key is not None:
+            index = bisect.bisect_left(self._keys, key)
+            del self._keys[index]
+            del self._tasks[index]
+
+    def after(self, key):
+        """
+        Iterate over the tasks with a higher key than the given one.
+        """
+        return itertools.islice(self._tasks, bisect.bisect_right(self._keys, key), None)
+
+
 class Task(object):
+    _attrs = (
+        'id', 'stakeholders', 'workers', 'deps', 'status', 'time', 'updated', 'retry', 'remove',
+        'worker_running', 'time_running', 'expl', 'priority', 'resources', 'family', 'module', 'params',
+        'retry_policy', 'failures', 'tracking_url', 'status_message', 'scheduler_disable_time',
+        'runnable', 'batchable', 'batch_id', 'idempotent', 'backup_worker', 'stopped_worker',
+    )
+    __slots__ = _attrs + ('_pretty_id',)  # _pretty_id caches pretty_id and isn't saved
+
     def __init__(self, task_id, status, deps, resources=None, priority=0, family='', module=None,
                  params=None, tracking_url=None, status_message=None, retry_policy='notoptional'):
-        self.id = task_id
-        self.stakeholders = set()  # workers ids that are somehow related to this task (i.e. don't prune while any of these workers are still active)
-        self.workers = OrderedSet()  # workers ids that can perform task - task is 'BROKEN' if none of these workers are active
-        if deps is None:
-            self.deps = set()
-        else:
-            self.deps = set(deps)
+        self.id = _intern(task_id)
+        # workers ids that are somehow related to this task (i.e. don't prune while any of these workers are still active)
+        self.stakeholders = CompactOrderedSet()
+        self.workers = CompactOrderedSet()  # workers ids that can perform task - task is 'BROKEN' if none of these workers are active
+        self.deps = _intern_ids(deps or ())
         self.status = status  # PENDING, RUNNING, FAILED or DONE
         self.time = time.time()  # Timestamp when task was first added
         self.updated = self.time
@@ -293,9 +557,9 @@ class Task(object):
         self.expl = None
         self.priority = priority
         self.resources = _get_default(resources, {})
-        self.family = family
-        self.module = module
-        self.params = _get_default(params, {})
+        self.family = _intern(family)
+        self.module = _intern(module)
+        self.params = _intern_params(_get_default(params, {}))
 
         self.retry_policy = retry_policy
         self.failures = Failures(self.retry_policy.disable_window)
@@ -305,9 +569,61 @@ class Task(object):
         self.runnable = False
         self.batchable = False
         self.batch_id = None
+        self.idempotent = False
+        self.backup_worker = None  # the worker id that is running a second copy of the task or None
+        self.stopped_worker = None  # the worker id that was told to stop its copy of the task or None
+        self._pretty_id = None
+
+    def __getstate__(self):
+        # Attributes that are None are left out to keep the pickled state small
+        return dict((attr, value) for attr, value in self._items() if value is not None)
+
+    def __setstate__(self, state):
+        # Also accepts the __dict__ of tasks pickled before Task had __slots__
+        for attr in self._attrs:
+            setattr(self, attr, state.get(attr))
+        self._pretty_id = None
+        self.id = _intern(self.id)
+        self.stakeholders = CompactOrderedSet(_intern(worker_id) for worker_id in self.stakeholders or ())
+        self.workers = CompactOrderedSet(_intern(worker_id) for worker_id in self.workers or ())
+        self.deps = _intern_ids(self.deps or ())
+        self.priority = _get_default(self.priority, 0)
+        self.resources = _get_default(self.resources, {})
+        self.family = _intern(_get_default(self.family, ''))
+        self.module = _intern(self.module)
+        self.params = _intern_params(_get_default(self.params, {}))
+        self.runnable = bool(self.runnable)
+        self.batchable = bool(self.batchable)
+        self.idempotent = bool(self.idempotent)
+
+    def _items(self):
+        return ((attr, getattr(self, attr)) for attr in self._attrs)
+
+    def to_record(self):
+        """
+        Return the task as a dict of JSON serializable values, see :py:mod:`luigi.scheduler_journal`.
+        """
+        record = self.__getstate__()
+        record['stakeholders'] = list(self.stakeholders)
+        record['workers'] = list(self.workers)
+        record['deps'] = list(self.deps)
+        record['params'] = dict(self.params)
+        record['resources'] = dict(self.resources)
+        record['retry_policy'] = dict(self.retry_policy._asdict())
+        record['failures'] = self.failures.to_record()
+        return record
+
+    @classmethod
+    def from_record(cls, record):
+        task = cls.__new__(cls)
+        state = dict(record)
+        state['retry_policy'] = RetryPolicy(**record['retry_policy'])
+        state['failures'] = Failures.from_record(record['failures'])
+        task.__setstate__(state)
+        return task
 
     def __repr__(self):
-        return "Task(%r)" % vars(self)
+        return "Task(%r)" % dict(self._items())
 
     # TODO(2017-08-10) replace this function with direct calls to batchable
     # this only exists for backward compatibility
@@ -332,10 +648,17 @@ class Task(object):
 
         return False
 
+    def set_family_and_params(self, family, params):
+        self.family = _intern(family)
+        self.params = _intern_params(params)
+        self._pretty_id = None
+
     @property
     def pretty_id(self):
-        param_str = ', '.join('{}={}'.format(key, value) for key, value in sorted(self.params.items()))
-        return '{}({})'.format(self.family, param_str)
+        if self._pretty_id is None:
+            param_str = ', '.join('{}={}'.format(key, value) for key, value in sorted(self.params.items()))
+            self._pretty_id = '{}({})'.format(self.family, param_str)
+        return self._pretty_id
 
 
 class Worker(object):
@@ -343,17 +666,45 @@ class Worker(object):
     Structure for tracking worker activity and keeping their references.
     """
 
+    __slots__ = ('id', 'reference', 'last_active', 'last_get_work', 'started', 'info', 'disabled', 'rpc_messages')
+
     def __init__(self, worker_id, last_active=None):
-        self.id = worker_id
+        self.id = _intern(worker_id)
         self.reference = None  # reference to the worker in the real world. (Currently a dict containing just the host)
         self.last_active = last_active or time.time()  # seconds since epoch
         self.last_get_work = None
         self.started = time.time()  # seconds since epoch
-        self.tasks = set()  # task objects
         self.info = {}
         self.disabled = False
         self.rpc_messages = []
 
+    def __getstate__(self):
+        return dict((attr, getattr(self, attr)) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        # Also accepts the __dict__ of workers pickled before Worker had __slots__
+        for attr in self.__slots__:
+            setattr(self, attr, state.get(attr))
+        self.id = _intern(self.id)
+        self.info = _get_default(self.info, {})
+        self.disabled = bool(self.disabled)
+        self.rpc_messages = _get_default(self.rpc_messages, [])
+
+    def to_record(self):
+        """
+        Return the worker as a dict of JSON serializable values, see :py:mod:`luigi.scheduler_journal`.
+        """
+        record = self.__getstate__()
+        record['info'] = dict(self.info)
+        record['rpc_messages'] = list(self.rpc_messages)
+        return record
+
+    @classmethod
+    def from_record(cls, record):
+        worker = cls.__new__(cls)
+        worker.__setstate__(record)
+        return worker
+
     def add_info(self, info):
         self.info.update(info)
 
@@ -370,12 +721,7 @@ class Worker(object):
             return True
 
     def get_tasks(self, state, *statuses):
-        num_self_tasks = len(self.tasks)
-        num_state_tasks = sum(len(state._status_tasks[status]) for status in statuses)
-        if num_self_tasks < num_state_tasks:
-            return six.moves.filter(lambda task: task.status in statuses, self.tasks)
-        else:
-            return six.moves.filter(lambda task: self.id in task.workers, state.get_active_tasks_by_status(*statuses))
+        return state.get_worker_tasks(self.id, *statuses)
 
     def is_trivial_worker(self, state):
         """
@@ -420,17 +766,113 @@ class SimpleTaskState(object):
     """
     Keep track of the current state and handle persistance.
 
-    The point of this class is to enable other ways to keep state, eg. by using a database
-    These will be implemented by creating an abstract base class that this and other classes
-    inherit from.
+    All tasks are kept in memory and persisted with a :py:class:`~luigi.scheduler_journal.StateJournal`.
+    Other ways to keep state, eg. by using a database, are implemented by subclasses, see
+    :py:class:`SqliteTaskState`.
     """
 
-    def __init__(self, state_path):
+    def __init__(self, state_path, max_task_changes=100000):
         self._state_path = state_path
         self._tasks = {}  # map from id to a Task object
         self._status_tasks = collections.defaultdict(dict)
         self._active_workers = {}  # map from id to a Worker object
         self._task_batchers = {}
+        self._work_version = 0  # changes whenever a worker may have gotten a task to run
+        self._reset_indexes()
+
+        # Tasks whose status, priority or deps changed, for clients that follow the state
+        self._state_version = 0  # number of changes so far
+        self._task_changes = collections.OrderedDict()  # task id -> version of its last change, oldest first
+        self._task_changes_since = 0  # every change after this version is still in _task_changes
+        self._max_task_changes = max_task_changes
+
+        # Typical runtime of the tasks of each family, only set when ranking by critical path
+        self._runtime_estimates = None
+        self._default_runtime = 1.0
+
+        # Changes not written to the journal yet. Only tracked once load has started the journal.
+        self._journal = None
+        self._dirty_tasks = set()
+        self._dirty_workers = set()
+        self._dirty_batchers = set()
+        self._removed_tasks = []
+        self._removed_workers = []
+        self._record_listeners = []
+
+    def _reset_indexes(self):
+        # Everything below is derived from the tasks and workers, so it's rebuilt on load rather than persisted.
+
+        # Reverse dependencies, and how many deps of each task aren't DONE (or don't exist)
+        self._dependents = {}  # task id -> set of ids of active tasks depending on it
+        self._unmet_deps = {}  # task id -> number of deps that aren't DONE
+
+        # The ready queue holds every schedulable PENDING task and every RUNNING task ordered
+        # by rank. PENDING tasks are bucketed by the resources they need.
+        self._pending_queues = collections.defaultdict(RankedTasks)  # resource signature -> tasks
+        self._running_queue = RankedTasks()
+        self._queued_signatures = {}  # task id -> resource signature, or None when running
+        self._status_seq = {}  # task id -> order in which the task entered its current status
+        self._status_counter = itertools.count()
+        self._used_resources = collections.defaultdict(int)  # resource -> amount used by RUNNING tasks
+
+        # Schedulable batchable PENDING tasks by the batch they could go in, for every set of batched
+        # params a batcher was added with. Tasks of a family with the same batched param names and
+        # the same other params can be batched together.
+        self._batch_param_names = {}  # family -> set of sorted tuples of batched param names
+        self._batch_groups = {}  # (family, batched param names, frozenset of other params) -> tasks
+        self._batch_group_keys = {}  # task id -> keys of the batch groups it's in
+
+        # Tasks by the workers that can run them, are running them or are stakeholders, and by batch
+        self._worker_tasks = {}  # worker id -> status -> {task id: task} for ids in task.workers
+        self._worker_running_tasks = {}  # worker id -> {task id: task} for RUNNING/BATCH_RUNNING tasks
+        self._stakeholder_tasks = {}  # worker id -> set of ids of tasks it's a stakeholder of
+        self._batch_tasks = {}  # batch id -> {task id: task}
+
+        # Upstream status of PENDING tasks with deps, kept until the status or deps of a task upstream change
+        self._upstream_statuses = {}  # task id -> one of UPSTREAM_SEVERITY_ORDER
+
+        # Search index over the parts of the pretty ids of tasks between ', ' separators. Search terms
+        # have no spaces, so one without a comma can only be found within a part.
+        self._search_parts = {}  # part -> set of ids of the tasks whose pretty id has it
+        self._search_trigrams = {}  # trigram -> set of parts containing it
+
+        # With critical path ranking, the estimated runtime of each task that isn't DONE plus the longest
+        # such path among the tasks depending on it: how long until everything downstream could be done.
+        self._path_lengths = {}  # task id -> seconds
+        self._family_path_tasks = {}  # family -> ids of the tasks that have a path length
+
+        # Timers for prune, so it only has to look at tasks and workers whose deadlines have passed.
+        # Each heap holds (value, id) pairs; entries whose value is no longer current are dropped lazily.
+        self._task_timers = dict((attr, []) for attr in ('retry', 'remove', 'scheduler_disable_time'))
+        self._orphan_candidates = set()  # ids of tasks that may have lost their last stakeholder
+        self._worker_timers = []  # heap of (last_active, worker id)
+        self._worker_timer_keys = {}  # worker id -> last_active of its current entry in the heap
+
+    def _rebuild_indexes(self):
+        self._status_tasks = collections.defaultdict(dict)
+        self._reset_indexes()
+        for task in six.itervalues(self._tasks):
+            self._status_tasks[task.status][task.id] = task
+            self._status_seq[task.id] = next(self._status_counter)
+            self._index_search(task)
+        for batchers in six.itervalues(self._task_batchers):
+            for family, (batcher_args, _) in six.iteritems(batchers):
+                self._add_batch_param_names(family, batcher_args)
+        for task in six.itervalues(self._tasks):
+            self._index_deps(task)
+        for task in six.itervalues(self._tasks):
+            self._enqueue(task)
+            self._index_workers(task)
+            for worker_id in task.stakeholders:
+                self._stakeholder_tasks.setdefault(worker_id, set()).add(task.id)
+            if task.batch_id is not None:
+                self._batch_tasks.setdefault(task.batch_id, {})[task.id] = task
+            for attr in self._task_timers:
+                self._push_task_timer(task, attr)
+            self._orphan_candidates.add(task.id)
+        for worker in six.itervalues(self._active_workers):
+            self._push_worker_timer(worker)
+        self._compute_path_lengths()
 
     def get_state(self):
         return self._tasks, self._active_workers, self._task_batchers
@@ -440,32 +882,155 @@ class SimpleTaskState(object):
         if len(state) >= 3:
             self._task_batchers = state[2]
 
+    def _records(self):
+        for task in six.itervalues(self._tasks):
+            yield 'task', task.to_record()
+        for worker in six.itervalues(self._active_workers):
+            yield 'worker', worker.to_record()
+        for worker_id, batchers in six.iteritems(self._task_batchers):
+            yield 'batchers', {'worker': worker_id, 'batchers': dict(batchers)}
+
+    def _apply_record(self, kind, payload):
+        if kind == 'task':
+            task = Task.from_record(payload)
+            self._tasks[task.id] = task
+        elif kind == 'worker':
+            worker = Worker.from_record(payload)
+            self._active_workers[worker.id] = worker
+        elif kind == 'batchers':
+            self._task_batchers[payload['worker']] = dict(
+                (family, tuple(batcher)) for family, batcher in six.iteritems(payload['batchers']))
+        elif kind == 'remove_tasks':
+            for task_id in payload:
+                self._tasks.pop(task_id, None)
+        elif kind == 'remove_workers':
+            for worker_id in payload:
+                self._active_workers.pop(worker_id, None)
+        else:
+            raise scheduler_journal.StateFormatError('Unknown record kind %r' % (kind,))
+
+    def touch_task(self, task):
+        """
+        Mark the task as changed so that it's written to the journal.
+        """
+        if self._journal is not None:
+            self._dirty_tasks.add(task.id)
+
+    def touch_worker(self, worker):
+        """
+        Mark the worker as changed so that it's written to the journal.
+        """
+        if self._journal is not None:
+            self._dirty_workers.add(worker.id)
+
+    def flush_journal(self):
+        """
+        Append the tasks and workers changed since the last call to the journal.
+        """
+        if self._journal is None:
+            return
+        records = []
+        if self._removed_tasks:
+            records.append(('remove_tasks', self._removed_tasks))
+        if self._removed_workers:
+            records.append(('remove_workers', self._removed_workers))
+        for task_id in self._dirty_tasks:
+            task = self._tasks.get(task_id)
+            if task is not None:
+                records.append(('task', task.to_record()))
+        for worker_id in self._dirty_workers:
+            worker = self._active_workers.get(worker_id)
+            if worker is not None:
+                records.append(('worker', worker.to_record()))
+        for worker_id in self._dirty_batchers:
+            records.append(('batchers', {'worker': worker_id, 'batchers': dict(self._task_batchers[worker_id])}))
+        self._dirty_tasks, self._dirty_workers, self._dirty_batchers = set(), set(), set()
+        self._removed_tasks, self._removed_workers = [], []
+        try:
+            self._journal.append(records)
+        except (IOError, sqlite3.Error):
+            logger.warning("Failed writing to the scheduler state journal", exc_info=1)
+        if records:
+            for listener in self._record_listeners:
+                listener(records)
+
+    def add_record_listener(self, listener):
+        """
+        Call listener with the records of the whole state, then with the records of every change.
+
+        Changes are only tracked once load has started the journal. The records passed to the
+        listener are never modified afterwards.
+        """
+        listener(list(self._records()))
+        self._record_listeners.append(listener)
+
+    def snapshot(self):
+        """
+        Write a compacted snapshot of the state in the background, so the journal can be truncated.
+
+        Only the records are built here, the slow part of serializing and writing them happens in
+        another thread.
+        """
+        if self._journal is None or self._journal.snapshot_running():
+            return
+        self.flush_journal()
+        self._journal.start_snapshot(list(self._records()))
+
     def dump(self):
+        """
+        Write the whole state as a snapshot, so that the next start doesn't have to replay a journal.
+        """
         try:
-            with open(self._state_path, 'wb') as fobj:
-                pickle.dump(self.get_state(), fobj)
-        except IOError:
+            if self._journal is not None:
+                self.flush_journal()
+                self._journal.compact(list(self._records()))
+            else:
+                scheduler_journal.write_snapshot(self._state_path, 0, self._records())
+                scheduler_journal.StateJournal(self._state_path).discard()
+        except (IOError, OSError):
             logger.warning("Failed saving scheduler state", exc_info=1)
         else:
             logger.info("Saved state in %s", self._state_path)
 
-    # prone to lead to crashes when old state is unpickled with updated code. TODO some kind of version control?
+    def _load_state(self, journal):
+        if scheduler_journal.is_snapshot(self._state_path):
+            sequence, records = scheduler_journal.read_snapshot(self._state_path)
+            for kind, payload in records:
+                self._apply_record(kind, payload)
+        elif os.path.exists(self._state_path):
+            # State files written by older versions of Luigi are a plain pickle
+            with open(self._state_path, 'rb') as fobj:
+                self.set_state(pickle.load(fobj))
+            sequence = 0
+            for worker_id, worker in list(six.iteritems(self._active_workers)):
+                if not isinstance(worker, Worker):  # very old state files stored timestamps instead
+                    self._active_workers[worker_id] = Worker(worker_id, last_active=worker)
+        else:
+            sequence = 0
+
+        for kind, payload in journal.replay(sequence):
+            self._apply_record(kind, payload)
+
     def load(self):
-        if os.path.exists(self._state_path):
+        """
+        Load the snapshot and replay the journal, then start journaling changes.
+        """
+        journal = scheduler_journal.StateJournal(self._state_path)
+        if os.path.exists(self._state_path) or journal.exists():
             logger.info("Attempting to load state from %s", self._state_path)
             try:
-                with open(self._state_path, 'rb') as fobj:
-                    state = pickle.load(fobj)
-            except BaseException:
-                logger.exception("Error when loading state. Starting from empty state.")
-                return
-
-            self.set_state(state)
-            self._status_tasks = collections.defaultdict(dict)
-            for task in six.itervalues(self._tasks):
-                self._status_tasks[task.status][task.id] = task
+                self._load_state(journal)
+            except (IOError, OSError, ValueError, EOFError, pickle.UnpicklingError, scheduler_journal.StateFormatError):
+                logger.exception("Error when loading state, moving %s and its journal aside with the suffix "
+                                 "'.unreadable'. Starting from empty state.", self._state_path)
+                self._tasks, self._active_workers, self._task_batchers = {}, {}, {}
+                if os.path.exists(self._state_path):
+                    os.rename(self._state_path, self._state_path + '.unreadable')
+                journal.move_aside('.unreadable')
+            self._rebuild_indexes()
         else:
             logger.info("No prior state file exists at %s. Starting with empty state", self._state_path)
+        self._journal = journal
 
     def get_active_tasks(self):
         return six.itervalues(self._tasks)
@@ -473,16 +1038,595 @@ class SimpleTaskState(object):
     def get_active_tasks_by_status(self, *statuses):
         return itertools.chain.from_iterable(six.itervalues(self._status_tasks[status]) for status in statuses)
 
+    def get_ranked_tasks(self, skip_resources=None):
+        """
+        Iterate over RUNNING tasks and schedulable PENDING tasks from highest to lowest rank.
+
+        The order is the one of :py:meth:`Scheduler._rank`. Tasks with the same
+        rank come PENDING first, then in the order they entered their status.
+
+        :param skip_resources: optional function called with the resources needed by a bucket of
+                               PENDING tasks right before its next task is yielded. If it returns
+                               True, the rest of that bucket is skipped.
+        """
+        heap = []
+        queues = [(None, self._running_queue)] + list(six.iteritems(self._pending_queues))
+        for i, (signature, queue) in enumerate(queues):
+            resources = dict(signature) if signature else None
+            items = iter(queue.items())
+            for key, task in items:
+                heap.append((key, i, task, resources, items))
+                break
+        heapq.heapify(heap)
+
+        while heap:
+            key, i, task, resources, items = heap[0]
+            if resources and skip_resources is not None and skip_resources(resources):
+                heapq.heappop(heap)
+                continue
+            yield task
+            for key, next_task in items:
+                heapq.heapreplace(heap, (key, i, next_task, resources, items))
+                break
+            else:
+                heapq.heappop(heap)
+
+    def rank_key(self, task):
+        """
+        Return the key ordering tasks in the ready queue, highest ranked first.
+        """
+        return -task.priority, -self._path_lengths.get(task.id, 0), task.time, task.status == RUNNING, self._status_seq[task.id]
+
+    def _enqueue(self, task):
+        if task.id in self._queued_signatures:
+            return  # eg. a RUNNING task whose deps are all DONE again, its resources are already counted
+        if task.status == PENDING and not self._unmet_deps.get(task.id):
+            signature = _resource_signature(task.resources)
+            key = self.rank_key(task)
+            self._pending_queues[signature].add(task, key)
+            self._queued_signatures[task.id] = signature
+            self._work_version += 1
+            if task.batchable:
+                for batch_param_names in self._batch_param_names.get(task.family, ()):
+                    self._add_batch_candidate(task, batch_param_names, key)
+        elif task.status == RUNNING:
+            self._running_queue.add(task, self.rank_key(task))
+            self._queued_signatures[task.id] = None
+            for resource, amount in six.iteritems(task.resources or {}):
+                self._used_resources[resource] += amount
+
+    def _dequeue(self, task):
+        if task.id not in self._queued_signatures:
+            return
+        signature = self._queued_signatures.pop(task.id)
+        if signature is None:
+            self._running_queue.discard(task.id)
+            self._work_version += 1
+            for resource, amount in six.iteritems(task.resources or {}):
+                self._used_resources[resource] -= amount
+                if not self._used_resources[resource]:
+                    del self._used_resources[resource]
+        else:
+            queue = self._pending_queues[signature]
+            queue.discard(task.id)
+            if not queue:
+                del self._pending_queues[signature]
+            for group_key in self._batch_group_keys.pop(task.id, ()):
+                group = self._batch_groups[group_key]
+                group.discard(task.id)
+                if not group:
+                    del self._batch_groups[group_key]
+
+    @staticmethod
+    def _batch_group_key(task, batch_param_names):
+        unbatched_params = frozenset(
+            (name, value) for name, value in six.iteritems(task.params) if name not in batch_param_names)
+        return task.family, batch_param_names, unbatched_params
+
+    def _add_batch_candidate(self, task, batch_param_names, key):
+        try:
+            group_key = self._batch_group_key(task, batch_param_names)
+        except TypeError:
+            return  # Params that can't be hashed never match
+        self._batch_groups.setdefault(group_key, RankedTasks()).add(task, key)
+        self._batch_group_keys.setdefault(task.id, []).append(group_key)
+
+    def _add_batch_param_names(self, family, batcher_args):
+        batch_param_names = tuple(sorted(batcher_args or ()))
+        family_names = self._batch_param_names.setdefault(family, set())
+        if not batch_param_names or batch_param_names in family_names:
+            return
+        family_names.add(batch_param_names)
+        for queue in six.itervalues(self._pending_queues):
+            for key, task in queue.items():
+                if task.family == family and task.batchable:
+                    self._add_batch_candidate(task, batch_param_names, key)
+
+    def get_batch_candidates(self, task, batcher_args):
+        """
+        Iterate over the schedulable batchable PENDING tasks that can go in a batch with the task, from highest
+        to lowest rank, starting after the task. O(1) per task.
+
+        These are the tasks of its family whose params other than the batched ones are the same.
+        """
+        try:
+            group = self._batch_groups.get(self._batch_group_key(task, tuple(sorted(batcher_args))))
+        except TypeError:
+            group = None
+        if group is None or task.id not in self._queued_signatures:
+            return iter(())
+        return group.after(self.rank_key(task))
+
+    def set_batchable(self, task, batchable):
+        if batchable != task.batchable:
+            self._dequeue(task)
+            task.batchable = batchable
+            self._enqueue(task)
+
+    def get_used_resources(self):
+        """
+        Return how much of each resource the RUNNING tasks hold. O(number of resources).
+
+        Tasks in a batch are accounted for by the RUNNING task of the batch.
+        """
+        return dict(self._used_resources)
+
+    def enable_critical_path(self, runtime_estimates):
+        """
+        Rank tasks of the same priority by how long the work downstream of them is expected to take.
+
+        :param runtime_estimates: typical runtime in seconds of the tasks of each family. Tasks of other families
+                                  are assumed to take the median of these, or 1 second when there are none.
+        """
+        self._runtime_estimates = dict(runtime_estimates)
+        if self._runtime_estimates:
+            self._default_runtime = sorted(self._runtime_estimates.values())[len(self._runtime_estimates) // 2]
+        self._compute_path_lengths()
+
+    def record_runtime(self, family, runtime):
+        """
+        Update the runtime estimate of the family with how long one of its tasks took.
+
+        The path lengths of its tasks, and of the tasks upstream of them, are
+        only updated when the estimate moves by more than 10%.
+        """
+        if self._runtime_estimates is None:
+            return
+        previous = self._runtime_estimates.get(family)
+        estimate = runtime if previous is None else 0.8 * previous + 0.2 * runtime
+        self._runtime_estimates[family] = estimate
+        if abs(estimate - (self._default_runtime if previous is None else previous)) > 0.1 * estimate:
+            self._update_path_lengths(list(self._family_path_tasks.get(family, ())))
+
+    def path_length(self, task):
+        """
+        Return the estimated seconds of work left from the start of the task to the end of what depends on it.
+
+        Always 0 unless ranking by critical path.
+        """
+        return self._path_lengths.get(task.id, 0)
+
+    def _path_length(self, task):
+        if task is None or task.status == DONE:
+            return None
+        downstream = [self._path_lengths[dependent_id] for dependent_id in self._dependents.get(task.id, ())
+                      if dependent_id in self._path_lengths]
+        return self._runtime_estimates.get(task.family, self._default_runtime) + max(downstream or [0])
+
+    def _set_path_length(self, task_id, family, length):
+        if length is not None:
+            self._path_lengths[task_id] = length
+            self._family_path_tasks.setdefault(family, set()).add(task_id)
+        elif self._path_lengths.pop(task_id, None) is not None:
+            family_tasks = self._family_path_tasks.get(family, set())
+            family_tasks.discard(task_id)
+            if not family_tasks:
+                self._family_path_tasks.pop(family, None)
+
+    def _compute_path_lengths(self):
+        self._path_lengths = {}
+        self._family_path_tasks = {}
+        if self._runtime_estimates is None:
+            return
+        # Downstream tasks first, so every task is computed once its dependents are
+        remaining = dict((task_id, sum(1 for dependent_id in self._dependents.get(task_id, ()) if dependent_id in self._tasks))
+                         for task_id in self._tasks)
+        ready = collections.deque(task_id for (task_id, count) in six.iteritems(remaining) if count == 0)
+        while ready:
+            task = self._tasks[ready.popleft()]
+            self._set_path_length(task.id, task.family, self._path_length(task))
+            for dep in set(task.deps):
+                if dep in remaining:
+                    remaining[dep] -= 1
+                    if remaining[dep] == 0:
+                        ready.append(dep)
+        for task in six.itervalues(self._tasks):
+            if task.id in self._queued_signatures:
+                self._dequeue(task)
+                self._enqueue(task)
+
+    def _update_path_lengths(self, task_ids):
+        """
+        Recompute the path lengths of the tasks, and of the tasks upstream of those whose path length changed.
+        """
+        if self._runtime_estimates is None:
+            return
+        pending = collections.deque(task_ids)
+        visits = collections.defaultdict(int)
+        while pending:
+            task_id = pending.popleft()
+            task = self._tasks.get(task_id)
+            length = self._path_length(task)
+            if length == self._path_lengths.get(task_id):
+                continue
+            visits[task_id] += 1
+            if visits[task_id] > len(self._dependents.get(task_id, ())) + 1:
+                continue  # the deps form a cycle
+            if task is None:
+                self._path_lengths.pop(task_id, None)  # removed from the family index by inactivate_tasks
+            else:
+                self._set_path_length(task_id, task.family, length)
+                if task_id in self._queued_signatures:
+                    self._dequeue(task)
+                    self._enqueue(task)
+                pending.extend(task.deps)
+
+    def set_priority(self, task, priority):
+        if priority != task.priority:
+            self.touch_task(task)
+            self.task_changed(task.id)
+            self._dequeue(task)
+            task.priority = priority
+            self._enqueue(task)
+
+    def set_resources(self, task, resources):
+        self.touch_task(task)
+        self._dequeue(task)
+        task.resources = resources
+        self._enqueue(task)
+
+    def _index_deps(self, task):
+        unmet_deps = 0
+        for dep in task.deps:
+            self._dependents.setdefault(dep, set()).add(task.id)
+            if not self._is_done(dep):
+                unmet_deps += 1
+        self._unmet_deps[task.id] = unmet_deps
+
+    def _unindex_deps(self, task):
+        for dep in task.deps:
+            dependents = self._dependents.get(dep)
+            if dependents is not None:
+                dependents.discard(task.id)
+                if not dependents:
+                    del self._dependents[dep]
+        self._unmet_deps.pop(task.id, None)
+
+    def _is_done(self, task_id):
+        task = self._tasks.get(task_id)
+        return task is not None and task.status == DONE
+
+    def _update_dependents(self, task_id, delta):
+        """
+        Adjust the unmet dependency count of the tasks depending on task_id.
+
+        Called with -1 when the task becomes DONE and +1 when it stops being DONE (or is removed).
+        """
+        for dependent_id in self._dependents.get(task_id, ()):
+            dependent = self._tasks.get(dependent_id)
+            if dependent is None:
+                continue
+            unmet_deps = self._unmet_deps.get(dependent_id, 0) + delta
+            self._unmet_deps[dependent_id] = unmet_deps
+            if unmet_deps == 0:
+                self._enqueue(dependent)
+            elif unmet_deps == 1 and delta > 0 and dependent.status == PENDING:
+                self._dequeue(dependent)
+
+    def set_deps(self, task, deps):
+        self.touch_task(task)
+        deps = _intern_ids(deps)
+        old_deps = task.deps
+        if deps != tuple(old_deps):
+            self.task_changed(task.id)
+        self._dequeue(task)
+        self._unindex_deps(task)
+        task.deps = deps
+        self._index_deps(task)
+        self._enqueue(task)
+        self._invalidate_upstream_status(task.id)
+        if deps != tuple(old_deps):
+            self._update_path_lengths(set(old_deps).union(deps))
+
+    def add_deps(self, task, deps):
+        self.set_deps(task, set(task.deps).union(deps))
+
+    def get_dependents(self, task_id):
+        """
+        Return the ids of the active tasks that have task_id as a dependency. O(1).
+        """
+        return self._dependents.get(task_id, set())
+
+    def has_unmet_deps(self, task):
+        """
+        Return whether some dependency of the task isn't DONE (or doesn't exist). O(1).
+        """
+        return self._unmet_deps.get(task.id, 0) > 0
+
+    def _index_search(self, task):
+        for part in set(task.pretty_id.split(', ')):
+            task_ids = self._search_parts.get(part)
+            if task_ids is None:
+                task_ids = self._search_parts[part] = set()
+                for i in range(len(part) - 2):
+                    self._search_trigrams.setdefault(part[i:i + 3], set()).add(part)
+            task_ids.add(task.id)
+
+    def _unindex_search(self, task):
+        for part in set(task.pretty_id.split(', ')):
+            task_ids = self._search_parts.get(part)
+            if task_ids is None:
+                continue
+            task_ids.discard(task.id)
+            if not task_ids:
+                del self._search_parts[part]
+                for i in range(len(part) - 2):
+                    parts = self._search_trigrams.get(part[i:i + 3])
+                    if parts is not None:
+                        parts.discard(part)
+                        if not parts:
+                            del self._search_trigrams[part[i:i + 3]]
+
+    def _search_task_ids(self, term):
+        if len(term) < 3:
+            parts = self._search_parts
+        else:
+            parts = min((self._search_trigrams.get(term[i:i + 3], ()) for i in range(len(term) - 2)), key=len)
+        task_ids = set()
+        for part in parts:
+            if term in part:
+                task_ids.update(self._search_parts[part])
+        return task_ids
+
+    def search_tasks(self, terms, status=None):
+        """
+        Return the tasks whose pretty id contains all the terms, optionally only the ones with the status.
+
+        Candidates come from the search index, unless all terms have a comma.
+        """
+        task_ids = None
+        for term in terms:
+            if ',' not in term:
+                term_task_ids = self._search_task_ids(term)
+                task_ids = term_task_ids if task_ids is None else task_ids & term_task_ids
+        if task_ids is None:
+            tasks = six.itervalues(self._status_tasks.get(status, {}) if status else self._tasks)
+        else:
+            tasks = (self._tasks[task_id] for task_id in task_ids)
+        return [task for task in tasks
+                if (not status or task.status == status) and all(term in task.pretty_id for term in terms)]
+
+    def set_family_and_params(self, task, family, params):
+        self._dequeue(task)
+        self._unindex_search(task)
+        length = self._path_lengths.get(task.id)
+        self._set_path_length(task.id, task.family, None)
+        task.set_family_and_params(family, params)
+        self._set_path_length(task.id, task.family, length)
+        self._index_search(task)
+        self._enqueue(task)
+        self._update_path_lengths([task.id])
+
+    def _invalidate_upstream_status(self, task_id):
+        """
+        Forget the upstream status of the tasks downstream of a task whose status or deps changed.
+
+        A task's upstream status is only kept when those of the PENDING tasks it depends on are, so
+        the walk can stop at tasks that don't have one.
+        """
+        self._upstream_statuses.pop(task_id, None)
+        stack = list(self._dependents.get(task_id, ()))
+        while stack:
+            dependent_id = stack.pop()
+            if self._upstream_statuses.pop(dependent_id, None) is not None:
+                stack.extend(self._dependents.get(dependent_id, ()))
+
+    def _dep_upstream_status(self, task_id):
+        task = self._tasks.get(task_id)
+        if task is None or task.status == DONE:
+            return ''
+        elif task.status == PENDING and task.deps:
+            return self._upstream_statuses.get(task_id, '')  # only missing in a dependency cycle
+        else:
+            return STATUS_TO_UPSTREAM_MAP.get(task.status, '')
+
+    def get_upstream_status(self, task):
+        """
+        Return the most severe reason among the task and its PENDING upstream tasks why it can't run yet.
+
+        That's one of UPSTREAM_SEVERITY_ORDER, with '' for tasks that are DONE or waiting for nothing.
+        """
+        if task.status != PENDING or not task.deps:
+            return self._dep_upstream_status(task.id)
+        stack = [task]
+        visiting = set()
+        while stack:
+            top = stack[-1]
+            if top.id in self._upstream_statuses:
+                stack.pop()
+                continue
+            if top.id not in visiting:
+                visiting.add(top.id)
+                unknown_deps = [
+                    dep for dep in (self._tasks.get(dep_id) for dep_id in top.deps)
+                    if dep is not None and dep.status == PENDING and dep.deps and
+                    dep.id not in self._upstream_statuses and dep.id not in visiting
+                ]
+                if unknown_deps:
+                    stack.extend(unknown_deps)
+                    continue
+            stack.pop()
+            self._upstream_statuses[top.id] = max(
+                (self._dep_upstream_status(dep_id) for dep_id in top.deps), key=UPSTREAM_SEVERITY_KEY)
+        return self._upstream_statuses[task.id]
+
+    def _index_workers(self, task):
+        for worker_id in task.workers:
+            self._worker_tasks.setdefault(worker_id, {}).setdefault(task.status, {})[task.id] = task
+        if task.worker_running is not None and task.status in (RUNNING, BATCH_RUNNING):
+            self._worker_running_tasks.setdefault(task.worker_running, {})[task.id] = task
+
+    def _unindex_workers(self, task):
+        for worker_id in task.workers:
+            self._worker_tasks.get(worker_id, {}).get(task.status, {}).pop(task.id, None)
+        running_tasks = self._worker_running_tasks.get(task.worker_running)
+        if running_tasks is not None:
+            running_tasks.pop(task.id, None)
+            if not running_tasks:
+                del self._worker_running_tasks[task.worker_running]
+
+    def add_worker_to_task(self, task, worker_id):
+        worker_id = _intern(worker_id)
+        self.touch_task(task)
+        if worker_id not in task.workers:
+            self._work_version += 1
+        task.workers.add(worker_id)
+        self._worker_tasks.setdefault(worker_id, {}).setdefault(task.status, {})[task.id] = task
+
+    def add_stakeholder(self, task, worker_id):
+        worker_id = _intern(worker_id)
+        self.touch_task(task)
+        task.stakeholders.add(worker_id)
+        self._stakeholder_tasks.setdefault(worker_id, set()).add(task.id)
+
+    def set_worker_running(self, task, worker_id):
+        self.touch_task(task)
+        self._unindex_workers(task)
+        task.worker_running = worker_id
+        self._index_workers(task)
+
+    def set_backup_worker(self, task, worker_id):
+        self.touch_task(task)
+        task.backup_worker = worker_id
+
+    def _unindex_batch(self, task):
+        batch_tasks = self._batch_tasks.get(task.batch_id)
+        if batch_tasks is not None:
+            batch_tasks.pop(task.id, None)
+            if not batch_tasks:
+                del self._batch_tasks[task.batch_id]
+
+    def set_batch_id(self, task, batch_id):
+        self.touch_task(task)
+        self._unindex_batch(task)
+        task.batch_id = batch_id
+        if batch_id is not None:
+            self._batch_tasks.setdefault(batch_id, {})[task.id] = task
+
+    def get_worker_tasks(self, worker_id, *statuses):
+        """
+        Return the tasks with one of the statuses that the worker can run.
+        """
+        status_tasks = self._worker_tasks.get(worker_id, {})
+        return itertools.chain.from_iterable(
+            list(six.itervalues(status_tasks.get(status, {}))) for status in statuses)
+
+    def get_running_tasks(self, worker_id):
+        """
+        Return the RUNNING and BATCH_RUNNING tasks that are run by the worker.
+        """
+        return list(six.itervalues(self._worker_running_tasks.get(worker_id, {})))
+
     def get_batch_running_tasks(self, batch_id):
         assert batch_id is not None
         return [
-            task for task in self.get_active_tasks_by_status(BATCH_RUNNING)
-            if task.batch_id == batch_id
+            task for task in six.itervalues(self._batch_tasks.get(batch_id, {}))
+            if task.status == BATCH_RUNNING
         ]
 
+    def _push_task_timer(self, task, attr):
+        value = getattr(task, attr)
+        if value is not None:
+            heapq.heappush(self._task_timers[attr], (value, task.id))
+
+    def _set_task_timer(self, task, attr, value):
+        self.touch_task(task)
+        setattr(task, attr, value)
+        self._push_task_timer(task, attr)
+
+    def set_remove(self, task, remove):
+        self._set_task_timer(task, 'remove', remove)
+        if remove is None:
+            self._orphan_candidates.add(task.id)
+
+    def _pop_expired_tasks(self, attr, expired):
+        timers = self._task_timers[attr]
+        while timers and expired(timers[0][0]):
+            value, task_id = heapq.heappop(timers)
+            task = self._tasks.get(task_id)
+            if task is not None and getattr(task, attr) == value:
+                yield task
+
+    def get_prune_candidates(self, config):
+        """
+        Return the tasks prune has to look at.
+
+        These are the running tasks, the tasks that might have lost their last stakeholder and the
+        tasks whose retry, re-enable or removal deadline has passed. Any other task would be left
+        untouched by :py:meth:`fail_dead_worker_task`, :py:meth:`update_status` and :py:meth:`may_prune`.
+        """
+        now = time.time()
+        candidates = collections.OrderedDict()
+        for task in self.get_active_tasks_by_status(RUNNING, BATCH_RUNNING):
+            candidates[task.id] = task
+        for task_id in self._orphan_candidates:
+            if task_id in self._tasks:
+                candidates[task_id] = self._tasks[task_id]
+        self._orphan_candidates = set()
+
+        # The conditions mirror the ones in update_status and may_prune
+        expired_tasks = itertools.chain(
+            self._pop_expired_tasks('retry', lambda retry: retry < now),
+            self._pop_expired_tasks('scheduler_disable_time', lambda t: now - t > config.disable_persist),
+            self._pop_expired_tasks('remove', lambda remove: now >= remove),
+        )
+        for task in expired_tasks:
+            candidates[task.id] = task
+        return list(six.itervalues(candidates))
+
+    def _push_worker_timer(self, worker):
+        self._worker_timer_keys[worker.id] = worker.last_active
+        heapq.heappush(self._worker_timers, (worker.last_active, worker.id))
+
+    def reschedule_worker(self, worker):
+        # Only needed when the clock went backwards, otherwise the existing entry expires first
+        if worker.last_active < self._worker_timer_keys.get(worker.id, float('inf')):
+            self._push_worker_timer(worker)
+
+    def get_prune_worker_candidates(self, config):
+        """
+        Return the workers that haven't been active for worker_disconnect_delay seconds.
+        """
+        now = time.time()
+        timers = self._worker_timers
+        candidates = []
+        while timers and timers[0][0] + config.worker_disconnect_delay < now:
+            last_active, worker_id = heapq.heappop(timers)
+            worker = self._active_workers.get(worker_id)
+            if worker is None or self._worker_timer_keys.get(worker_id) != last_active:
+                continue
+            if worker.last_active == last_active:
+                candidates.append(worker)
+            else:
+                self._push_worker_timer(worker)
+        return candidates
+
     def set_batcher(self, worker_id, family, batcher_args, max_batch_size):
         self._task_batchers.setdefault(worker_id, {})
         self._task_batchers[worker_id][family] = (batcher_args, max_batch_size)
+        self._add_batch_param_names(family, batcher_args)
+        if self._journal is not None:
+            self._dirty_batchers.add(worker_id)
 
     def get_batcher(self, worker_id, family):
         return self._task_batchers.get(worker_id, {}).get(family, (None, 1))
@@ -493,10 +1637,74 @@ class SimpleTaskState(object):
         """
         return len(self._status_tasks[PENDING]) + len(self._status_tasks[RUNNING])
 
+    def num_active_tasks(self, *statuses):
+        """
+        Return how many tasks have one of the statuses, or any status if none are given. O(1).
+        """
+        if not statuses:
+            return len(self._tasks)
+        return sum(len(self._status_tasks.get(status, ())) for status in statuses)
+
+    def work_version(self):
+        """
+        Return a number that changes whenever a worker may have gotten a task to run.
+
+        That is when a task becomes ready, a running task stops, a worker can
+        run one more task or more resources are available.
+        """
+        return self._work_version
+
+    def work_changed(self):
+        self._work_version += 1
+
+    def state_version(self):
+        """
+        Return the number of times the status, priority or deps of a task changed or a task was added or removed.
+        """
+        return self._state_version
+
+    def task_changed(self, task_id):
+        self._state_version += 1
+        self._task_changes.pop(task_id, None)
+        self._task_changes[task_id] = self._state_version
+        if len(self._task_changes) > self._max_task_changes:
+            _, self._task_changes_since = self._task_changes.popitem(last=False)
+
+    def get_changed_task_ids(self, since):
+        """
+        Return the ids of the tasks changed after state version ``since``, most recently changed first.
+
+        Returns None if the changes made back then were forgotten already, or
+        if ``since`` is a version this state didn't get to yet.
+        """
+        if not self._task_changes_since <= since <= self._state_version:
+            return None
+        task_ids = []
+        for task_id in reversed(self._task_changes):
+            if self._task_changes[task_id] <= since:
+                break
+            task_ids.append(task_id)
+        return task_ids
+
     def get_task(self, task_id, default=None, setdefault=None):
         if setdefault:
             task = self._tasks.setdefault(task_id, setdefault)
             self._status_tasks[task.status][task.id] = task
+            if task is setdefault:
+                self.touch_task(task)
+                self.task_changed(task.id)
+                self._status_seq[task.id] = next(self._status_counter)
+                self._index_deps(task)
+                if task.status == DONE:
+                    self._update_dependents(task.id, -1)
+                self._invalidate_upstream_status(task.id)
+                self._index_search(task)
+                self._enqueue(task)
+                self._index_workers(task)
+                for attr in self._task_timers:
+                    self._push_task_timer(task, attr)
+                self._orphan_candidates.add(task.id)
+                self._update_path_lengths([task.id])
             return task
         else:
             return self._tasks.get(task_id, default)
@@ -505,6 +1713,7 @@ class SimpleTaskState(object):
         return task_id in self._tasks
 
     def re_enable(self, task, config=None):
+        self.touch_task(task)
         task.scheduler_disable_time = None
         task.failures.clear()
         if config:
@@ -513,8 +1722,8 @@ class SimpleTaskState(object):
 
     def set_batch_running(self, task, batch_id, worker_id):
         self.set_status(task, BATCH_RUNNING)
-        task.batch_id = batch_id
-        task.worker_running = worker_id
+        self.set_batch_id(task, batch_id)
+        self.set_worker_running(task, worker_id)
         task.time_running = time.time()
 
     def set_status(self, task, new_status, config=None):
@@ -524,6 +1733,8 @@ class SimpleTaskState(object):
         if new_status == DISABLED and task.status in (RUNNING, BATCH_RUNNING):
             return
 
+        self.touch_task(task)
+
         remove_on_failure = task.batch_id is not None and not task.batchable
 
         if task.status == DISABLED:
@@ -537,13 +1748,13 @@ class SimpleTaskState(object):
         if task.status == RUNNING and task.batch_id is not None and new_status != RUNNING:
             for batch_task in self.get_batch_running_tasks(task.batch_id):
                 self.set_status(batch_task, new_status, config)
-                batch_task.batch_id = None
-            task.batch_id = None
+                self.set_batch_id(batch_task, None)
+            self.set_batch_id(task, None)
 
         if new_status == FAILED and task.status != DISABLED:
             task.add_failure()
             if task.has_excessive_failures():
-                task.scheduler_disable_time = time.time()
+                self._set_task_timer(task, 'scheduler_disable_time', time.time())
                 new_status = DISABLED
                 if not config.batch_emails:
                     notifications.send_error_email(
@@ -559,25 +1770,64 @@ class SimpleTaskState(object):
             task.scheduler_disable_time = None
 
         if new_status != task.status:
-            self._status_tasks[task.status].pop(task.id)
-            self._status_tasks[new_status][task.id] = task
-            task.status = new_status
-            task.updated = time.time()
+            self._move_status(task, new_status)
 
         if new_status == FAILED:
-            task.retry = time.time() + config.retry_delay
+            self._set_task_timer(task, 'retry', time.time() + config.retry_delay)
             if remove_on_failure:
-                task.remove = time.time()
+                self.set_remove(task, time.time())
+
+    def set_foreign_status(self, task, new_status):
+        """
+        Give a dependency owned by another shard of a sharded scheduler the status its shard reports.
+
+        Unlike :py:meth:`set_status`, no failures are counted and no retry is scheduled, as the owning shard does that.
+        """
+        if new_status != task.status:
+            self.touch_task(task)
+            self._move_status(task, new_status)
+
+    def _move_status(self, task, new_status):
+        self._dequeue(task)
+        self._unindex_workers(task)
+        self._status_tasks[task.status].pop(task.id)
+        self._status_tasks[new_status][task.id] = task
+        self._status_seq[task.id] = next(self._status_counter)
+        was_done = task.status == DONE
+        if task.status == RUNNING:
+            self._orphan_candidates.add(task.id)
+        task.status = new_status
+        task.updated = time.time()
+        self.task_changed(task.id)
+        self._enqueue(task)
+        self._index_workers(task)
+        if new_status == DONE:
+            self._update_dependents(task.id, -1)
+        elif was_done:
+            self._update_dependents(task.id, 1)
+        self._invalidate_upstream_status(task.id)
+        if new_status == DONE or was_done:
+            self._update_path_lengths([task.id])
 
     def fail_dead_worker_task(self, task, config, assistants):
+        if task.backup_worker is not None and task.backup_worker not in task.stakeholders | assistants:
+            logger.info("Backup of task %r by disconnected worker %r is given up on", task.id, task.backup_worker)
+            self.set_backup_worker(task, None)
+
         # If a running worker disconnects, tag all its jobs as FAILED and subject it to the same retry logic
         if task.status in (BATCH_RUNNING, RUNNING) and task.worker_running and task.worker_running not in task.stakeholders | assistants:
+            if task.backup_worker is not None:
+                logger.info("Task %r is marked as running by disconnected worker %r -> leaving it "
+                            "to its backup by worker %r", task.id, task.worker_running, task.backup_worker)
+                self.set_worker_running(task, task.backup_worker)
+                self.set_backup_worker(task, None)
+                return
             logger.info("Task %r is marked as running by disconnected worker %r -> marking as "
                         "FAILED with retry delay of %rs", task.id, task.worker_running,
                         config.retry_delay)
-            task.worker_running = None
+            self.set_worker_running(task, None)
             self.set_status(task, FAILED, config)
-            task.retry = time.time() + config.retry_delay
+            self._set_task_timer(task, 'retry', time.time() + config.retry_delay)
 
     def update_status(self, task, config):
         # Mark tasks with no remaining active stakeholders for deletion
@@ -586,7 +1836,7 @@ class SimpleTaskState(object):
             # by the fail_dead_worker_task function.
             logger.debug("Task %r has no stakeholders anymore -> might remove "
                          "task in %s seconds", task.id, config.remove_delay)
-            task.remove = time.time() + config.remove_delay
+            self.set_remove(task, time.time() + config.remove_delay)
 
         # Re-enable task after the disable time expires
         if task.status == DISABLED and task.scheduler_disable_time is not None:
@@ -594,7 +1844,7 @@ class SimpleTaskState(object):
                 self.re_enable(task, config)
 
         # Reset FAILED tasks to PENDING if max timeout is reached, and retry delay is >= 0
-        if task.status == FAILED and config.retry_delay >= 0 and task.retry < time.time():
+        if task.status == FAILED and config.retry_delay >= 0 and task.retry is not None and task.retry < time.time():
             self.set_status(task, PENDING, config)
 
     def may_prune(self, task):
@@ -607,6 +1857,24 @@ class SimpleTaskState(object):
         for task in delete_tasks:
             task_obj = self._tasks.pop(task)
             self._status_tasks[task_obj.status].pop(task)
+            self._dequeue(task_obj)
+            self._status_seq.pop(task, None)
+            self._unindex_deps(task_obj)
+            self._unindex_search(task_obj)
+            if task_obj.status == DONE:
+                self._update_dependents(task, 1)
+            self._invalidate_upstream_status(task)
+            self._unindex_workers(task_obj)
+            for worker_id in task_obj.stakeholders:
+                self._stakeholder_tasks.get(worker_id, set()).discard(task)
+            self._unindex_batch(task_obj)
+            self._orphan_candidates.discard(task)
+            if task in self._path_lengths:
+                self._set_path_length(task, task_obj.family, None)
+                self._update_path_lengths(task_obj.deps)
+            self.task_changed(task)
+            if self._journal is not None:
+                self._removed_tasks.append(task)
 
     def get_active_workers(self, last_active_lt=None, last_get_work_gt=None):
         for worker in six.itervalues(self._active_workers):
@@ -624,25 +1892,232 @@ class SimpleTaskState(object):
     def get_worker_ids(self):
         return self._active_workers.keys()  # only used for unit tests
 
+    def has_worker(self, worker_id):
+        return worker_id in self._active_workers
+
     def get_worker(self, worker_id):
-        return self._active_workers.setdefault(worker_id, Worker(worker_id))
+        worker = self._active_workers.get(worker_id)
+        if worker is None:
+            worker = self._active_workers[worker_id] = Worker(worker_id)
+            self._push_worker_timer(worker)
+            self.touch_worker(worker)
+        return worker
 
     def inactivate_workers(self, delete_workers):
         # Mark workers as inactive
         for worker in delete_workers:
             self._active_workers.pop(worker)
+            self._worker_timer_keys.pop(worker, None)
+            if self._journal is not None:
+                self._removed_workers.append(worker)
         self._remove_workers_from_tasks(delete_workers)
 
     def _remove_workers_from_tasks(self, workers, remove_stakeholders=True):
-        for task in self.get_active_tasks():
+        for worker_id in workers:
+            for status_tasks in six.itervalues(self._worker_tasks.pop(worker_id, {})):
+                for task in six.itervalues(status_tasks):
+                    self.touch_task(task)
+                    task.workers.discard(worker_id)
             if remove_stakeholders:
-                task.stakeholders.difference_update(workers)
-            task.workers -= workers
+                for task_id in self._stakeholder_tasks.pop(worker_id, ()):
+                    task = self._tasks.get(task_id)
+                    if task is not None:
+                        self.touch_task(task)
+                        task.stakeholders.discard(worker_id)
+                        if not task.stakeholders:
+                            self._orphan_candidates.add(task_id)
 
     def disable_workers(self, worker_ids):
         self._remove_workers_from_tasks(worker_ids, remove_stakeholders=False)
         for worker_id in worker_ids:
-            self.get_worker(worker_id).disabled = True
+            worker = self.get_worker(worker_id)
+            worker.disabled = True
+            self.touch_worker(worker)
+
+
+class SqliteTaskState(SimpleTaskState):
+    """
+    Keep the state in a SQLite database and only the tasks that may need attention in memory.
+
+    Tasks that are DONE and idle (see :py:func:`luigi.scheduler_sqlite.is_idle`) are kept in an LRU
+    cache of cache_size tasks. The ones that fall out of it are dropped from memory along with
+    their index entries, and loaded again when they're looked up, their stakeholder disconnects or
+    a query asks for DONE tasks. Any task that isn't in memory but is in the database is therefore
+    DONE.
+    """
+
+    def __init__(self, state_path, cache_size=100000, max_task_changes=100000):
+        super(SqliteTaskState, self).__init__(state_path, max_task_changes)
+        self._cache_size = cache_size
+        self._store = None
+        self._idle_tasks = collections.OrderedDict()  # ids of idle tasks in memory, least recently used first
+
+    def load(self):
+        """
+        Open the database and load the workers and the tasks that aren't idle.
+        """
+        try:
+            self._store = scheduler_sqlite.SqliteStateStore(self._state_path)
+            records = self._store.load()
+        except (sqlite3.DatabaseError, scheduler_journal.StateFormatError):
+            broken_path = self._state_path + '.unreadable'
+            logger.exception("Error when loading state, moving %s to %s. Starting from empty state.",
+                             self._state_path, broken_path)
+            if self._store is not None:
+                self._store.close()
+            os.rename(self._state_path, broken_path)
+            self._store = scheduler_sqlite.SqliteStateStore(self._state_path)
+            records = []
+        for kind, payload in records:
+            self._apply_record(kind, payload)
+        self._rebuild_indexes()
+        self._journal = self._store
+
+    def dump(self):
+        try:
+            if self._store is not None:
+                self.flush_journal()
+                self._store.sync()
+            else:
+                store = scheduler_sqlite.SqliteStateStore(self._state_path)
+                store.replace(self._records())
+                store.close()
+        except sqlite3.Error:
+            logger.warning("Failed saving scheduler state", exc_info=1)
+        else:
+            logger.info("Saved state in %s", self._state_path)
+
+    def snapshot(self):
+        # The database is updated in place, there's nothing to compact
+        self.flush_journal()
+
+    def add_record_listener(self, listener):
+        super(SqliteTaskState, self).add_record_listener(listener)
+        if self._store is not None:
+            listener([('task', record) for record in self._store.get_idle_task_records()
+                      if record['id'] not in self._tasks])
+
+    def flush_journal(self):
+        dirty_tasks = self._dirty_tasks
+        super(SqliteTaskState, self).flush_journal()
+        for task_id in dirty_tasks:
+            self._idle_tasks.pop(task_id, None)
+            task = self._tasks.get(task_id)
+            if task is not None and self._is_idle(task):
+                self._idle_tasks[task_id] = None
+        while len(self._idle_tasks) > self._cache_size:
+            task_id, _ = self._idle_tasks.popitem(last=False)
+            self._evict(self._tasks[task_id])
+
+    @staticmethod
+    def _is_idle(task):
+        # Same as scheduler_sqlite.is_idle, without building the record
+        return (task.status == DONE and bool(task.stakeholders) and task.remove is None and
+                task.batch_id is None and task.worker_running is None)
+
+    def _evict(self, task):
+        del self._tasks[task.id]
+        self._status_tasks[task.status].pop(task.id, None)
+        self._status_seq.pop(task.id, None)
+        self._unindex_deps(task)
+        self._unindex_search(task)
+        self._unindex_workers(task)
+        for worker_id in task.stakeholders:
+            self._stakeholder_tasks.get(worker_id, set()).discard(task.id)
+        self._orphan_candidates.discard(task.id)
+
+    def _from_record(self, record):
+        task = Task.from_record(record)
+        # Workers that went away while the task was on disk couldn't be removed from it
+        for worker_id in list(task.workers):
+            worker = self._active_workers.get(worker_id)
+            if worker is None or not worker.enabled:
+                task.workers.discard(worker_id)
+        return task
+
+    def _load_task(self, task_id):
+        if self._store is None or task_id in self._removed_tasks:
+            return
+        record = self._store.get_task_record(task_id)
+        if record is None:
+            return
+        task = self._from_record(record)
+        self._tasks[task.id] = task
+        self._status_tasks[task.status][task.id] = task
+        self._status_seq[task.id] = next(self._status_counter)
+        self._index_deps(task)
+        self._index_search(task)
+        self._enqueue(task)
+        self._index_workers(task)
+        for worker_id in task.stakeholders:
+            self._stakeholder_tasks.setdefault(worker_id, set()).add(task.id)
+        self._idle_tasks[task.id] = None
+
+    def _is_done(self, task_id):
+        if task_id in self._tasks:
+            return self._tasks[task_id].status == DONE
+        return self._store is not None and task_id not in self._removed_tasks and self._store.has_task(task_id)
+
+    def get_task(self, task_id, default=None, setdefault=None):
+        if task_id in self._idle_tasks:
+            del self._idle_tasks[task_id]
+            self._idle_tasks[task_id] = None
+        elif task_id not in self._tasks:
+            self._load_task(task_id)
+        return super(SqliteTaskState, self).get_task(task_id, default, setdefault)
+
+    def has_task(self, task_id):
+        return task_id in self._tasks or (
+            self._store is not None and task_id not in self._removed_tasks and self._store.has_task(task_id))
+
+    def _get_stored_tasks(self, status=None):
+        # Tasks only read from the database for a query, they don't go into the cache
+        if self._store is None:
+            return
+        for record in self._store.get_idle_task_records(status):
+            if record['id'] not in self._tasks and record['id'] not in self._removed_tasks:
+                yield self._from_record(record)
+
+    def get_active_tasks(self):
+        return itertools.chain(super(SqliteTaskState, self).get_active_tasks(), self._get_stored_tasks())
+
+    def get_active_tasks_by_status(self, *statuses):
+        tasks = super(SqliteTaskState, self).get_active_tasks_by_status(*statuses)
+        if DONE in statuses:
+            tasks = itertools.chain(tasks, self._get_stored_tasks(DONE))
+        return tasks
+
+    def search_tasks(self, terms, status=None):
+        tasks = super(SqliteTaskState, self).search_tasks(terms, status)
+        if not status or status == DONE:
+            tasks.extend(task for task in self._get_stored_tasks(status or None)
+                         if all(term in task.pretty_id for term in terms))
+        return tasks
+
+    def num_active_tasks(self, *statuses):
+        num_tasks = super(SqliteTaskState, self).num_active_tasks(*statuses)
+        if self._store is not None and (not statuses or DONE in statuses):
+            # Idle tasks in the database that are in memory or removed mustn't be counted again.
+            # Besides the cached ones, tasks in memory can only be idle there if they changed since
+            # the last flush.
+            in_memory = set(self._idle_tasks)
+            in_memory.update(self._dirty_tasks)
+            in_memory.update(self._removed_tasks)
+            num_tasks += self._store.count_idle_tasks() - self._store.count_idle_tasks(in_memory)
+        return num_tasks
+
+    def inactivate_tasks(self, delete_tasks):
+        delete_tasks = [task_id for task_id in delete_tasks if self.get_task(task_id) is not None]
+        for task_id in delete_tasks:
+            self._idle_tasks.pop(task_id, None)
+        super(SqliteTaskState, self).inactivate_tasks(delete_tasks)
+
+    def _remove_workers_from_tasks(self, workers, remove_stakeholders=True):
+        if remove_stakeholders and self._store is not None:
+            for worker_id in workers:
+                for task_id in self._store.get_stakeholder_task_ids(worker_id):
+                    self.get_task(task_id)
+        super(SqliteTaskState, self)._remove_workers_from_tasks(workers, remove_stakeholders)
 
 
 class Scheduler(object):
@@ -660,7 +2135,12 @@ class Scheduler(object):
         :param task_history_impl: ignore config and use this object as the task history
         """
         self._config = config or scheduler(**kwargs)
-        self._state = SimpleTaskState(self._config.state_path)
+        if self._config.state_store == 'sqlite':
+            self._state = SqliteTaskState(
+                self._config.state_path, self._config.state_cache_size, self._config.max_graph_changes)
+        else:
+            self._state = SimpleTaskState(self._config.state_path, self._config.max_graph_changes)
+        self._state_epoch = uuid.uuid4().hex[:8]  # so versions from before a restart aren't mistaken for current ones
 
         if task_history_impl:
             self._task_history = task_history_impl
@@ -671,41 +2151,86 @@ class Scheduler(object):
             self._task_history = history.NopHistory()
         self._resources = resources or configuration.get_config().getintdict('resources')  # TODO: Can we make this a Parameter?
         self._make_task = functools.partial(Task, retry_policy=self._config._get_retry_policy())
+        self._retry_policies = {}  # so that tasks with equal retry policies share a RetryPolicy
         self._worker_requests = {}
+        if len(self._config.shard_urls) > 1:
+            self._shard_ring = scheduler_sharding.HashRing(len(self._config.shard_urls))
+        else:
+            self._shard_ring = None
 
         if self._config.batch_emails:
             self._email_batcher = BatchNotifier()
 
+        self._event_listeners = []
+
+        if self._config.critical_path_priority:
+            self._state.enable_critical_path(self._task_history.runtime_estimates())
+        self._slow_runtimes = {}
+        self._slow_runtimes_refresh = 0.0
+        self._refresh_slow_runtimes()
+
     def load(self):
         self._state.load()
 
+    def snapshot(self):
+        self._state.snapshot()
+
     def dump(self):
         self._state.dump()
+        self._task_history.flush()
         if self._config.batch_emails:
             self._email_batcher.send_email()
 
+    def work_version(self):
+        """
+        Return a number that changes whenever :py:meth:`get_work` may have a task for some worker it had none for.
+        """
+        return self._state.work_version()
+
+    def add_event_listener(self, listener):
+        """
+        Call listener with a dict for every event: task status changes, workers joining or leaving and resource changes.
+
+        Every event has a ``type`` and a ``time``. The listener is called while
+        the scheduler handles a request, so it shouldn't take long.
+        """
+        self._event_listeners.append(listener)
+
+    def _publish(self, event_type, **event):
+        if not self._event_listeners:
+            return
+        event.update(type=event_type, time=time.time())
+        for listener in self._event_listeners:
+            try:
+                listener(event)
+            except Exception:
+                logger.warning("Error publishing %s event", event_type, exc_info=True)
+
     @rpc_method()
     def prune(self):
         logger.info("Starting pruning of task graph")
         self._prune_workers()
         self._prune_tasks()
         self._prune_emails()
+        self._refresh_slow_runtimes()
         logger.info("Done pruning task graph")
 
     def _prune_workers(self):
         remove_workers = []
-        for worker in self._state.get_active_workers():
+        for worker in self._state.get_prune_worker_candidates(self._config):
             if worker.prune(self._config):
                 logger.debug("Worker %s timed out (no contact for >=%ss)", worker, self._config.worker_disconnect_delay)
                 remove_workers.append(worker.id)
 
         self._state.inactivate_workers(remove_workers)
+        for worker_id in remove_workers:
+            self._publish('worker_left', worker=worker_id)
 
     def _prune_tasks(self):
         assistant_ids = set(w.id for w in self._state.get_assistants())
         remove_tasks = []
 
-        for task in self._state.get_active_tasks():
+        for task in self._state.get_prune_candidates(self._config):
             self._state.fail_dead_worker_task(task, self._config, assistant_ids)
             self._state.update_status(task, self._config)
             if self._state.may_prune(task):
@@ -714,15 +2239,30 @@ class Scheduler(object):
 
         self._state.inactivate_tasks(remove_tasks)
 
+    def _refresh_slow_runtimes(self):
+        """
+        Reload the 95th percentiles of the runtimes every speculative_refresh_interval seconds.
+        """
+        if self._config.speculative_execution and time.time() >= self._slow_runtimes_refresh:
+            self._slow_runtimes = self._task_history.runtime_estimates(percentile=95)
+            self._slow_runtimes_refresh = time.time() + self._config.speculative_refresh_interval
+
     def _prune_emails(self):
         if self._config.batch_emails:
             self._email_batcher.update()
 
+    def _get_worker(self, worker_id):
+        if not self._state.has_worker(worker_id):
+            self._publish('worker_joined', worker=worker_id)
+        return self._state.get_worker(worker_id)
+
     def _update_worker(self, worker_id, worker_reference=None, get_work=False):
         # Keep track of whenever the worker was last active.
         # For convenience also return the worker object.
-        worker = self._state.get_worker(worker_id)
+        worker = self._get_worker(worker_id)
         worker.update(worker_reference, get_work=get_work)
+        self._state.reschedule_worker(worker)
+        self._state.touch_worker(worker)
         return worker
 
     def _update_priority(self, task, prio, worker):
@@ -732,7 +2272,8 @@ class Scheduler(object):
         Priority can only be increased.
         If the task doesn't exist, a placeholder task is created to preserve priority when the task is later scheduled.
         """
-        task.priority = prio = max(prio, task.priority)
+        prio = max(prio, task.priority)
+        self._state.set_priority(task, prio)
         for dep in task.deps or []:
             t = self._state.get_task(dep)
             if t is not None and prio > t.priority:
@@ -747,7 +2288,7 @@ class Scheduler(object):
                  deps=None, new_deps=None, expl=None, resources=None,
                  priority=0, family='', module=None, params=None,
                  assistant=False, tracking_url=None, worker=None, batchable=None,
-                 batch_id=None, retry_policy_dict={}, owners=None, **kwargs):
+                 batch_id=None, retry_policy_dict={}, owners=None, idempotent=None, **kwargs):
         """
         * add task identified by task_id if it doesn't exist
         * if deps is not None, update dependency list
@@ -773,35 +2314,49 @@ class Scheduler(object):
         if task is None or (task.status != RUNNING and not worker.enabled):
             return
 
+        self._state.touch_task(task)
+
         # for setting priority, we'll sometimes create tasks with unset family and params
-        if not task.family:
-            task.family = family
+        if not task.family or not task.params:
+            self._state.set_family_and_params(task, task.family or family, task.params or _get_default(params, {}))
         if not getattr(task, 'module', None):
-            task.module = module
-        if not task.params:
-            task.params = _get_default(params, {})
+            task.module = _intern(module)
 
         if batch_id is not None:
-            task.batch_id = batch_id
+            self._state.set_batch_id(task, batch_id)
         if status == RUNNING and not task.worker_running:
-            task.worker_running = worker_id
+            self._state.set_worker_running(task, worker_id)
 
         if tracking_url is not None or task.status != RUNNING:
             task.tracking_url = tracking_url
             if task.batch_id is not None:
                 for batch_task in self._state.get_batch_running_tasks(task.batch_id):
+                    self._state.touch_task(batch_task)
                     batch_task.tracking_url = tracking_url
 
         if batchable is not None:
-            task.batchable = batchable
+            self._state.set_batchable(task, batchable)
+
+        if idempotent is not None:
+            task.idempotent = bool(idempotent)
+
+        if task.backup_worker is not None and worker_id in (task.worker_running, task.backup_worker) and \
+                (status not in (PENDING, RUNNING) or new_deps):
+            status = self._end_backup(task, worker_id, status)
+        elif worker_id == task.stopped_worker and task.status == DONE and (status == FAILED or new_deps):
+            # How the copy that lost ended doesn't matter, it may even have failed because of the one that won
+            logger.info("Ignoring status %s of task %r from worker %r, which was told to stop it", status, task.id, worker_id)
+            task.stopped_worker = None
+            status, new_deps = DONE, None
 
         if task.remove is not None:
-            task.remove = None  # unmark task for removal so it isn't removed after being added
+            self._state.set_remove(task, None)  # unmark task for removal so it isn't removed after being added
 
         if expl is not None:
             task.expl = expl
             if task.batch_id is not None:
                 for batch_task in self._state.get_batch_running_tasks(task.batch_id):
+                    self._state.touch_task(batch_task)
                     batch_task.expl = expl
 
         if not (task.status in (RUNNING, BATCH_RUNNING) and status == PENDING) or new_deps:
@@ -811,6 +2366,8 @@ class Scheduler(object):
                 # We also check for status == PENDING b/c that's the default value
                 # (so checking for status != task.status woule lie)
                 self._update_task_history(task, status)
+            if status == DONE and task.status == RUNNING and task.time_running is not None:
+                self._state.record_runtime(task.family, time.time() - task.time_running)
             self._state.set_status(task, PENDING if status == SUSPENDED else status, self._config)
 
         if status == FAILED and self._config.batch_emails:
@@ -835,22 +2392,22 @@ class Scheduler(object):
                     task.pretty_id, task.family, unbatched_params, owners)
 
         if deps is not None:
-            task.deps = set(deps)
+            self._state.set_deps(task, deps)
 
         if new_deps is not None:
-            task.deps.update(new_deps)
+            self._state.add_deps(task, new_deps)
 
         if resources is not None:
-            task.resources = resources
+            self._state.set_resources(task, resources)
 
         if worker.enabled and not assistant:
-            task.stakeholders.add(worker_id)
+            self._state.add_stakeholder(task, worker_id)
 
             # Task dependencies might not exist yet. Let's create dummy tasks for them for now.
             # Otherwise the task dependencies might end up being pruned if scheduling takes a long time
             for dep in task.deps or []:
                 t = self._state.get_task(dep, setdefault=self._make_task(task_id=dep, status=UNKNOWN, deps=None, priority=priority))
-                t.stakeholders.add(worker_id)
+                self._state.add_stakeholder(t, worker_id)
 
         self._update_priority(task, priority, worker_id)
 
@@ -859,10 +2416,21 @@ class Scheduler(object):
         task.retry_policy = retry_policy
 
         if runnable and status != FAILED and worker.enabled:
-            task.workers.add(worker_id)
-            self._state.get_worker(worker_id).tasks.add(task)
+            self._state.add_worker_to_task(task, worker_id)
             task.runnable = runnable
 
+    @rpc_method()
+    def add_tasks(self, worker, tasks, **kwargs):
+        """
+        Call :py:meth:`add_task` for every item of ``tasks``, in order.
+
+        Each item holds the keyword arguments of one call except ``worker``, so
+        a worker can report the tasks it schedules in a few requests instead
+        of one per task.
+        """
+        for task_kwargs in tasks:
+            self.add_task(worker=worker, **task_kwargs)
+
     @rpc_method()
     def announce_scheduling_failure(self, task_name, family, params, expl, owners, **kwargs):
         if not self._config.batch_emails:
@@ -881,7 +2449,9 @@ class Scheduler(object):
 
     @rpc_method()
     def add_worker(self, worker, info, **kwargs):
-        self._state.get_worker(worker).add_info(info)
+        worker = self._get_worker(worker)
+        worker.add_info(info)
+        self._state.touch_worker(worker)
 
     @rpc_method()
     def disable_worker(self, worker):
@@ -889,18 +2459,23 @@ class Scheduler(object):
 
     @rpc_method()
     def set_worker_processes(self, worker, n):
-        self._state.get_worker(worker).add_rpc_message('set_worker_processes', n=n)
+        worker = self._state.get_worker(worker)
+        worker.add_rpc_message('set_worker_processes', n=n)
+        self._state.touch_worker(worker)
 
     @rpc_method()
     def update_resources(self, **resources):
         if self._resources is None:
             self._resources = {}
         self._resources.update(resources)
+        self._state.work_changed()
+        self._publish('resources', resources=resources)
 
     def _generate_retry_policy(self, task_retry_policy_dict):
         retry_policy_dict = self._config._get_retry_policy()._asdict()
         retry_policy_dict.update({k: v for k, v in six.iteritems(task_retry_policy_dict) if v is not None})
-        return RetryPolicy(**retry_policy_dict)
+        retry_policy = RetryPolicy(**retry_policy_dict)
+        return self._retry_policies.setdefault(retry_policy, retry_policy)
 
     def _has_resources(self, needed_resources, used_resources):
         if needed_resources is None:
@@ -915,10 +2490,7 @@ class Scheduler(object):
     def _used_resources(self):
         used_resources = collections.defaultdict(int)
         if self._resources is not None:
-            for task in self._state.get_active_tasks_by_status(RUNNING):
-                if task.resources:
-                    for resource, amount in six.iteritems(task.resources):
-                        used_resources[resource] += amount
+            used_resources.update(self._state.get_used_resources())
         return used_resources
 
     def _rank(self, task):
@@ -928,26 +2500,21 @@ class Scheduler(object):
         :return:
         """
 
-        return task.priority, -task.time
+        return task.priority, self._state.path_length(task), -task.time
 
     def _schedulable(self, task):
-        if task.status != PENDING:
-            return False
-        for dep in task.deps:
-            dep_task = self._state.get_task(dep, default=None)
-            if dep_task is None or dep_task.status != DONE:
-                return False
-        return True
+        return task.status == PENDING and not self._state.has_unmet_deps(task)
 
     def _reset_orphaned_batch_running_tasks(self, worker_id):
+        worker_running_tasks = self._state.get_running_tasks(worker_id)
         running_batch_ids = {
             task.batch_id
-            for task in self._state.get_active_tasks_by_status(RUNNING)
-            if task.worker_running == worker_id
+            for task in worker_running_tasks
+            if task.status == RUNNING
         }
         orphaned_tasks = [
-            task for task in self._state.get_active_tasks_by_status(BATCH_RUNNING)
-            if task.worker_running == worker_id and task.batch_id not in running_batch_ids
+            task for task in worker_running_tasks
+            if task.status == BATCH_RUNNING and task.batch_id not in running_batch_ids
         ]
         for task in orphaned_tasks:
             self._state.set_status(task, PENDING)
@@ -959,9 +2526,8 @@ class Scheduler(object):
         num_pending, num_unique_pending, num_pending_last_scheduled = 0, 0, 0
         running_tasks = []
 
-        upstream_status_table = {}
         for task in worker.get_tasks(self._state, RUNNING):
-            if self._upstream_status(task.id, upstream_status_table) == UPSTREAM_DISABLED:
+            if self._state.get_upstream_status(task) == UPSTREAM_DISABLED:
                 continue
             # Return a list of currently running tasks to the client,
             # makes it easier to troubleshoot
@@ -972,7 +2538,7 @@ class Scheduler(object):
                 running_tasks.append(more_info)
 
         for task in worker.get_tasks(self._state, PENDING, FAILED):
-            if self._upstream_status(task.id, upstream_status_table) == UPSTREAM_DISABLED:
+            if self._state.get_upstream_status(task) == UPSTREAM_DISABLED:
                 continue
             num_pending += 1
             num_unique_pending += int(len(task.workers) == 1)
@@ -987,7 +2553,7 @@ class Scheduler(object):
         }
 
     @rpc_method(allow_null=False)
-    def get_work(self, host=None, assistant=False, current_tasks=None, worker=None, **kwargs):
+    def get_work(self, host=None, assistant=False, current_tasks=None, worker=None, slots=1, **kwargs):
         # TODO: remove any expired nodes
 
         # Algo: iterate over all nodes, find the highest priority node no dependencies and available
@@ -998,6 +2564,9 @@ class Scheduler(object):
         # checks in order to prevent a worker with many low-priority tasks from starving other
         # workers with higher priority tasks that share the same resources.
 
+        # A worker with several free slots asks for up to that many tasks at once. Every task picked
+        # counts as running from then on, so the walk goes on as if the worker had asked again.
+
         # TODO: remove tasks that can't be done, figure out if the worker has absolutely
         # nothing it can wait for
 
@@ -1022,13 +2591,14 @@ class Scheduler(object):
         if assistant:
             self.add_worker(worker_id, [('assistant', assistant)])
 
-        batched_params, unbatched_params, batched_tasks, max_batch_size = None, None, [], 1
-        best_task = None
+        slots = max(1, slots)
+        picks = []  # (task, tasks of its batch, batched params) for every task handed out
+        taken = set()  # ids of the tasks handed out, batches included
         if current_tasks is not None:
             ct_set = set(current_tasks)
-            for task in sorted(self._state.get_active_tasks_by_status(RUNNING), key=self._rank):
-                if task.worker_running == worker_id and task.id not in ct_set:
-                    best_task = task
+            for task in reversed(sorted(self._state.get_running_tasks(worker_id), key=self._rank)):
+                if task.status == RUNNING and task.id not in ct_set and len(picks) < slots:
+                    picks.append((task, [], None))
 
         if current_tasks is not None:
             # batch running tasks that weren't claimed since the last get_work go back in the pool
@@ -1037,29 +2607,30 @@ class Scheduler(object):
         greedy_resources = collections.defaultdict(int)
 
         worker = self._state.get_worker(worker_id)
-        if worker.is_trivial_worker(self._state):
-            relevant_tasks = worker.get_tasks(self._state, PENDING, RUNNING)
+        trivial_worker = worker.is_trivial_worker(self._state)
+        if trivial_worker:
+            # Tasks of the same rank stay in ready queue order, which batches rely on
+            tasks = sorted(worker.get_tasks(self._state, PENDING, RUNNING), key=self._state.rank_key)
+            tasks.sort(key=self._rank, reverse=True)
             used_resources = collections.defaultdict(int)
             greedy_workers = dict()  # If there's no resources, then they can grab any task
         else:
-            relevant_tasks = self._state.get_active_tasks_by_status(PENDING, RUNNING)
+            # The ready queue is kept in rank order, so we can walk it without sorting. Greedy
+            # resource usage only grows during the walk, so once a bucket of tasks needs more than
+            # what's left, none of its tasks can be picked or use up a greedy worker.
+            def saturated(resources):
+                return len(picks) < slots and not self._has_resources(resources, greedy_resources)
+            tasks = self._state.get_ranked_tasks(skip_resources=saturated)
             used_resources = self._used_resources()
             activity_limit = time.time() - self._config.worker_disconnect_delay
             active_workers = self._state.get_active_workers(last_get_work_gt=activity_limit)
             greedy_workers = dict((worker.id, worker.info.get('workers', 1))
                                   for worker in active_workers)
-        tasks = list(relevant_tasks)
-        tasks.sort(key=self._rank, reverse=True)
 
         for task in tasks:
-            if (best_task and batched_params and task.family == best_task.family and
-                    len(batched_tasks) < max_batch_size and task.is_batchable() and all(
-                    task.params.get(name) == value for name, value in unbatched_params.items()) and
-                    self._schedulable(task)):
-                for name, params in batched_params.items():
-                    params.append(task.params.get(name))
-                batched_tasks.append(task)
-            if best_task:
+            if len(picks) >= slots:
+                break
+            if task.id in taken:
                 continue
 
             if task.status == RUNNING and (task.worker_running in greedy_workers):
@@ -1070,21 +2641,17 @@ class Scheduler(object):
             if self._schedulable(task) and self._has_resources(task.resources, greedy_resources):
                 in_workers = (assistant and task.runnable) or worker_id in task.workers
                 if in_workers and self._has_resources(task.resources, used_resources):
-                    best_task = task
-                    batch_param_names, max_batch_size = self._state.get_batcher(
-                        worker_id, task.family)
-                    if batch_param_names and task.is_batchable():
-                        try:
-                            batched_params = {
-                                name: [task.params[name]] for name in batch_param_names
-                            }
-                            unbatched_params = {
-                                name: value for name, value in task.params.items()
-                                if name not in batched_params
-                            }
-                            batched_tasks.append(task)
-                        except KeyError:
-                            batched_params, unbatched_params = None, None
+                    batched_tasks = self._get_batch(task, worker_id, trivial_worker, taken)
+                    picks.append(batched_tasks)
+                    taken.update(batch_task.id for batch_task in batched_tasks[1])
+                    taken.add(task.id)
+
+                    # the task now runs on the worker, for the rest of the walk
+                    if greedy_workers.get(worker_id, 0) > 0:
+                        greedy_workers[worker_id] -= 1
+                    for resource, amount in six.iteritems((task.resources or {})):
+                        used_resources[resource] += amount
+                        greedy_resources[resource] += amount
                 else:
                     workers = itertools.chain(task.workers, [worker_id]) if assistant else task.workers
                     for task_worker in workers:
@@ -1100,37 +2667,127 @@ class Scheduler(object):
 
         reply = self.count_pending(worker_id)
 
+        work = [self._start_work(worker_id, host, *pick) for pick in picks]
+        if self._config.speculative_execution and len(work) < slots:
+            backup = self._get_backup(worker_id)
+            if backup is not None:
+                logger.info("Task %r runs for long on worker %r, giving worker %r a second copy of it",
+                            backup.id, backup.worker_running, worker_id)
+                self._state.set_backup_worker(backup, worker_id)
+                work.append({
+                    'task_id': backup.id,
+                    'task_family': backup.family,
+                    'task_module': getattr(backup, 'module', None),
+                    'task_params': backup.params,
+                })
+        if work:
+            reply.update(work[0])
+        else:
+            reply['task_id'] = None
+        if slots > 1:
+            reply['tasks'] = work
+
+        return reply
+
+    def _end_backup(self, task, worker_id, status):
+        """
+        Settle a task run by two workers when one of them reports how it went, and return the status to give it.
+
+        The first copy to complete wins and the other worker is told to stop. When a copy ends any other way,
+        the task stays RUNNING with the copy that still runs.
+        """
+        other_worker_id = task.backup_worker if worker_id == task.worker_running else task.worker_running
+        self._state.set_backup_worker(task, None)
+        if status == DONE:
+            logger.info("Task %r was completed by worker %r first, telling worker %r to stop", task.id, worker_id, other_worker_id)
+            task.stopped_worker = other_worker_id
+            if self._state.has_worker(other_worker_id):
+                self._state.get_worker(other_worker_id).add_rpc_message('stop_task', task_id=task.id)
+            return status
+        logger.info("Copy of task %r by worker %r ended with status %s, leaving it to worker %r",
+                    task.id, worker_id, status, other_worker_id)
+        self._state.set_worker_running(task, other_worker_id)
+        return RUNNING
+
+    def _get_backup(self, worker_id):
+        """
+        Return the straggling task the worker should run a second copy of, or None.
+
+        That is the idempotent task it could run that runs for longest compared to the 95th percentile of the
+        runtimes of its family, if that's more than speculative_runtime_factor times it.
+        """
+        now = time.time()
+        best, best_ratio = None, self._config.speculative_runtime_factor
+        for task in self._state.get_worker_tasks(worker_id, RUNNING):
+            slow_runtime = self._slow_runtimes.get(task.family)
+            if (not task.idempotent or slow_runtime is None or task.resources or
+                    task.batch_id is not None or task.backup_worker is not None or
+                    task.worker_running in (None, worker_id) or task.time_running is None):
+                continue
+            runtime = now - task.time_running
+            if runtime >= self._config.speculative_min_runtime and runtime > best_ratio * slow_runtime:
+                best, best_ratio = task, runtime / slow_runtime
+        return best
+
+    def _get_batch(self, task, worker_id, trivial_worker, taken):
+        """
+        Return the task with the tasks that run in one batch with it and their batched params.
+
+        Only tasks ranked after the task go in its batch, as if the walk of get_work had gone on.
+        """
+        batch_param_names, max_batch_size = self._state.get_batcher(worker_id, task.family)
+        if not batch_param_names or not task.is_batchable():
+            return task, [], None
+        try:
+            batched_params = {name: [task.params[name]] for name in batch_param_names}
+        except KeyError:
+            return task, [], None
+
+        batched_tasks = [task]
+        for candidate in self._state.get_batch_candidates(task, batch_param_names):
+            if len(batched_tasks) >= max_batch_size:
+                break
+            if candidate.id in taken or (trivial_worker and worker_id not in candidate.workers):
+                continue
+            for name, params in batched_params.items():
+                params.append(candidate.params.get(name))
+            batched_tasks.append(candidate)
+        return task, batched_tasks, batched_params
+
+    def _start_work(self, worker_id, host, task, batched_tasks, batched_params):
+        """
+        Mark a task, or the batch of tasks, as run by the worker and return what it needs to run it.
+        """
         if len(batched_tasks) > 1:
-            batch_string = '|'.join(task.id for task in batched_tasks)
+            batch_string = '|'.join(batch_task.id for batch_task in batched_tasks)
             batch_id = hashlib.md5(batch_string.encode('utf-8')).hexdigest()
-            for task in batched_tasks:
-                self._state.set_batch_running(task, batch_id, worker_id)
+            for batch_task in batched_tasks:
+                self._state.set_batch_running(batch_task, batch_id, worker_id)
 
-            combined_params = best_task.params.copy()
+            combined_params = task.params.copy()
             combined_params.update(batched_params)
 
-            reply['task_id'] = None
-            reply['task_family'] = best_task.family
-            reply['task_module'] = getattr(best_task, 'module', None)
-            reply['task_params'] = combined_params
-            reply['batch_id'] = batch_id
-            reply['batch_task_ids'] = [task.id for task in batched_tasks]
-
-        elif best_task:
-            self._state.set_status(best_task, RUNNING, self._config)
-            best_task.worker_running = worker_id
-            best_task.time_running = time.time()
-            self._update_task_history(best_task, RUNNING, host=host)
-
-            reply['task_id'] = best_task.id
-            reply['task_family'] = best_task.family
-            reply['task_module'] = getattr(best_task, 'module', None)
-            reply['task_params'] = best_task.params
+            return {
+                'task_id': None,
+                'task_family': task.family,
+                'task_module': getattr(task, 'module', None),
+                'task_params': combined_params,
+                'batch_id': batch_id,
+                'batch_task_ids': [batch_task.id for batch_task in batched_tasks],
+            }
 
-        else:
-            reply['task_id'] = None
+        self._state.set_status(task, RUNNING, self._config)
+        self._state.set_worker_running(task, worker_id)
+        task.time_running = time.time()
+        task.stopped_worker = None
+        self._update_task_history(task, RUNNING, host=host)
 
-        return reply
+        return {
+            'task_id': task.id,
+            'task_family': task.family,
+            'task_module': getattr(task, 'module', None),
+            'task_params': task.params,
+        }
 
     @rpc_method(attempts=1)
     def ping(self, **kwargs):
@@ -1138,36 +2795,12 @@ class Scheduler(object):
         worker = self._update_worker(worker_id)
         return {"rpc_messages": worker.fetch_rpc_messages()}
 
-    def _upstream_status(self, task_id, upstream_status_table):
-        if task_id in upstream_status_table:
-            return upstream_status_table[task_id]
-        elif self._state.has_task(task_id):
-            task_stack = [task_id]
-
-            while task_stack:
-                dep_id = task_stack.pop()
-                dep = self._state.get_task(dep_id)
-                if dep:
-                    if dep.status == DONE:
-                        continue
-                    if dep_id not in upstream_status_table:
-                        if dep.status == PENDING and dep.deps:
-                            task_stack += [dep_id] + list(dep.deps)
-                            upstream_status_table[dep_id] = ''  # will be updated postorder
-                        else:
-                            dep_status = STATUS_TO_UPSTREAM_MAP.get(dep.status, '')
-                            upstream_status_table[dep_id] = dep_status
-                    elif upstream_status_table[dep_id] == '' and dep.deps:
-                        # This is the postorder update step when we set the
-                        # status based on the previously calculated child elements
-                        status = max((upstream_status_table.get(a_task_id, '')
-                                      for a_task_id in dep.deps),
-                                     key=UPSTREAM_SEVERITY_KEY)
-                        upstream_status_table[dep_id] = status
-            return upstream_status_table[dep_id]
-
-    def _serialize_task(self, task_id, include_deps=True, deps=None):
+    def _upstream_status(self, task_id):
         task = self._state.get_task(task_id)
+        if task is not None:
+            return self._state.get_upstream_status(task)
+
+    def _serialize_task(self, task, include_deps=True, deps=None):
         ret = {
             'display_name': task.pretty_id,
             'status': task.status,
@@ -1198,6 +2831,37 @@ class Scheduler(object):
             serialized.update(self._traverse_graph(task.id, seen))
         return serialized
 
+    @rpc_method()
+    def graph_changes(self, since=None, **kwargs):
+        """
+        Return the tasks whose status, priority or deps changed since an earlier call.
+
+        Returns ``{'version': ..., 'reset': False, 'tasks': ..., 'removed': ...}``
+        where ``tasks`` has the changed tasks serialized like :py:meth:`graph`
+        does and ``removed`` the ids of the tasks removed since. Pass the version
+        back as ``since`` to get the next changes.
+
+        Without ``since``, or when the changes made since then are no longer
+        known, only returns ``{'version': ..., 'reset': True}``: the client has
+        to get the tasks it shows again, eg. with :py:meth:`dep_graph`.
+        """
+        self.prune()
+        task_ids = None
+        prefix = self._state_epoch + ':'
+        if since is not None and since.startswith(prefix):
+            task_ids = self._state.get_changed_task_ids(int(since[len(prefix):]))
+        version = prefix + str(self._state.state_version())
+        if task_ids is None:
+            return {'version': version, 'reset': True}
+        tasks, removed = {}, []
+        for task_id in task_ids:
+            task = self._state.get_task(task_id)
+            if task is None:
+                removed.append(task_id)
+            else:
+                tasks[task_id] = self._serialize_task(task)
+        return {'version': version, 'reset': False, 'tasks': tasks, 'removed': removed}
+
     def _filter_done(self, task_ids):
         for task_id in task_ids:
             task = self._state.get_task(task_id)
@@ -1252,7 +2916,7 @@ class Scheduler(object):
                 deps = dep_func(task)
                 if not include_done:
                     deps = list(self._filter_done(deps))
-                serialized[task_id] = self._serialize_task(task_id, deps=deps)
+                serialized[task_id] = self._serialize_task(task, deps=deps)
                 for dep in sorted(deps):
                     if dep not in seen:
                         seen.add(dep)
@@ -1277,38 +2941,53 @@ class Scheduler(object):
         self.prune()
         if not self._state.has_task(task_id):
             return {}
-        inverse_graph = collections.defaultdict(set)
-        for task in self._state.get_active_tasks():
-            for dep in task.deps:
-                inverse_graph[dep].add(task.id)
         return self._traverse_graph(
-            task_id, dep_func=lambda t: inverse_graph[t.id], include_done=include_done)
+            task_id, dep_func=lambda t: self._state.get_dependents(t.id), include_done=include_done)
 
     @rpc_method()
     def task_list(self, status='', upstream_status='', limit=True, search=None, max_shown_tasks=None,
-                  **kwargs):
+                  count_only=False, page_size=None, cursor=None, **kwargs):
         """
         Query for a subset of tasks by status.
+
+        Returns the serialized tasks by id, or only ``{'num_tasks': n}`` when ``count_only`` is set
+        or when ``limit`` is set and more than ``max_shown_tasks`` tasks match.
+
+        With ``page_size``, returns ``{'tasks': ..., 'cursor': ...}`` with at most page_size tasks,
+        ordered by (status, updated, id). Passing the cursor back gets the next ones, until it's None.
         """
         self.prune()
-        result = {}
-        upstream_status_table = {}  # used to memoize upstream status
-        if search is None:
-            def filter_func(_):
-                return True
+        max_shown_tasks = max_shown_tasks or self._config.max_shown_tasks
+        filtered = search or (upstream_status and status in ('', PENDING))
+        if not filtered and (count_only or (limit and page_size is None)):
+            num_tasks = self._state.num_active_tasks(*([status] if status else []))
+            if count_only or num_tasks > max_shown_tasks:
+                return {'num_tasks': num_tasks}
+
+        if search is not None:
+            tasks = iter(self._state.search_tasks(search.split(), status))
+        elif status:
+            tasks = self._state.get_active_tasks_by_status(status)
         else:
-            terms = search.split()
-
-            def filter_func(t):
-                return all(term in t.pretty_id for term in terms)
-
-        tasks = self._state.get_active_tasks_by_status(status) if status else self._state.get_active_tasks()
-        for task in filter(filter_func, tasks):
-            if task.status != PENDING or not upstream_status or upstream_status == self._upstream_status(task.id, upstream_status_table):
-                serialized = self._serialize_task(task.id, include_deps=False)
-                result[task.id] = serialized
-        if limit and len(result) > (max_shown_tasks or self._config.max_shown_tasks):
-            return {'num_tasks': len(result)}
+            tasks = self._state.get_active_tasks()
+        if upstream_status:
+            tasks = (task for task in tasks
+                     if task.status != PENDING or upstream_status == self._state.get_upstream_status(task))
+
+        if count_only:
+            return {'num_tasks': sum(1 for _ in tasks)}
+        if page_size is not None:
+            page, cursor = _page(tasks, _task_list_key, page_size, cursor)
+            return {
+                'tasks': {task.id: self._serialize_task(task, include_deps=False) for task in page},
+                'cursor': cursor,
+            }
+        result = {}
+        for task in tasks:
+            if limit and len(result) == max_shown_tasks:
+                # Only count the rest
+                return {'num_tasks': len(result) + 1 + sum(1 for _ in tasks)}
+            result[task.id] = self._serialize_task(task, include_deps=False)
         return result
 
     def _first_task_display_name(self, worker):
@@ -1318,41 +2997,48 @@ class Scheduler(object):
         else:
             return task_id
 
+    def _serialize_worker(self, worker, include_running):
+        ret = dict(
+            name=worker.id,
+            last_active=worker.last_active,
+            started=worker.started,
+            state=worker.state,
+            first_task_display_name=self._first_task_display_name(worker),
+            num_unread_rpc_messages=len(worker.rpc_messages),
+            **worker.info
+        )
+        if include_running:
+            tasks = {
+                task.id: self._serialize_task(task, include_deps=False)
+                for task in self._state.get_running_tasks(worker.id)
+                if task.status == RUNNING
+            }
+            ret['num_running'] = len(tasks)
+            ret['num_pending'] = ret['num_uniques'] = 0
+            for task in self._state.get_worker_tasks(worker.id, PENDING):
+                ret['num_pending'] += 1
+                ret['num_uniques'] += int(len(task.workers) == 1)
+            ret['running'] = tasks
+        return ret
+
     @rpc_method()
-    def worker_list(self, include_running=True, **kwargs):
+    def worker_list(self, include_running=True, page_size=None, cursor=None, **kwargs):
+        """
+        List the active workers, most recently started first.
+
+        With ``page_size``, returns ``{'workers': ..., 'cursor': ...}`` with at most page_size
+        workers. Passing the cursor back gets the next ones, until it's None.
+        """
         self.prune()
-        workers = [
-            dict(
-                name=worker.id,
-                last_active=worker.last_active,
-                started=worker.started,
-                state=worker.state,
-                first_task_display_name=self._first_task_display_name(worker),
-                num_unread_rpc_messages=len(worker.rpc_messages),
-                **worker.info
-            ) for worker in self._state.get_active_workers()]
-        workers.sort(key=lambda worker: worker['started'], reverse=True)
-        if include_running:
-            running = collections.defaultdict(dict)
-            for task in self._state.get_active_tasks_by_status(RUNNING):
-                if task.worker_running:
-                    running[task.worker_running][task.id] = self._serialize_task(task.id, include_deps=False)
-
-            num_pending = collections.defaultdict(int)
-            num_uniques = collections.defaultdict(int)
-            for task in self._state.get_active_tasks_by_status(PENDING):
-                for worker in task.workers:
-                    num_pending[worker] += 1
-                if len(task.workers) == 1:
-                    num_uniques[list(task.workers)[0]] += 1
-
-            for worker in workers:
-                tasks = running[worker['name']]
-                worker['num_running'] = len(tasks)
-                worker['num_pending'] = num_pending[worker['name']]
-                worker['num_uniques'] = num_uniques[worker['name']]
-                worker['running'] = tasks
-        return workers
+        workers = self._state.get_active_workers()
+        if page_size is None:
+            return [self._serialize_worker(worker, include_running)
+                    for worker in sorted(workers, key=_worker_list_key)]
+        page, cursor = _page(workers, _worker_list_key, page_size, cursor)
+        return {
+            'workers': [self._serialize_worker(worker, include_running) for worker in page],
+            'cursor': cursor,
+        }
 
     @rpc_method()
     def resource_list(self):
@@ -1371,7 +3057,7 @@ class Scheduler(object):
             for task in self._state.get_active_tasks_by_status(RUNNING):
                 if task.status == RUNNING and task.resources:
                     for resource, amount in six.iteritems(task.resources):
-                        consumers[resource][task.id] = self._serialize_task(task.id, include_deps=False)
+                        consumers[resource][task.id] = self._serialize_task(task, include_deps=False)
             for resource in resources:
                 tasks = consumers[resource['name']]
                 resource['num_consumer'] = len(tasks)
@@ -1402,17 +3088,57 @@ class Scheduler(object):
         result = collections.defaultdict(dict)
         for task in self._state.get_active_tasks():
             if task.id.find(task_str) != -1:
-                serialized = self._serialize_task(task.id, include_deps=False)
+                serialized = self._serialize_task(task, include_deps=False)
                 result[task.status][task.id] = serialized
         return result
 
+    def _is_foreign(self, task_id):
+        return self._shard_ring is not None and self._shard_ring.get_shard(task_id) != self._config.shard
+
+    def foreign_dependencies(self):
+        """
+        Return the ids of the dependencies owned by other shards that aren't known to be DONE, by shard.
+        """
+        foreign = collections.defaultdict(list)
+        if self._shard_ring is not None:
+            for task in self._state.get_active_tasks_by_status(UNKNOWN, FAILED, DISABLED):
+                shard = self._shard_ring.get_shard(task.id)
+                if shard != self._config.shard and self._state.get_dependents(task.id):
+                    foreign[shard].append(task.id)
+        return foreign
+
+    def update_foreign_statuses(self, statuses):
+        """
+        Give dependencies owned by other shards the status their shard reports, when it's DONE, FAILED or DISABLED.
+
+        Those that are pending or running on their shard go back to UNKNOWN.
+
+        :param statuses: a dict of task id -> status, as returned by get_task_statuses
+        """
+        for task_id, status in six.iteritems(statuses):
+            if not self._is_foreign(task_id):
+                continue
+            task = self._state.get_task(task_id)
+            if task is not None and task.status in (UNKNOWN, FAILED, DISABLED):
+                self._state.set_foreign_status(task, status if status in (DONE, FAILED, DISABLED) else UNKNOWN)
+        self._state.flush_journal()
+
+    @rpc_method()
+    def get_task_statuses(self, task_ids):
+        statuses = {}
+        for task_id in task_ids:
+            task = self._state.get_task(task_id)
+            if task is not None:
+                statuses[task_id] = task.status
+        return statuses
+
     @rpc_method()
     def re_enable_task(self, task_id):
         serialized = {}
         task = self._state.get_task(task_id)
         if task and task.status == DISABLED and task.scheduler_disable_time:
             self._state.re_enable(task, self._config)
-            serialized = self._serialize_task(task_id)
+            serialized = self._serialize_task(task)
         return serialized
 
     @rpc_method()
@@ -1427,9 +3153,11 @@ class Scheduler(object):
     def set_task_status_message(self, task_id, status_message):
         if self._state.has_task(task_id):
             task = self._state.get_task(task_id)
+            self._state.touch_task(task)
             task.status_message = status_message
             if task.status == RUNNING and task.batch_id is not None:
                 for batch_task in self._state.get_batch_running_tasks(task.batch_id):
+                    self._state.touch_task(batch_task)
                     batch_task.status_message = status_message
 
     @rpc_method()
@@ -1441,6 +3169,7 @@ class Scheduler(object):
             return {"taskId": task_id, "statusMessage": ""}
 
     def _update_task_history(self, task, status, host=None):
+        self._publish('task_status', task_id=task.id, family=task.family, status=status, host=host)
         try:
             if status == DONE or status == FAILED:
                 successful = (status == DONE)
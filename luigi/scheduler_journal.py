@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2017 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+On-disk persistence of the scheduler state as a snapshot plus a write-ahead journal.
+
+All files are made of JSON documents, one per line. The first line of every
+file is a header of the form::
+
+    {"format": "luigi-scheduler-snapshot", "version": 1, "sequence": 42}
+    {"format": "luigi-scheduler-journal", "version": 1}
+
+Files with an unknown format or a version newer than :py:data:`FORMAT_VERSION`
+are refused rather than misread.
+
+The snapshot lives at ``state_path``. Its header holds the sequence number of the
+last journal record it includes and every following line is a ``[kind, payload]``
+pair describing one task, one worker or the batchers of one worker.
+
+Journal segments live next to it as ``<state_path>.journal.<n>``, where ``n`` is
+the sequence number of the segment's first record. Each line after the header
+is a ``[sequence, kind, payload]`` triple. Besides the kinds found in snapshots,
+journals hold ``remove_tasks`` and ``remove_workers`` records listing ids that
+were dropped. A task or worker record always holds the whole task or worker, so
+replaying only needs to keep the last one.
+
+Loading reads the snapshot and replays the journal records with a higher
+sequence number, in order. A partially written last line, as left behind by a
+crash, is ignored. A new snapshot is written to a temporary file in a background
+thread and atomically moved into place, after which the journal segments it
+covers are deleted.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+SNAPSHOT_FORMAT = 'luigi-scheduler-snapshot'
+JOURNAL_FORMAT = 'luigi-scheduler-journal'
+
+_SEGMENT_RE = re.compile(r'\.journal\.(\d+)$')
+
+
+class StateFormatError(Exception):
+    """
+    Raised when a state file can't be read with this version of Luigi.
+    """
+    pass
+
+
+def _replace(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def _dump_line(value):
+    return json.dumps(value, separators=(',', ':')) + '\n'
+
+
+def _read_header(fobj, expected_format):
+    line = fobj.readline()
+    try:
+        header = json.loads(line)
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or header.get('format') != expected_format:
+        raise StateFormatError('%s is not a %s file' % (fobj.name, expected_format))
+    version = header.get('version')
+    if not isinstance(version, int) or version > FORMAT_VERSION:
+        raise StateFormatError('%s has version %r, only versions up to %d can be read' % (
+            fobj.name, version, FORMAT_VERSION))
+    return header
+
+
+def is_snapshot(path):
+    """
+    Return whether the file at path starts with a snapshot header.
+
+    Older versions of Luigi stored a pickle at the same path instead.
+    """
+    try:
+        with open(path, 'rb') as fobj:
+            line = fobj.readline(1024)
+    except IOError:
+        return False
+    try:
+        header = json.loads(line.decode('utf-8'))
+    except ValueError:
+        return False
+    return isinstance(header, dict) and header.get('format') == SNAPSHOT_FORMAT
+
+
+def read_snapshot(path):
+    """
+    Return the sequence number of a snapshot and the list of its ``(kind, payload)`` records.
+    """
+    with open(path, 'r') as fobj:
+        header = _read_header(fobj, SNAPSHOT_FORMAT)
+        records = [tuple(json.loads(line)) for line in fobj if line.strip()]
+    return header['sequence'], records
+
+
+def write_snapshot(path, sequence, records):
+    """
+    Atomically replace the snapshot at path with the given ``(kind, payload)`` records.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fobj:
+        fobj.write(_dump_line({'format': SNAPSHOT_FORMAT, 'version': FORMAT_VERSION, 'sequence': sequence}))
+        for record in records:
+            fobj.write(_dump_line(record))
+        fobj.flush()
+        os.fsync(fobj.fileno())
+    _replace(tmp_path, path)
+
+
+class StateJournal(object):
+    """
+    Append-only journal of scheduler state changes, split into segments.
+
+    A new segment is started whenever a snapshot is taken so that the segments
+    fully covered by a snapshot can be deleted once it's written.
+    """
+
+    def __init__(self, state_path):
+        self._state_path = state_path
+        self._sequence = 0  # sequence number of the last record written or replayed
+        self._fobj = None
+        self._snapshot_thread = None
+
+    @property
+    def sequence(self):
+        return self._sequence
+
+    def _segments(self):
+        """
+        Return the ``(first sequence number, path)`` of the segments on disk, oldest first.
+        """
+        directory, prefix = os.path.split(os.path.abspath(self._state_path))
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return []
+        segments = []
+        for name in names:
+            match = _SEGMENT_RE.search(name)
+            if match and name[:match.start()] == prefix:
+                segments.append((int(match.group(1)), os.path.join(directory, name)))
+        return sorted(segments)
+
+    def exists(self):
+        return bool(self._segments())
+
+    def replay(self, sequence):
+        """
+        Yield the ``(kind, payload)`` of the records that come after the given sequence number.
+
+        Afterwards :py:attr:`sequence` is the number of the last record on disk.
+        """
+        self._sequence = sequence
+        segments = self._segments()
+        for i, (_, path) in enumerate(segments):
+            with open(path, 'r') as fobj:
+                _read_header(fobj, JOURNAL_FORMAT)
+                offset = fobj.tell()
+                lines = fobj.readlines()
+            for j, line in enumerate(lines):
+                try:
+                    record_sequence, kind, payload = json.loads(line)
+                except ValueError:
+                    if i == len(segments) - 1 and j == len(lines) - 1:
+                        # Cut it off so that new records don't end up after a broken line
+                        logger.warning("Dropping truncated last record of %s", path)
+                        with open(path, 'r+') as fobj:
+                            fobj.truncate(offset)
+                        break
+                    raise StateFormatError('%s has a corrupt record on line %d' % (path, j + 2))
+                offset += len(line)
+                if record_sequence > self._sequence:
+                    self._sequence = record_sequence
+                    yield kind, payload
+
+    def discard(self):
+        """
+        Delete all journal segments, used once a snapshot written without journaling covers them.
+        """
+        self.close()
+        for _, path in self._segments():
+            os.remove(path)
+
+    def move_aside(self, suffix):
+        """
+        Rename all journal segments by appending suffix, so they're kept but no longer replayed.
+        """
+        self.close()
+        for _, path in self._segments():
+            os.rename(path, path + suffix)
+
+    def _open_segment(self):
+        path = '%s.journal.%d' % (self._state_path, self._sequence + 1)
+        self._fobj = open(path, 'a')
+        if not self._fobj.tell():
+            self._fobj.write(_dump_line({'format': JOURNAL_FORMAT, 'version': FORMAT_VERSION}))
+            self._fobj.flush()
+
+    def append(self, records):
+        """
+        Write ``(kind, payload)`` records to the journal and flush them to the operating system.
+        """
+        if not records:
+            return
+        if self._fobj is None:
+            self._open_segment()
+        lines = []
+        for kind, payload in records:
+            self._sequence += 1
+            lines.append(_dump_line((self._sequence, kind, payload)))
+        self._fobj.write(''.join(lines))
+        self._fobj.flush()
+
+    def snapshot_running(self):
+        return self._snapshot_thread is not None and self._snapshot_thread.is_alive()
+
+    def start_snapshot(self, records):
+        """
+        Write a snapshot made of records in a background thread.
+
+        The records must not be modified afterwards. Does nothing if the
+        previous snapshot is still being written.
+        """
+        if self.snapshot_running():
+            logger.info("Previous scheduler state snapshot is still being written, skipping")
+            return
+        self.close()
+        self._snapshot_thread = threading.Thread(target=self._write_snapshot, args=(self._sequence, records))
+        self._snapshot_thread.daemon = True
+        self._snapshot_thread.start()
+
+    def _compact(self, sequence, records):
+        write_snapshot(self._state_path, sequence, records)
+        for first_sequence, path in self._segments():
+            if first_sequence <= sequence:
+                os.remove(path)
+
+    def _write_snapshot(self, sequence, records):
+        try:
+            self._compact(sequence, records)
+        except (IOError, OSError):
+            logger.warning("Failed saving scheduler state snapshot", exc_info=1)
+        else:
+            logger.info("Saved state snapshot up to journal record %d in %s", sequence, self._state_path)
+
+    def compact(self, records):
+        """
+        Write a snapshot made of records right away and delete the whole journal.
+
+        The journal is synced first, so the state survives if writing the snapshot fails.
+        """
+        self.wait()
+        self.sync()
+        self.close()
+        self._compact(self._sequence, records)
+
+    def wait(self):
+        """
+        Wait for the snapshot being written, if any.
+        """
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+            self._snapshot_thread = None
+
+    def sync(self):
+        """
+        Make sure the records written so far survive a crash of the machine.
+        """
+        if self._fobj is not None:
+            self._fobj.flush()
+            os.fsync(self._fobj.fileno())
+
+    def close(self):
+        if self._fobj is not None:
+            self._fobj.close()
+            self._fobj = None
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2017 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Read-only copy of the scheduler state that answers the visualiser's queries.
+
+Used by :py:mod:`luigi.server` when ``[scheduler] query_replica`` is set, so
+that listing tasks or drawing graphs doesn't hold up workers asking for work.
+"""
+
+import logging
+import threading
+import time
+
+import tornado.concurrent
+import tornado.ioloop
+
+from luigi.six.moves import queue
+from luigi import task_history as history
+from luigi.scheduler import Scheduler, SimpleTaskState
+
+logger = logging.getLogger(__name__)
+
+QUERY_METHODS = frozenset([
+    'graph', 'dep_graph', 'inverse_dep_graph', 'task_list', 'worker_list', 'resource_list', 'task_search',
+    'graph_changes',
+])
+
+
+class ReplicaScheduler(Scheduler):
+    """
+    Scheduler answering queries on a replica state, which it never changes itself.
+    """
+
+    def __init__(self, config, resources):
+        super(ReplicaScheduler, self).__init__(
+            config=config, resources=resources, task_history_impl=history.NopHistory())
+        self._state = SimpleTaskState(config.state_path, config.max_graph_changes)
+
+    def prune(self):
+        # The scheduler prunes its own state and the replica gets the result
+        pass
+
+
+class SchedulerReplica(object):
+    """
+    Copy of a scheduler's state, kept up to date and queried in a thread of its own.
+
+    The scheduler's state hands over the records of every change as it journals
+    them. They're applied in the replica's thread at most every
+    ``query_replica_staleness`` seconds, since the indexes have to be rebuilt
+    afterwards. Queries run in the same thread, so they never see a change
+    that is only partly applied.
+    """
+
+    def __init__(self, scheduler):
+        self._max_staleness = scheduler._config.query_replica_staleness
+        self._scheduler = ReplicaScheduler(scheduler._config, scheduler._resources)
+        self._lock = threading.Lock()
+        self._pending_records = []  # lists of records not applied yet
+        self._refresh_time = None
+        self._queries = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        scheduler._state.add_record_listener(self._add_records)
+
+    def _add_records(self, records):
+        with self._lock:
+            self._pending_records.append(records)
+
+    def start(self):
+        self._refresh(force=True)
+        self._thread.start()
+
+    def stop(self):
+        self._queries.put(None)
+        self._thread.join()
+
+    def query(self, method, arguments):
+        """
+        Run a query method of the scheduler on the replica.
+
+        :return: a future resolved on the current IOLoop with the method's result
+        """
+        future = tornado.concurrent.Future()
+        self._queries.put((method, arguments, future, tornado.ioloop.IOLoop.current()))
+        return future
+
+    def _refresh(self, force=False):
+        if not force and self._refresh_time is not None and time.time() - self._refresh_time < self._max_staleness:
+            return
+        with self._lock:
+            pending_records, self._pending_records = self._pending_records, []
+        if pending_records:
+            state = self._scheduler._state
+            for records in pending_records:
+                for kind, payload in records:
+                    state._apply_record(kind, payload)
+                    if kind == 'task':
+                        state.task_changed(payload['id'])
+                    elif kind == 'remove_tasks':
+                        for task_id in payload:
+                            state.task_changed(task_id)
+            state._rebuild_indexes()
+        self._refresh_time = time.time()
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queries.get(timeout=max(self._max_staleness, 1.0))
+            except queue.Empty:
+                self._refresh(force=True)
+                continue
+            if item is None:
+                return
+            method, arguments, future, io_loop = item
+            self._refresh()
+            try:
+                result = getattr(self._scheduler, method)(**arguments)
+            except Exception as e:
+                logger.exception("Failed answering %s from the scheduler replica", method)
+                io_loop.add_callback(future.set_exception, e)
+            else:
+                io_loop.add_callback(future.set_result, result)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2017 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Partitioning of task ids over the shards of a sharded scheduler.
+
+Every shard is a separate ``luigid`` process that owns the tasks whose ids hash
+to it. Workers talk to all of them through
+:py:class:`~luigi.rpc.ShardedRemoteScheduler` and the shards find out about the
+dependencies owned by other shards by asking those shards for their status, see
+:doc:`/central_scheduler`.
+"""
+
+import bisect
+import hashlib
+
+from luigi import six
+
+
+def _hash(key):
+    if isinstance(key, six.text_type):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hashing of task ids onto shards numbered from 0.
+
+    Every shard owns ``replicas`` points on a ring and a key belongs to the
+    shard owning the first point after the key's hash. The points only depend
+    on the shard numbers, so workers and shards agree on the owner of a task
+    as long as they're configured with the same number of shards, and adding
+    a shard only moves the tasks that now hash to it.
+    """
+
+    def __init__(self, n_shards, replicas=100):
+        assert n_shards > 0
+        points = sorted((_hash('%d:%d' % (shard, replica)), shard)
+                        for shard in range(n_shards) for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+        self.n_shards = n_shards
+
+    def get_shard(self, key):
+        if self.n_shards == 1:
+            return 0
+        i = bisect.bisect(self._hashes, _hash(key))
+        return self._shards[i % len(self._shards)]
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2017 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+SQLite storage of the scheduler state, used when ``[scheduler] state_store`` is ``sqlite``.
+
+The database at ``state_path`` has a table of tasks, indexed by status, a table
+of workers and a table with the batchers of each worker. Tasks and workers are
+stored as the same JSON records as in :py:mod:`luigi.scheduler_journal`.
+
+Tasks that are DONE and still have stakeholders are *idle*: nothing happens to
+them until they're scheduled again or their last stakeholder goes away. They're
+marked as such in the tasks table and their stakeholders are kept in a separate
+table so that the scheduler can leave them on disk and find them when one of
+their stakeholders disconnects. Only the other tasks are read at startup.
+"""
+
+import json
+import logging
+import sqlite3
+
+from luigi.scheduler_journal import StateFormatError
+from luigi.task_status import DONE
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+_MAX_VARIABLES = 500  # ids per query, older SQLite versions allow at most 999 parameters
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS tasks (id TEXT PRIMARY KEY, status TEXT NOT NULL, idle INTEGER NOT NULL, record TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status)',
+    'CREATE INDEX IF NOT EXISTS tasks_idle ON tasks (idle)',
+    'CREATE TABLE IF NOT EXISTS stakeholders (worker_id TEXT NOT NULL, task_id TEXT NOT NULL, PRIMARY KEY (worker_id, task_id))',
+    'CREATE INDEX IF NOT EXISTS stakeholders_task ON stakeholders (task_id)',
+    'CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, record TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS batchers (worker_id TEXT PRIMARY KEY, record TEXT NOT NULL)',
+]
+
+
+def is_idle(record):
+    """
+    Return whether the task record is DONE, has stakeholders and isn't waiting for anything.
+    """
+    return (record['status'] == DONE and bool(record.get('stakeholders')) and record.get('remove') is None and
+            record.get('batch_id') is None and record.get('worker_running') is None)
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+class SqliteStateStore(object):
+    """
+    Keeps task, worker and batcher records in a SQLite database.
+
+    Changes are written with :py:meth:`append`, which takes the same records as
+    :py:meth:`luigi.scheduler_journal.StateJournal.append` and commits them in
+    one transaction.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        with self._connection:
+            for statement in _SCHEMA:
+                self._connection.execute(statement)
+            row = self._connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if row is None:
+                self._connection.execute("INSERT INTO meta VALUES ('version', ?)", (str(FORMAT_VERSION),))
+            elif int(row[0]) > FORMAT_VERSION:
+                raise StateFormatError('%s has version %s, only versions up to %d can be read' % (
+                    path, row[0], FORMAT_VERSION))
+
+    def load(self):
+        """
+        Return the ``(kind, payload)`` records of the workers, batchers and tasks that aren't idle.
+        """
+        records = []
+        for record, in self._connection.execute('SELECT record FROM workers'):
+            records.append(('worker', json.loads(record)))
+        for worker_id, record in self._connection.execute('SELECT worker_id, record FROM batchers'):
+            records.append(('batchers', {'worker': worker_id, 'batchers': json.loads(record)}))
+        for record, in self._connection.execute('SELECT record FROM tasks WHERE idle = 0'):
+            records.append(('task', json.loads(record)))
+        return records
+
+    def get_task_record(self, task_id):
+        row = self._connection.execute('SELECT record FROM tasks WHERE id = ?', (task_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def has_task(self, task_id):
+        return self._connection.execute('SELECT 1 FROM tasks WHERE id = ?', (task_id,)).fetchone() is not None
+
+    def get_idle_task_records(self, status=None):
+        """
+        Yield the records of the idle tasks, optionally only the ones with the given status.
+        """
+        if status is None:
+            rows = self._connection.execute('SELECT record FROM tasks WHERE idle = 1')
+        else:
+            rows = self._connection.execute('SELECT record FROM tasks WHERE idle = 1 AND status = ?', (status,))
+        for record, in rows:
+            yield json.loads(record)
+
+    def count_idle_tasks(self, task_ids=None):
+        """
+        Return how many tasks are idle, or how many of the given tasks are if task_ids is given.
+        """
+        if task_ids is None:
+            return self._connection.execute('SELECT COUNT(*) FROM tasks WHERE idle = 1').fetchone()[0]
+        task_ids = list(task_ids)
+        count = 0
+        for i in range(0, len(task_ids), _MAX_VARIABLES):
+            chunk = task_ids[i:i + _MAX_VARIABLES]
+            query = 'SELECT COUNT(*) FROM tasks WHERE idle = 1 AND id IN (%s)' % ','.join('?' * len(chunk))
+            count += self._connection.execute(query, chunk).fetchone()[0]
+        return count
+
+    def get_stakeholder_task_ids(self, worker_id):
+        """
+        Return the ids of the idle tasks the worker is a stakeholder of.
+        """
+        rows = self._connection.execute('SELECT task_id FROM stakeholders WHERE worker_id = ?', (worker_id,))
+        return [task_id for task_id, in rows]
+
+    def _put_task(self, record):
+        idle = is_idle(record)
+        self._connection.execute('INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?)',
+                                 (record['id'], record['status'], int(idle), _dumps(record)))
+        self._connection.execute('DELETE FROM stakeholders WHERE task_id = ?', (record['id'],))
+        if idle:
+            self._connection.executemany('INSERT INTO stakeholders VALUES (?, ?)',
+                                         ((worker_id, record['id']) for worker_id in record['stakeholders']))
+
+    def append(self, records):
+        """
+        Write ``(kind, payload)`` records in a single transaction.
+        """
+        if not records:
+            return
+        with self._connection:
+            for kind, payload in records:
+                if kind == 'task':
+                    self._put_task(payload)
+                elif kind == 'worker':
+                    self._connection.execute('INSERT OR REPLACE INTO workers VALUES (?, ?)', (payload['id'], _dumps(payload)))
+                elif kind == 'batchers':
+                    self._connection.execute('INSERT OR REPLACE INTO batchers VALUES (?, ?)',
+                                             (payload['worker'], _dumps(payload['batchers'])))
+                elif kind == 'remove_tasks':
+                    self._connection.executemany('DELETE FROM tasks WHERE id = ?', ((task_id,) for task_id in payload))
+                    self._connection.executemany('DELETE FROM stakeholders WHERE task_id = ?', ((task_id,) for task_id in payload))
+                elif kind == 'remove_workers':
+                    self._connection.executemany('DELETE FROM workers WHERE id = ?', ((worker_id,) for worker_id in payload))
+                else:
+                    raise ValueError('Unknown record kind %r' % (kind,))
+
+    def replace(self, records):
+        """
+        Replace everything in the database with the given records.
+        """
+        with self._connection:
+            for table in ('tasks', 'stakeholders', 'workers', 'batchers'):
+                self._connection.execute('DELETE FROM %s' % table)
+        self.append(list(records))
+
+    def sync(self):
+        """
+        Move the changes from the write-ahead log into the database file.
+        """
+        self._connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        self._connection.close()
@@ -36,6 +36,7 @@ See :doc:`/central_scheduler` for more info.
 #
 
 import atexit
+import collections
 import json
 import logging
 import os
@@ -43,44 +44,239 @@ import signal
 import sys
 import datetime
 import time
+import zlib
 
 import pkg_resources
+import tornado.concurrent
+import tornado.gen
+import tornado.httpclient
 import tornado.httpserver
 import tornado.ioloop
+import tornado.iostream
 import tornado.netutil
 import tornado.web
 
-from luigi.scheduler import Scheduler, RPC_METHODS
+from luigi import six
+from luigi.scheduler import Scheduler, RPC_METHODS, WORKER_STATE_ACTIVE
+from luigi.scheduler_replica import QUERY_METHODS, SchedulerReplica
+from luigi.six.moves.urllib.parse import parse_qs, urlencode
 
 logger = logging.getLogger("luigi.server")
 
 
+class WorkWaiters(object):
+    """
+    Hold the ``get_work`` calls of workers that long poll until there may be work for them.
+
+    Workers pass ``wait``, the number of seconds they are willing to wait. A
+    call that gets no task is retried whenever :py:meth:`notify` finds that
+    the scheduler's work version changed, until it gets one or the time is
+    up. Calls of workers that have nothing pending are answered right away,
+    since nothing they wait for can become ready.
+    """
+
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+        self._version = scheduler.work_version()
+        self._waiters = set()  # futures of the held calls
+
+    def notify(self):
+        """
+        Wake the held calls up if the scheduler may have work it didn't have before.
+        """
+        version = self._scheduler.work_version()
+        if version == self._version:
+            return
+        self._version = version
+        waiters, self._waiters = self._waiters, set()
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+    @staticmethod
+    def _may_wait(reply, arguments):
+        if reply.get('task_id') is not None or reply.get('batch_id') is not None:
+            return False
+        if reply.get('worker_state', WORKER_STATE_ACTIVE) != WORKER_STATE_ACTIVE:
+            return False
+        return reply.get('n_pending_tasks') or arguments.get('assistant')
+
+    @tornado.gen.coroutine
+    def get_work(self, arguments, wait, is_closed):
+        """
+        Call ``get_work`` with arguments until it returns a task or wait seconds have passed.
+
+        :param is_closed: function telling whether the worker went away, so the task mustn't be handed out
+        """
+        io_loop = tornado.ioloop.IOLoop.current()
+        deadline = io_loop.time() + wait
+        while True:
+            reply = self._scheduler.get_work(**arguments)
+            if not self._may_wait(reply, arguments):
+                raise tornado.gen.Return(reply)
+            if io_loop.time() >= deadline:
+                break
+            future = tornado.concurrent.Future()
+            self._waiters.add(future)
+            try:
+                yield tornado.gen.with_timeout(deadline, future)
+            except tornado.gen.TimeoutError:
+                self._waiters.discard(future)
+                break
+            if is_closed():
+                raise tornado.gen.Return(None)
+        # Tells the worker it doesn't need to sleep before asking again
+        reply['waited'] = True
+        raise tornado.gen.Return(reply)
+
+
+class EventStream(object):
+    """
+    Hand the scheduler's events to the clients of ``/api/events``, see :py:meth:`Scheduler.add_event_listener`.
+
+    Each client has a buffer of its own, written out from the IOLoop once the
+    scheduler is done with the request that made the events. Only one write
+    per client is in flight at a time, the events arriving meanwhile wait in
+    the buffer. A client whose buffer fills up with ``max_buffered`` events
+    is sent an ``overflow`` event and disconnected, rather than slowing the
+    scheduler down or using up its memory.
+    """
+
+    def __init__(self, scheduler, max_buffered=10000):
+        self.max_buffered = max_buffered
+        self._subscribers = set()
+        scheduler.add_event_listener(self.publish)
+
+    def subscribe(self, subscriber):
+        self._subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+
+    def publish(self, event):
+        for subscriber in list(self._subscribers):
+            subscriber.put(event)
+
+
+class EventStreamHandler(tornado.web.RequestHandler):
+    """
+    Stream the scheduler's events as server-sent events, one JSON object per event.
+    """
+
+    def initialize(self, event_stream):
+        self._event_stream = event_stream
+        self._buffer = collections.deque()
+        self._writing = False
+        self._done = tornado.concurrent.Future()
+
+    @tornado.gen.coroutine
+    def get(self):
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("Access-Control-Allow-Origin", "*")
+        self.write(": connected\n\n")
+        self.flush()
+        self._event_stream.subscribe(self)
+        try:
+            yield self._done
+        finally:
+            self._event_stream.unsubscribe(self)
+
+    def put(self, event):
+        if self._done.done():
+            return
+        if len(self._buffer) >= self._event_stream.max_buffered:
+            logger.warning("Disconnecting event stream client %s, it fell %d events behind",
+                           self.request.remote_ip, len(self._buffer))
+            self._buffer.clear()
+            self._write_event({'type': 'overflow'})
+            self._done.set_result(None)
+            return
+        self._buffer.append(event)
+        if not self._writing:
+            self._writing = True
+            tornado.ioloop.IOLoop.current().add_callback(self._send_events)
+
+    def _write_event(self, event):
+        self.write("event: {}\ndata: {}\n\n".format(event['type'], json.dumps(event)))
+
+    @tornado.gen.coroutine
+    def _send_events(self):
+        try:
+            while self._buffer and not self._done.done():
+                while self._buffer:
+                    self._write_event(self._buffer.popleft())
+                yield self.flush()
+        except tornado.iostream.StreamClosedError:
+            self.on_connection_close()
+        finally:
+            self._writing = False
+
+    def on_connection_close(self):
+        if not self._done.done():
+            self._done.set_result(None)
+
+
 class RPCHandler(tornado.web.RequestHandler):
     """
     Handle remote scheduling calls using rpc.RemoteSchedulerResponder.
     """
 
-    def initialize(self, scheduler):
+    def initialize(self, scheduler, replica=None, work_waiters=None):
         self._scheduler = scheduler
+        self._replica = replica
+        self._work_waiters = work_waiters
+        self._closed = False
         self.set_header("Access-Control-Allow-Headers", "Accept, Authorization, Content-Type, Origin")
         self.set_header("Access-Control-Allow-Methods", "GET, OPTIONS")
         self.set_header("Access-Control-Allow-Origin", "*")
+        # Tell clients they may gzip the requests they send (RFC 7694)
+        self.set_header("Accept-Encoding", "gzip")
+
+    def _payload(self):
+        if self.request.headers.get('Content-Encoding') == 'gzip':
+            # Only servers made without decompress_request leave the body compressed
+            body = zlib.decompress(self.request.body, 16 + zlib.MAX_WBITS).decode('utf-8')
+            return parse_qs(body).get('data', ["{}"])[0]
+        return self.get_argument('data', default="{}")
 
+    @tornado.gen.coroutine
     def get(self, method):
         if method not in RPC_METHODS:
             self.send_error(404)
             return
-        payload = self.get_argument('data', default="{}")
+        payload = self._payload()
         arguments = json.loads(payload)
 
-        if hasattr(self._scheduler, method):
-            result = getattr(self._scheduler, method)(**arguments)
-            self.write({"response": result})  # wrap all json response in a dictionary
-        else:
-            self.send_error(404)
+        try:
+            if self._replica is not None and method in QUERY_METHODS:
+                result = yield self._replica.query(method, arguments)
+                self.write({"response": result})
+            elif method == 'get_work' and arguments.get('wait') and self._work_waiters is not None:
+                result = yield self._work_waiters.get_work(
+                    arguments, float(arguments.pop('wait')), lambda: self._closed)
+                if not self._closed:
+                    self.write({"response": result})
+            elif hasattr(self._scheduler, method):
+                result = getattr(self._scheduler, method)(**arguments)
+                self.write({"response": result})  # wrap all json response in a dictionary
+                if self._work_waiters is not None:
+                    self._work_waiters.notify()
+            else:
+                self.send_error(404)
+        except ValueError as ex:
+            # Invalid arguments, like a page_size that isn't positive
+            raise tornado.web.HTTPError(400, str(ex))
 
     post = get
 
+    def on_connection_close(self):
+        self._closed = True
+
+
+HISTORY_PAGE_SIZE = 100
+MAX_HISTORY_PAGE_SIZE = 1000
+
 
 class BaseTaskHistoryHandler(tornado.web.RequestHandler):
     def initialize(self, scheduler):
@@ -89,13 +285,26 @@ class BaseTaskHistoryHandler(tornado.web.RequestHandler):
     def get_template_path(self):
         return pkg_resources.resource_filename(__name__, 'templates')
 
+    def render_runs_page(self, task_name=None, params=None, exact=False, since=None):
+        """
+        Render a page of the tasks found by ``find_runs_page``, with a link to the next page.
+        """
+        try:
+            page_size = min(int(self.get_argument('page_size', HISTORY_PAGE_SIZE)), MAX_HISTORY_PAGE_SIZE)
+            tasks, cursor = self._scheduler.task_history.find_runs_page(
+                task_name, params, exact, since, page_size=page_size, cursor=self.get_argument('cursor', None))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        next_url = None
+        if cursor is not None:
+            args = dict((k, self.get_argument(k)) for k in self.request.arguments if k != 'cursor')
+            next_url = self.request.path + '?' + urlencode(dict(args, cursor=cursor))
+        self.render("recent.html", tasks=tasks, next_url=next_url)
+
 
 class AllRunHandler(BaseTaskHistoryHandler):
     def get(self):
-        all_tasks = self._scheduler.task_history.find_all_runs()
-        tasknames = []
-        for task in all_tasks:
-            tasknames.append(task.name)
+        tasknames = self._scheduler.task_history.find_task_names()
         # show all tasks with their name list to be selected
         # why all tasks? the duration of the event history of a selected task
         # can be more than 24 hours.
@@ -161,14 +370,12 @@ def from_utc(utcTime, fmt=None):
 
 class RecentRunHandler(BaseTaskHistoryHandler):
     def get(self):
-        tasks = self._scheduler.task_history.find_latest_runs()
-        self.render("recent.html", tasks=tasks)
+        self.render_runs_page(since=datetime.datetime.now() - datetime.timedelta(days=1))
 
 
 class ByNameHandler(BaseTaskHistoryHandler):
     def get(self, name):
-        tasks = self._scheduler.task_history.find_all_by_name(name)
-        self.render("recent.html", tasks=tasks)
+        self.render_runs_page(name)
 
 
 class ByIdHandler(BaseTaskHistoryHandler):
@@ -181,8 +388,24 @@ class ByParamsHandler(BaseTaskHistoryHandler):
     def get(self, name):
         payload = self.get_argument('data', default="{}")
         arguments = json.loads(payload)
-        tasks = self._scheduler.task_history.find_all_by_parameters(name, session=None, **arguments)
-        self.render("recent.html", tasks=tasks)
+        self.render_runs_page(name, arguments, exact=self.get_argument('exact', 'false') == 'true')
+
+
+class TaskStatsHandler(BaseTaskHistoryHandler):
+    def get(self, name=None):
+        try:
+            days = int(self.get_argument('days', 30))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        stats = self._scheduler.task_history.find_task_stats(name, days)
+        self.write({'stats': [dict(day_stats, day=day_stats['day'].isoformat()) for day_stats in stats]})
+
+
+class WriterStatsHandler(BaseTaskHistoryHandler):
+    def get(self):
+        if not hasattr(self._scheduler.task_history, 'writer_stats'):
+            raise tornado.web.HTTPError(404)
+        self.write(self._scheduler.task_history.writer_stats())
 
 
 class RootPathHandler(BaseTaskHistoryHandler):
@@ -190,32 +413,56 @@ class RootPathHandler(BaseTaskHistoryHandler):
         self.redirect("/static/visualiser/index.html")
 
 
-def app(scheduler):
+def app(scheduler, replica=None, work_waiters=None, event_stream=None):
     settings = {"static_path": os.path.join(os.path.dirname(__file__), "static"),
                 "unescape": tornado.escape.xhtml_unescape,
                 "compress_response": True,
                 }
     handlers = [
-        (r'/api/(.*)', RPCHandler, {"scheduler": scheduler}),
+        (r'/api/(.*)', RPCHandler, {"scheduler": scheduler, "replica": replica, "work_waiters": work_waiters}),
         (r'/', RootPathHandler, {'scheduler': scheduler}),
         (r'/tasklist', AllRunHandler, {'scheduler': scheduler}),
         (r'/tasklist/(.*?)', SelectedRunHandler, {'scheduler': scheduler}),
         (r'/history', RecentRunHandler, {'scheduler': scheduler}),
         (r'/history/by_name/(.*?)', ByNameHandler, {'scheduler': scheduler}),
         (r'/history/by_id/(.*?)', ByIdHandler, {'scheduler': scheduler}),
-        (r'/history/by_params/(.*?)', ByParamsHandler, {'scheduler': scheduler})
+        (r'/history/by_params/(.*?)', ByParamsHandler, {'scheduler': scheduler}),
+        (r'/history/writer_stats', WriterStatsHandler, {'scheduler': scheduler}),
+        (r'/history/stats', TaskStatsHandler, {'scheduler': scheduler}),
+        (r'/history/stats/by_name/(.*?)', TaskStatsHandler, {'scheduler': scheduler}),
     ]
+    if event_stream is not None:
+        handlers.insert(0, (r'/api/events', EventStreamHandler, {"event_stream": event_stream}))
     api_app = tornado.web.Application(handlers, **settings)
     return api_app
 
 
-def _init_api(scheduler, api_port=None, address=None, unix_socket=None):
-    api_app = app(scheduler)
+@tornado.gen.coroutine
+def sync_shard_statuses(scheduler):
+    """
+    Ask the other shards of a sharded scheduler about the dependencies they own.
+    """
+    client = tornado.httpclient.AsyncHTTPClient()
+    shard_urls = scheduler._config.shard_urls
+    for shard, task_ids in six.iteritems(scheduler.foreign_dependencies()):
+        url = '{}/api/get_task_statuses'.format(shard_urls[shard].rstrip('/'))
+        body = urlencode({'data': json.dumps({'task_ids': task_ids})})
+        try:
+            response = yield client.fetch(url, method='POST', body=body)
+        except (tornado.httpclient.HTTPError, IOError):
+            logger.warning("Failed fetching task statuses from shard %s", url, exc_info=True)
+            continue
+        scheduler.update_foreign_statuses(json.loads(response.body.decode('utf-8'))['response'])
+
+
+def _init_api(scheduler, api_port=None, address=None, unix_socket=None, replica=None, work_waiters=None,
+              event_stream=None):
+    api_app = app(scheduler, replica, work_waiters, event_stream)
     if unix_socket is not None:
         api_sockets = [tornado.netutil.bind_unix_socket(unix_socket)]
     else:
         api_sockets = tornado.netutil.bind_sockets(api_port, address=address)
-    server = tornado.httpserver.HTTPServer(api_app)
+    server = tornado.httpserver.HTTPServer(api_app, decompress_request=True)
     server.add_sockets(api_sockets)
 
     # Return the bound socket names.  Useful for connecting client in test scenarios.
@@ -232,17 +479,50 @@ def run(api_port=8082, address=None, unix_socket=None, scheduler=None):
     # load scheduler state
     scheduler.load()
 
+    # answer the visualiser's queries from a replica of the state in another thread
+    replica = None
+    if scheduler._config.query_replica:
+        replica = SchedulerReplica(scheduler)
+        replica.start()
+
+    # hold the get_work calls of workers that long poll until there is work for them
+    work_waiters = WorkWaiters(scheduler)
+
+    # stream task status changes, workers joining and leaving and resource changes to /api/events
+    event_stream = EventStream(scheduler)
+
     _init_api(
         scheduler=scheduler,
         api_port=api_port,
         address=address,
         unix_socket=unix_socket,
+        replica=replica,
+        work_waiters=work_waiters,
+        event_stream=event_stream,
     )
 
     # prune work DAG every 60 seconds
-    pruner = tornado.ioloop.PeriodicCallback(scheduler.prune, 60000)
+    def prune():
+        scheduler.prune()
+        work_waiters.notify()
+
+    pruner = tornado.ioloop.PeriodicCallback(prune, 60000)
     pruner.start()
 
+    # compact the state journal into a snapshot in the background
+    snapshotter = tornado.ioloop.PeriodicCallback(scheduler.snapshot, scheduler._config.state_snapshot_interval * 1000)
+    snapshotter.start()
+
+    # find out which dependencies owned by the other shards are done
+    if len(scheduler._config.shard_urls) > 1:
+        @tornado.gen.coroutine
+        def sync_shards():
+            yield sync_shard_statuses(scheduler)
+            work_waiters.notify()
+
+        shard_syncer = tornado.ioloop.PeriodicCallback(sync_shards, scheduler._config.shard_sync_interval * 1000)
+        shard_syncer.start()
+
     def shutdown_handler(signum, frame):
         exit_handler()
         sys.exit(0)
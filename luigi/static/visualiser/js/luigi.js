@@ -57,6 +57,12 @@ var LuigiAPI = (function() {
         });
     }
 
+    LuigiAPI.prototype.getGraphChanges = function(since, callback) {
+        return jsonRPC(this.urlRoot + "/graph_changes", {since: since}, function(response) {
+            callback(response.response);
+        });
+    };
+
     LuigiAPI.prototype.getFailedTaskList = function(callback) {
         return jsonRPC(this.urlRoot + "/task_list", {status: "FAILED", upstream_status: "", search: searchTerm()}, function(response) {
             callback(flatten(response.response));
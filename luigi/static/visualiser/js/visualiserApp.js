@@ -3,6 +3,8 @@ function visualiserApp(luigi) {
     var typingTimer = 0;
     var dt; // DataTable instantiated in $(document).ready()
     var missingCategories = {};
+    var graphWatch = null; // the dependency graph shown, see showGraph()
+    var GRAPH_POLL_INTERVAL = 5000;
     var currentFilter = {
         taskFamily: "",
         taskCategory: [],
@@ -383,8 +385,93 @@ function visualiserApp(luigi) {
         }
     }
 
+    /*
+     * Show the dependency graph of taskId, then keep it up to date with the changes the scheduler
+     * reports. Changes to the statuses or priorities of the tasks shown are applied in place, the
+     * graph is only fetched again when its shape may have changed.
+     */
+    function showGraph(taskId, hideDone, invert, callback) {
+        var watch = {version: null, graph: [], tasks: {}};
+        graphWatch = watch;
+
+        function fetchGraph() {
+            var getGraph = invert ? luigi.getInverseDependencyGraph : luigi.getDependencyGraph;
+            getGraph.call(luigi, taskId, function(dependencyGraph) {
+                if (graphWatch !== watch) {
+                    return;
+                }
+                watch.graph = dependencyGraph;
+                watch.tasks = {};
+                $.each(dependencyGraph, function(i, node) {
+                    watch.tasks[node.taskId] = node;
+                });
+                callback(dependencyGraph);
+                if (watch.version !== null) {
+                    setTimeout(pollChanges, GRAPH_POLL_INTERVAL);
+                }
+            }, !hideDone);
+        }
+
+        function reshaped(changes) {
+            if ($.grep(changes.removed, function(id) { return watch.tasks[id] !== undefined; }).length) {
+                return true;
+            }
+            var shown = false, dependent = false, depsChanged = false;
+            $.each(changes.tasks, function(id, task) {
+                var node = watch.tasks[id];
+                if (node !== undefined) {
+                    shown = true;
+                    depsChanged = depsChanged || node.deps.slice().sort().join() !== task.deps.slice().sort().join();
+                }
+                dependent = dependent || $.grep(task.deps, function(dep) { return watch.tasks[dep] !== undefined; }).length > 0;
+            });
+            // Inverse graphs show dependents as deps, and graphs without DONE tasks drop tasks as they finish
+            if (invert) {
+                return dependent;
+            }
+            return hideDone ? shown : depsChanged;
+        }
+
+        function pollChanges() {
+            if (graphWatch !== watch) {
+                return;
+            }
+            luigi.getGraphChanges(watch.version, function(changes) {
+                if (graphWatch !== watch) {
+                    return;
+                }
+                watch.version = changes.version;
+                if (changes.reset || reshaped(changes)) {
+                    fetchGraph();
+                    return;
+                }
+                var updated = false;
+                $.each(changes.tasks, function(id, task) {
+                    var node = watch.tasks[id];
+                    if (node !== undefined) {
+                        node.status = task.status;
+                        node.priority = task.priority;
+                        updated = true;
+                    }
+                });
+                if (updated) {
+                    callback(watch.graph);
+                }
+                setTimeout(pollChanges, GRAPH_POLL_INTERVAL);
+            });
+        }
+
+        // Get the version before the graph so that no change made in between is missed.
+        // Schedulers without graph_changes only get the graph shown once.
+        luigi.getGraphChanges(null, function(changes) {
+            watch.version = changes.version;
+            fetchGraph();
+        }).fail(fetchGraph);
+    }
+
     function processHashChange(paint) {
         var hash = decodeURIComponent(location.hash);
+        graphWatch = null;
         // Convert fragment params to object.
         var fragmentQuery = URI.parseQuery(location.hash.replace('#', '')); // "http://example.org/#!/foo/bar/baz.html");
 
@@ -412,12 +499,7 @@ function visualiserApp(luigi) {
             $("#searchError").removeClass();
             if (taskId) {
                 var depGraphCallback = makeGraphCallback(fragmentQuery.visType, taskId, paint);
-
-                if (fragmentQuery.invertDependencies) {
-                    luigi.getInverseDependencyGraph(taskId, depGraphCallback, !hideDone);
-                } else {
-                    luigi.getDependencyGraph(taskId, depGraphCallback, !hideDone);
-                }
+                showGraph(taskId, hideDone, fragmentQuery.invertDependencies, depGraphCallback);
             }
             updateVisType(fragmentQuery.visType || 'd3');
             initVisualisation(fragmentQuery.visType);
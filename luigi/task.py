@@ -193,6 +193,11 @@ class Task(object):
     #: Maximum number of tasks to run together as a batch. Infinite by default
     max_batch_size = float('inf')
 
+    #: Whether running the task twice at the same time does no harm. The scheduler may then
+    #: give a second copy of the task to another worker when it runs for unusually long,
+    #: see ``speculative_execution`` in :ref:`scheduler-config`.
+    idempotent = False
+
     @property
     def batchable(self):
         """
@@ -68,6 +68,20 @@ class TaskHistory(object):
     def task_started(self, task, worker_host):
         pass
 
+    def flush(self):
+        """
+        Wait until the history recorded so far is stored.
+        """
+        pass
+
+    def runtime_estimates(self, percentile=50):
+        """
+        Return the typical runtime in seconds of the tasks of each family, for the families that ran before.
+
+        :param percentile: 50 for the median runtime, 95 for the runtime only one run in twenty exceeds.
+        """
+        return {}
+
     # TODO(erikbern): should web method (find_latest_runs etc) be abstract?
 
 
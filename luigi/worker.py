@@ -96,11 +96,13 @@ class TaskException(Exception):
 
 GetWorkResponse = collections.namedtuple('GetWorkResponse', (
     'task_id',
+    'task_ids',
     'running_tasks',
     'n_pending_tasks',
     'n_unique_pending',
     'n_pending_last_scheduled',
     'worker_state',
+    'waited',
 ))
 
 
@@ -367,6 +369,16 @@ class worker(Config):
     no_install_shutdown_handler = BoolParameter(default=False,
                                                 description='If true, the SIGUSR1 shutdown handler will'
                                                 'NOT be install on the worker')
+    get_work_wait = FloatParameter(default=0.0,
+                                   description='Seconds a worker waiting for work lets the scheduler hold '
+                                               'its get_work call until there is work, instead of asking '
+                                               'again every wait_interval. 0 disables long polling')
+    add_task_batch_size = IntParameter(default=1,
+                                       description='Number of scheduled tasks to report to the scheduler '
+                                                   'in one add_tasks request. 1 reports every task right away')
+    add_task_batch_interval = FloatParameter(default=5.0,
+                                             description='Seconds after which scheduled tasks waiting to be '
+                                                         'reported in one request are reported anyway')
 
 
 class KeepAliveThread(threading.Thread):
@@ -444,6 +456,8 @@ class Worker(object):
         self._suspended_tasks = {}
         self._batch_running_tasks = {}
         self._batch_families_sent = set()
+        self._add_task_buffer = None  # add_task arguments waiting to be sent, while add() batches them
+        self._add_task_buffer_time = None
 
         self._first_task = None
 
@@ -464,6 +478,7 @@ class Worker(object):
         # Keep info about what tasks are running (could be in other processes)
         self._task_result_queue = multiprocessing.Queue()
         self._running_tasks = {}
+        self._stopped_tasks = set()  # ids of running tasks that another worker completed first
 
         # Stuff for execution_summary
         self._add_task_history = []
@@ -487,10 +502,36 @@ class Worker(object):
             for batch_task in self._batch_running_tasks.pop(task_id):
                 self._add_task_history.append((batch_task, status, True))
 
+        if self._add_task_buffer is not None and not args:
+            if not self._add_task_buffer:
+                self._add_task_buffer_time = time.time()
+            self._add_task_buffer.append(kwargs)
+            if (len(self._add_task_buffer) >= self._config.add_task_batch_size or
+                    time.time() - self._add_task_buffer_time >= self._config.add_task_batch_interval):
+                self._flush_add_tasks()
+            return
+
         self._scheduler.add_task(*args, **kwargs)
 
         logger.info('Informed scheduler that task   %s   has status   %s', task_id, status)
 
+    def _flush_add_tasks(self):
+        """
+        Send the add_task calls batched so far in one request, in the order they were made.
+        """
+        buffer, self._add_task_buffer = self._add_task_buffer, []
+        if not buffer:
+            return
+        add_tasks = getattr(self._scheduler, 'add_tasks', None)
+        if add_tasks is None:
+            for kwargs in buffer:
+                self._scheduler.add_task(**kwargs)
+        else:
+            add_tasks(worker=self._id, tasks=[
+                dict((key, value) for key, value in six.iteritems(kwargs) if key != 'worker') for kwargs in buffer])
+        for kwargs in buffer:
+            logger.info('Informed scheduler that task   %s   has status   %s', kwargs['task_id'], kwargs['status'])
+
     def __enter__(self):
         """
         Start the KeepAliveThread.
@@ -647,6 +688,8 @@ class Worker(object):
 
         # we track queue size ourselves because len(queue) won't work for multiprocessing
         queue_size = 1
+        if self._config.add_task_batch_size > 1:
+            self._add_task_buffer = []
         try:
             seen = set([task.task_id])
             while queue_size:
@@ -659,6 +702,8 @@ class Worker(object):
                         seen.add(next.task_id)
                         pool.apply_async(check_complete, [next, queue])
                         queue_size += 1
+            if self._add_task_buffer is not None:
+                self._flush_add_tasks()
         except (KeyboardInterrupt, TaskException):
             raise
         except Exception as ex:
@@ -669,6 +714,7 @@ class Worker(object):
             self._email_unexpected_error(task, formatted_traceback)
             raise
         finally:
+            self._add_task_buffer = None
             pool.close()
             pool.join()
         return self.add_succeeded
@@ -771,6 +817,7 @@ class Worker(object):
             module=task.task_module,
             batchable=task.batchable,
             retry_policy_dict=_get_retry_policy_dict(task),
+            idempotent=task.idempotent,
         )
 
     def _validate_dependency(self, dependency):
@@ -836,51 +883,73 @@ class Worker(object):
         else:
             return None
 
+    def _claim_work(self, work):
+        """
+        Get ready to run a task or batch the scheduler handed out and return its id, or None if it can't run.
+        """
+        task_id = self._get_work_task_id(work)
+
+        if task_id is not None and task_id not in self._scheduled_tasks:
+            logger.info('Did not schedule %s, will load it dynamically', task_id)
+
+            try:
+                # TODO: we should obtain the module name from the server!
+                self._scheduled_tasks[task_id] = \
+                    load_task(module=work.get('task_module'),
+                              task_name=work['task_family'],
+                              params_str=work['task_params'])
+            except TaskClassException as ex:
+                self._handle_task_load_error(ex, [task_id])
+                task_id = None
+                self.run_succeeded = False
+
+        if task_id is not None and 'batch_task_ids' in work:
+            batch_tasks = filter(None, [
+                self._scheduled_tasks.get(batch_id) for batch_id in work['batch_task_ids']])
+            self._batch_running_tasks[task_id] = batch_tasks
+
+        return task_id
+
     def _get_work(self):
         if self._stop_requesting_work:
-            return GetWorkResponse(None, 0, 0, 0, 0, WORKER_STATE_DISABLED)
+            return GetWorkResponse(None, [], 0, 0, 0, 0, WORKER_STATE_DISABLED, False)
 
         if self.worker_processes > 0:
             logger.debug("Asking scheduler for work...")
+            kwargs = {}
+            free_slots = self.worker_processes - len(self._running_tasks)
+            if free_slots > 1:
+                kwargs['slots'] = free_slots
+            if self._config.get_work_wait > 0 and self._config.keep_alive and not self._running_tasks:
+                # Nothing to do but wait for work, which the scheduler tells about as soon as there is some
+                kwargs['wait'] = self._config.get_work_wait
             r = self._scheduler.get_work(
                 worker=self._id,
                 host=self.host,
                 assistant=self._assistant,
                 current_tasks=list(self._running_tasks.keys()),
+                **kwargs
             )
         else:
             logger.debug("Checking if tasks are still pending")
             r = self._scheduler.count_pending(worker=self._id)
 
         running_tasks = r['running_tasks']
-        task_id = self._get_work_task_id(r)
+        task_ids = []
+        for work in r.get('tasks', [r]):
+            task_id = self._claim_work(work)
+            if task_id is not None:
+                task_ids.append(task_id)
+        task_id = task_ids[0] if task_ids else None
 
         self._get_work_response_history.append({
             'task_id': task_id,
             'running_tasks': running_tasks,
         })
 
-        if task_id is not None and task_id not in self._scheduled_tasks:
-            logger.info('Did not schedule %s, will load it dynamically', task_id)
-
-            try:
-                # TODO: we should obtain the module name from the server!
-                self._scheduled_tasks[task_id] = \
-                    load_task(module=r.get('task_module'),
-                              task_name=r['task_family'],
-                              params_str=r['task_params'])
-            except TaskClassException as ex:
-                self._handle_task_load_error(ex, [task_id])
-                task_id = None
-                self.run_succeeded = False
-
-        if task_id is not None and 'batch_task_ids' in r:
-            batch_tasks = filter(None, [
-                self._scheduled_tasks.get(batch_id) for batch_id in r['batch_task_ids']])
-            self._batch_running_tasks[task_id] = batch_tasks
-
         return GetWorkResponse(
             task_id=task_id,
+            task_ids=task_ids,
             running_tasks=running_tasks,
             n_pending_tasks=r['n_pending_tasks'],
             n_unique_pending=r['n_unique_pending'],
@@ -889,6 +958,7 @@ class Worker(object):
             #  That is you can user a newer client than server (Sep 2016)
             n_pending_last_scheduled=r.get('n_pending_last_scheduled', 0),
             worker_state=r.get('worker_state', WORKER_STATE_ACTIVE),
+            waited=r.get('waited', False),
         )
 
     def _run_task(self, task_id):
@@ -920,7 +990,11 @@ class Worker(object):
         :return:
         """
         for task_id, p in six.iteritems(self._running_tasks):
-            if not p.is_alive() and p.exitcode:
+            if task_id in self._stopped_tasks:
+                if p.is_alive():
+                    p.terminate()
+                error_msg = 'Task {} was stopped, another worker completed it first'.format(task_id)
+            elif not p.is_alive() and p.exitcode:
                 error_msg = 'Task {} died unexpectedly with exit code {}'.format(task_id, p.exitcode)
                 p.task.trigger_event(Event.PROCESS_FAILURE, p.task, error_msg)
             elif p.timeout_time is not None and time.time() > float(p.timeout_time) and p.is_alive():
@@ -958,6 +1032,12 @@ class Worker(object):
                 # Not a running task. Probably already removed.
                 # Maybe it yielded something?
 
+            if task_id in self._stopped_tasks:
+                # The scheduler already knows the task is done
+                self._stopped_tasks.discard(task_id)
+                self._running_tasks.pop(task_id)
+                return
+
             # external task if run not implemented, retry-able if config option is enabled.
             external_task_retryable = _is_external(task) and self._config.retry_external_tasks
             if status == FAILED and not external_task_retryable:
@@ -1073,7 +1153,8 @@ class Worker(object):
                     self._log_remote_tasks(get_work_response)
                 if len(self._running_tasks) == 0:
                     if self._keep_alive(get_work_response):
-                        six.next(sleeper)
+                        if not get_work_response.waited:
+                            six.next(sleeper)
                         continue
                     else:
                         break
@@ -1083,7 +1164,8 @@ class Worker(object):
 
             # task_id is not None:
             logger.debug("Pending tasks: %s", get_work_response.n_pending_tasks)
-            self._run_task(get_work_response.task_id)
+            for task_id in get_work_response.task_ids:
+                self._run_task(task_id)
 
         while len(self._running_tasks):
             logger.debug('Shut down Worker, %d more tasks to go', len(self._running_tasks))
@@ -1110,6 +1192,12 @@ class Worker(object):
             logger.info("Worker %s successfully dispatched rpc message to function '%s'" % tpl)
             func(**kwargs)
 
+    @rpc_message_callback
+    def stop_task(self, task_id):
+        # only mark the task, it's stopped by the thread handling the running tasks
+        if task_id in self._running_tasks:
+            self._stopped_tasks.add(task_id)
+
     @rpc_message_callback
     def set_worker_processes(self, n):
         # set the new value
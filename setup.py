@@ -69,6 +69,7 @@ setup(
         'console_scripts': [
             'luigi = luigi.cmdline:luigi_run',
             'luigid = luigi.cmdline:luigid',
+            'luigi-history = luigi.cmdline:luigi_history',
             'luigi-grep = luigi.tools.luigi_grep:main',
             'luigi-deps = luigi.tools.deps:main',
             'luigi-deps-tree = luigi.tools.deps_tree:main',
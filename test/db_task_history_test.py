@@ -15,14 +15,22 @@
 # limitations under the License.
 #
 
+import datetime
+import os
+import tempfile
+import threading
+
 from helpers import unittest
+import mock
+import sqlalchemy
 
 from luigi import six
 
 from helpers import with_config
 import luigi
-from luigi.db_task_history import DbTaskHistory
-from luigi.task_status import DONE, PENDING, RUNNING
+from luigi.db_task_history import DbTaskHistory, TaskEvent, TaskParameter, TaskRecord, TaskStats
+from luigi.task_status import DONE, FAILED, PENDING, RUNNING
+import luigi.cmdline
 import luigi.scheduler
 
 
@@ -98,6 +106,221 @@ class DbTaskHistoryTest(unittest.TestCase):
         self.history.task_scheduled(task2)
         self.history.task_started(task2, 'hostname')
         self.history.task_finished(task2, successful=True)
+        self.history.flush()
+        return task2
+
+    def test_events_of_a_task_share_a_record(self):
+        task = self.run_task(DummyTask())
+        self.history.task_scheduled(task)
+        self.history.task_started(task, 'otherhost')
+        self.history.flush()
+
+        [task_record] = self.history.find_all_by_name('DummyTask')
+        self.assertEqual(task_record.host, 'otherhost')
+        self.assertEqual([RUNNING, PENDING, DONE, RUNNING, PENDING], [event.event_name for event in task_record.events])
+        self.assertEqual(1, len(task_record.parameters))
+
+    def test_writer_stats(self):
+        for i in range(3):
+            self.run_task(DummyTask(foo=str(i)))
+
+        stats = self.history.writer_stats()
+        self.assertEqual(9, stats['written'])
+        self.assertEqual(0, stats['dropped'])
+        self.assertEqual(0, stats['queued'])
+        self.assertEqual(3, stats['flushes'])
+        self.assertEqual(3, stats['last_flush_size'])
+
+    def test_runs_page(self):
+        for i in range(5):
+            self.run_task(DummyTask(foo=str(i)))
+
+        foos, cursor = [], None
+        while True:
+            page, cursor = self.history.find_runs_page('DummyTask', page_size=2, cursor=cursor)
+            foos.append([task.parameters['foo'].value for task in page])
+            if cursor is None:
+                break
+        self.assertEqual([['4', '3'], ['2', '1'], ['0']], foos)
+        self.assertRaises(ValueError, self.history.find_runs_page, page_size=0)
+        self.assertRaises(ValueError, self.history.find_runs_page, cursor='foo')
+
+    def test_runs_page_by_params(self):
+        self.run_task(ParamTask('foo', 1))
+        self.run_task(ParamTask('foo', 2))
+        self.run_task(ParamTask('bar', 1))
+
+        def param2s(params, exact=False):
+            page, cursor = self.history.find_runs_page('ParamTask', params, exact)
+            return sorted(task.parameters['param2'].value for task in page)
+
+        self.assertEqual(['1', '2'], param2s({'param1': 'foo'}))
+        self.assertEqual(['1'], param2s({'param1': 'foo', 'param2': '1'}))
+        self.assertEqual([], param2s({'param1': 'foo'}, exact=True))
+        self.assertEqual(['2'], param2s({'param2': '2', 'param1': 'foo'}, exact=True))
+
+    def test_upgrade_schema(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        engine = sqlalchemy.create_engine('sqlite:///' + path)
+        engine.execute('CREATE TABLE tasks (id INTEGER PRIMARY KEY, task_id VARCHAR(200), name VARCHAR(128), host VARCHAR(128))')
+        engine.execute('CREATE TABLE task_parameters (task_id INTEGER, name VARCHAR(128), value VARCHAR(256), PRIMARY KEY (task_id, name))')
+        engine.execute('CREATE TABLE task_events (id INTEGER PRIMARY KEY, task_id INTEGER, event_name VARCHAR(20), ts TIMESTAMP NOT NULL)')
+        engine.execute("INSERT INTO tasks VALUES (1, 'ParamTask_foo_1', 'ParamTask', 'hostname')")
+        engine.execute("INSERT INTO task_parameters VALUES (1, 'param1', 'foo'), (1, 'param2', '1')")
+        engine.execute("INSERT INTO task_events VALUES (1, 1, 'PENDING', '2017-01-01 00:00:00'), (2, 1, 'DONE', '2017-01-01 01:00:00')")
+        # More tasks than are upgraded at a time
+        engine.execute('INSERT INTO tasks VALUES (?, ?, ?, NULL)', [(i, 'ParamTask_foo_%d' % i, 'ParamTask') for i in range(2, 1100)])
+        engine.execute('INSERT INTO task_parameters VALUES (?, ?, ?)', [(i, 'param1', 'foo%d' % i) for i in range(2, 1100)])
+
+        history = with_config(dict(task_history=dict(db_connection='sqlite:///' + path, background_writes='false')))(DbTaskHistory)()
+        [task_record] = history.find_all_by_parameters('ParamTask', param1='foo')
+        self.assertEqual('2017-01-01 01:00:00', str(task_record.updated))
+        page, cursor = history.find_runs_page('ParamTask', {'param1': 'foo', 'param2': '1'}, exact=True)
+        self.assertEqual([task_record.id], [task.id for task in page])
+        page, cursor = history.find_runs_page('ParamTask', {'param1': 'foo1099'}, exact=True)
+        self.assertEqual([1099], [task.id for task in page])
+
+        indexes = [index['name'] for index in sqlalchemy.inspect(engine).get_indexes('tasks')]
+        self.assertIn('ix_tasks_name_updated', indexes)
+        self.assertIn('ix_tasks_name_param_hash', indexes)
+
+    def add_run(self, name, *events):
+        with self.history._session() as session:
+            task_record = TaskRecord(task_id=name, name=name, updated=events[-1][1])
+            task_record.parameters['foo'] = TaskParameter(name='foo', value='bar')
+            for (event_name, ts) in events:
+                task_record.events.append(TaskEvent(event_name=event_name, ts=ts))
+            session.add(task_record)
+
+    def test_compact(self):
+        old = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=40), datetime.time(10))
+        minute = datetime.timedelta(minutes=1)
+        self.add_run('A', (PENDING, old), (RUNNING, old), (DONE, old + minute))
+        self.add_run('A', (RUNNING, old), (FAILED, old + 3 * minute))
+        self.add_run('A', (FAILED, old))
+        self.add_run('B', (RUNNING, old + 14 * 60 * minute), (DONE, old + 14 * 60 * minute + 2 * minute))  # the next day
+        self.add_run('B', (RUNNING, old + 5 * minute))  # still running
+        self.run_task(DummyTask())
+
+        self.assertEqual(8, self.history.compact(30))
+        self.assertEqual(0, self.history.compact(30))
+
+        with self.history._session() as session:
+            self.assertEqual(['B', 'DummyTask'], sorted(task.name for task in session.query(TaskRecord)))
+            self.assertEqual(4, session.query(TaskEvent).count())
+            self.assertEqual(2, session.query(TaskParameter).count())
+            stats = dict(((row.name, row.day), row.as_dict()) for row in session.query(TaskStats))
+        self.assertEqual({
+            ('A', old.date()): dict(runs=3, failures=2, timed_runs=2, runtime_p50=180.0, runtime_p95=180.0, runtime_max=180.0),
+            ('B', old.date() + datetime.timedelta(days=1)): dict(
+                runs=1, failures=0, timed_runs=1, runtime_p50=120.0, runtime_p95=120.0, runtime_max=120.0),
+        }, stats)
+
+        stats = self.history.find_task_stats(days=60)
+        self.assertEqual(['A', 'B', 'DummyTask'], [day_stats['name'] for day_stats in stats])
+        self.assertEqual(1, stats[2]['runs'])
+        self.assertEqual(datetime.date.today(), stats[2]['day'])
+        self.assertEqual(['B'], [day_stats['name'] for day_stats in self.history.find_task_stats('B', days=60)])
+        self.assertEqual(['DummyTask'], [day_stats['name'] for day_stats in self.history.find_task_stats(days=1)])
+
+    def test_runtime_estimates(self):
+        for (ago, runtime) in ((1, 10), (1, 20), (2, 60)):
+            start = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=ago), datetime.time(12))
+            self.add_run('A', (RUNNING, start), (DONE, start + datetime.timedelta(seconds=runtime)))
+        self.add_run('B', (FAILED, datetime.datetime.now()))
+        # Medians of 20 and 60 seconds, the first day has twice as many runs
+        self.assertEqual(['A'], list(self.history.runtime_estimates()))
+        self.assertAlmostEqual(100.0 / 3, self.history.runtime_estimates()['A'])
+        # 95th percentiles of 20 and 60 seconds
+        self.assertAlmostEqual(100.0 / 3, self.history.runtime_estimates(percentile=95)['A'])
+        self.assertRaises(ValueError, self.history.runtime_estimates, percentile=90)
+
+    def test_record_deleted_by_compact(self):
+        task = self.run_task(DummyTask())
+        with self.history._session() as session:
+            session.query(TaskEvent).delete()
+            session.query(TaskParameter).delete()
+            session.query(TaskRecord).delete()
+
+        self.history.task_started(task, 'hostname')
+        self.history.flush()
+        [task_record] = self.history.find_all_by_name('DummyTask')
+        self.assertEqual([RUNNING], [event.event_name for event in task_record.events])
+        self.assertEqual(1, len(task_record.parameters))
+
+    def test_cmdline(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        @with_config(dict(task_history=dict(db_connection='sqlite:///' + path)))
+        def run(*argv):
+            with mock.patch('sys.stdout') as stdout:
+                luigi.cmdline.luigi_history(list(argv))
+            return ''.join(call[1][0] for call in stdout.write.mock_calls)
+
+        self.history = with_config(dict(task_history=dict(db_connection='sqlite:///' + path)))(DbTaskHistory)()
+        self.run_task(DummyTask())
+        self.assertIn('Rolled up and deleted 0 events older than 30 days', run('compact'))
+        self.assertIn('DummyTask', run('stats', '--days', '1'))
+
+    @with_config(dict(task_history=dict(db_connection='sqlite:///:memory:', writer_queue_size='1', writer_queue_timeout='0')))
+    def test_full_queue_drops_events(self):
+        history = DbTaskHistory()
+        writing, resume = threading.Event(), threading.Event()
+
+        def write_events(events):
+            writing.set()
+            resume.wait()
+
+        with mock.patch.object(history, '_write_events', side_effect=write_events) as written:
+            task = luigi.scheduler.Task('DummyTask()', PENDING, [], family='DummyTask', params={},
+                                        retry_policy=luigi.scheduler._get_empty_retry_policy())
+            history.task_scheduled(task)
+            writing.wait()
+            history.task_started(task, 'hostname')  # waits in the queue
+            history.task_finished(task, successful=True)  # dropped
+            history.task_finished(task, successful=True)  # dropped without waiting
+            resume.set()
+            history.flush()
+            self.assertEqual(2, history.writer_stats()['dropped'])
+
+            # The queue drained, so events are recorded again
+            history.task_started(task, 'hostname')
+            history.flush()
+        self.assertEqual(2, history.writer_stats()['dropped'])
+        self.assertEqual([PENDING, RUNNING, RUNNING],
+                         [event[1] for call in written.call_args_list for event in call[0][0]])
+
+    @with_config(dict(task_history=dict(db_connection='sqlite:///:memory:', writer_queue_size='1',
+                                        writer_queue_timeout='60', writer_flush_timeout='0.1')))
+    def test_stuck_writer(self):
+        history = DbTaskHistory()
+        writing, resume = threading.Event(), threading.Event()
+
+        def write_events(events):
+            writing.set()
+            resume.wait()
+
+        with mock.patch.object(history, '_write_events', side_effect=write_events):
+            task = luigi.scheduler.Task('DummyTask()', PENDING, [], family='DummyTask', params={},
+                                        retry_policy=luigi.scheduler._get_empty_retry_policy())
+            history.task_scheduled(task)
+            writing.wait()
+            history.task_started(task, 'hostname')  # waits in the queue
+            history.flush()  # gives up after writer_flush_timeout
+            resume.set()
+        history.flush()
+
+    @with_config(dict(task_history=dict(db_connection='sqlite:///:memory:', background_writes='false')))
+    def test_foreground_writes(self):
+        self.history = DbTaskHistory()
+        self.history.task_scheduled(luigi.scheduler.Task('DummyTask()', PENDING, [], family='DummyTask', params={},
+                                                         retry_policy=luigi.scheduler._get_empty_retry_policy()))
+        [task_record] = self.history.find_all_by_name('DummyTask')
+        self.assertEqual([PENDING], [event.event_name for event in task_record.events])
 
 
 class MySQLDbTaskHistoryTest(unittest.TestCase):
@@ -139,3 +362,4 @@ class MySQLDbTaskHistoryTest(unittest.TestCase):
         self.history.task_scheduled(task2)
         self.history.task_started(task2, 'hostname')
         self.history.task_finished(task2, successful=True)
+        self.history.flush()
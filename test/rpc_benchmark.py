@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2017 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Measure the latency and the bytes on the wire of the RPC transport.
+
+Starts a scheduler server in another process and talks to it the way a worker
+does: ``add_task`` for every task, a ``get_work`` and a ``ping`` per task, then
+``graph`` for the whole graph. This is done once per transport, each with a
+fresh server:
+
+* ``urlopen``: the transport rpc.py had before, a new connection per call and
+  no compression.
+* ``urllib``: :py:class:`~luigi.rpc.URLLibFetcher`, pooled and gzipped.
+* ``requests-plain``: a requests session without request compression, as before.
+* ``requests``: :py:class:`~luigi.rpc.RequestsFetcher`, pooled and gzipped.
+
+Not collected as a test, run it directly (Python 3 only)::
+
+    python test/rpc_benchmark.py --tasks 2000
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+import luigi.configuration
+import luigi.rpc
+import luigi.server
+
+
+class LegacyURLLibFetcher(object):
+    raises = luigi.rpc.URLLibFetcher.raises
+
+    def fetch(self, full_url, body, timeout):
+        body = urlencode(body).encode('utf-8')
+        return urlopen(full_url, body, timeout).read().decode('utf-8')
+
+
+class LegacyRequestsFetcher(object):
+    def __init__(self, session):
+        from requests import exceptions as requests_exceptions
+        self.raises = requests_exceptions.RequestException
+        self.session = session
+
+    def fetch(self, full_url, body, timeout):
+        resp = self.session.get(full_url, data=body, timeout=timeout)
+        resp.raise_for_status()
+        return resp.text
+
+
+def make_fetcher(transport):
+    if transport == 'urlopen':
+        return LegacyURLLibFetcher()
+    if transport == 'urllib':
+        return luigi.rpc.URLLibFetcher()
+    import requests
+    if transport == 'requests-plain':
+        return LegacyRequestsFetcher(requests.Session())
+    return luigi.rpc.RequestsFetcher(requests.Session())
+
+
+class WireCounter(object):
+    """
+    Count the bytes sent and received by the sockets of this process.
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self._sendall = socket.socket.sendall
+        self._recv_into = socket.socket.recv_into
+
+    def __enter__(self):
+        counter = self
+
+        def sendall(sock, data, *args):
+            counter.sent += len(data)
+            return counter._sendall(sock, data, *args)
+
+        def recv_into(sock, buf, *args):
+            received = counter._recv_into(sock, buf, *args)
+            counter.received += received
+            return received
+
+        socket.socket.sendall = sendall
+        socket.socket.recv_into = recv_into
+        return self
+
+    def __exit__(self, *exc_info):
+        socket.socket.sendall = self._sendall
+        socket.socket.recv_into = self._recv_into
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(port):
+    process = multiprocessing.Process(target=luigi.server.run, kwargs={'api_port': port, 'address': '127.0.0.1'})
+    process.start()
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except socket.error:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError('Scheduler server did not start')
+
+
+def calls(num_tasks):
+    """
+    Yield the RPC method and arguments of each call a worker scheduling ``num_tasks`` tasks makes.
+    """
+    for i in range(num_tasks):
+        deps = ['Task_%d' % j for j in range(max(0, i - 3), i)]
+        params = {'date': '2017-01-%02d' % (i % 28 + 1), 'shard': str(i), 'path': '/data/shard/%d/' % i * 4}
+        yield 'add_task', dict(worker='W', task_id='Task_%d' % i, deps=deps, family='Task',
+                               module='benchmark.module', params=params, status='PENDING', runnable=True)
+    for i in range(num_tasks):
+        yield 'get_work', dict(worker='W', host='benchmark', current_tasks=[])
+        yield 'ping', dict(worker='W')
+    yield 'graph', {}
+
+
+def run(transport, num_tasks):
+    port = free_port()
+    process = start_server(port)
+    try:
+        sch = luigi.rpc.RemoteScheduler('http://127.0.0.1:%d' % port)
+        sch._fetcher = make_fetcher(transport)
+        latencies = {}
+        with WireCounter() as counter:
+            start = time.time()
+            for method, kwargs in calls(num_tasks):
+                call_start = time.time()
+                getattr(sch, method)(**kwargs)
+                latencies.setdefault(method, []).append(time.time() - call_start)
+            elapsed = time.time() - start
+    finally:
+        process.terminate()
+        process.join()
+    return elapsed, latencies, counter
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=2000)
+    parser.add_argument('--transports', nargs='+', default=['urlopen', 'urllib', 'requests-plain', 'requests'])
+    args = parser.parse_args()
+
+    state_path = tempfile.mktemp(suffix='.pickle')
+    luigi.configuration.get_config().set('scheduler', 'state_path', state_path)
+    luigi.configuration.get_config().set('scheduler', 'record_task_history', 'false')
+
+    print('%-15s %8s %8s %10s %10s %12s %12s' % (
+        'transport', 'total', 'calls', 'mean ms', 'p99 ms', 'sent', 'received'))
+    for transport in args.transports:
+        elapsed, latencies, counter = run(transport, args.tasks)
+        all_latencies = [latency for method_latencies in latencies.values() for latency in method_latencies]
+        print('%-15s %7.1fs %8d %10.2f %10.2f %12d %12d' % (
+            transport, elapsed, len(all_latencies),
+            1000 * sum(all_latencies) / len(all_latencies), 1000 * percentile(all_latencies, 0.99),
+            counter.sent, counter.received))
+        for method in sorted(latencies):
+            print('  %-13s %18d %10.2f %10.2f' % (
+                method, len(latencies[method]),
+                1000 * sum(latencies[method]) / len(latencies[method]), 1000 * percentile(latencies[method], 0.99)))
+
+    if os.path.exists(state_path):
+        os.unlink(state_path)
+
+
+if __name__ == '__main__':
+    main()
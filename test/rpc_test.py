@@ -22,10 +22,12 @@ except ImportError:
     import mock
 
 import luigi.rpc
+from luigi.six.moves.urllib.error import HTTPError, URLError
 from luigi.scheduler import Scheduler
 import scheduler_api_test
 import luigi.server
 from server_test import ServerTestBase
+import json
 import time
 import socket
 
@@ -87,6 +89,68 @@ class RemoteSchedulerTest(unittest.TestCase):
         fetch_results = ['{"response": null}'] * 3 + ['{"response": {}}']
         self.assertRaises(luigi.rpc.RPCError, self.get_work, fetch_results)
 
+    def test_get_work_waits_longer_for_long_poll(self):
+        scheduler = luigi.rpc.RemoteScheduler('http://zorg.com', 42)
+        with mock.patch.object(scheduler, '_fetcher') as fetcher:
+            fetcher.fetch.return_value = '{"response": {}}'
+            scheduler.get_work(worker='fake_worker', wait=5)
+        (url, body, timeout), _ = fetcher.fetch.call_args
+        self.assertEqual(47, timeout)
+        self.assertEqual(5, json.loads(body['data'])['wait'])
+
+    @mock.patch('luigi.rpc.time.sleep')
+    @mock.patch('luigi.rpc.random.uniform', side_effect=lambda low, high: high)
+    def test_retry_backoff(self, uniform, sleep):
+        """
+        Tests that the waits between attempts double, up to rpc-retry-max-wait, with jitter
+        """
+        scheduler = luigi.rpc.RemoteScheduler('http://zorg.com', 42)
+        with mock.patch.object(scheduler, '_fetcher') as fetcher:
+            fetcher.raises = socket.timeout
+            fetcher.fetch.side_effect = [socket.timeout, socket.timeout, '{"response": {}}']
+            scheduler.ping(worker='fake_worker')
+        self.assertEqual([mock.call(15.0, 30), mock.call(30.0, 60)], uniform.call_args_list)
+
+        scheduler._failed_attempts = 10
+        scheduler._wait()
+        self.assertEqual(mock.call(150.0, 300), uniform.call_args)
+
+    def test_circuit_breaker(self):
+        """
+        Tests that requests fail fast after three failed requests in a row, until rpc-circuit-breaker-timeout passed
+        """
+        scheduler = luigi.rpc.RemoteScheduler('http://zorg.com', 42)
+        scheduler._wait = lambda: None
+        with mock.patch.object(scheduler, '_fetcher') as fetcher:
+            fetcher.raises = socket.timeout
+            fetcher.fetch.side_effect = socket.timeout
+            for _ in range(4):
+                self.assertRaises(luigi.rpc.RPCError, scheduler.ping, worker='fake_worker')
+            self.assertEqual(9, fetcher.fetch.call_count)
+
+            fetcher.fetch.side_effect = None
+            fetcher.fetch.return_value = '{"response": {}}'
+            with mock.patch('luigi.rpc.time.time', return_value=time.time() + 61):
+                scheduler.ping(worker='fake_worker')
+            scheduler.ping(worker='fake_worker')
+            self.assertEqual(11, fetcher.fetch.call_count)
+
+    def test_add_tasks_falls_back_to_add_task(self):
+        """
+        Tests that add_tasks sends one add_task per task to schedulers without add_tasks, and remembers it
+        """
+        scheduler = luigi.rpc.RemoteScheduler('http://zorg.com', 42)
+        not_found = HTTPError('http://zorg.com/api/add_tasks', 404, 'Not Found', {}, None)
+
+        with mock.patch.object(scheduler, '_fetcher') as fetcher:
+            fetcher.raises = URLError
+            fetcher.fetch.side_effect = [not_found] + ['{"response": null}'] * 3
+            scheduler.add_tasks('fake_worker', [{'task_id': 'A'}, {'task_id': 'B'}])
+            scheduler.add_tasks('fake_worker', [{'task_id': 'C'}])
+
+        urls = [args[0] for args, kwargs in fetcher.fetch.call_args_list]
+        self.assertEqual(['http://zorg.com/api/add_tasks'] + ['http://zorg.com/api/add_task'] * 3, urls)
+
 
 class RPCTest(scheduler_api_test.SchedulerApiTest, ServerTestBase):
 
@@ -16,13 +16,14 @@
 #
 
 import itertools
+import json
 import mock
 import time
 from helpers import unittest
 from nose.plugins.attrib import attr
 import luigi.notifications
 from luigi.scheduler import DISABLED, DONE, FAILED, PENDING, \
-    UNKNOWN, RUNNING, BATCH_RUNNING, UPSTREAM_RUNNING, Scheduler
+    UNKNOWN, RUNNING, BATCH_RUNNING, UPSTREAM_RUNNING, UPSTREAM_FAILED, Scheduler
 
 luigi.notifications.DEBUG = True
 WORKER = 'myworker'
@@ -65,6 +66,15 @@ class SchedulerApiTest(unittest.TestCase):
         self.sch.add_task(worker=WORKER, task_id='B', status=DONE)
         self.assertEqual(self.sch.get_work(worker=WORKER)['task_id'], None)
 
+    def test_add_tasks(self):
+        self.sch.add_tasks(worker=WORKER, tasks=[
+            {'task_id': 'B', 'deps': ['A']},
+            {'task_id': 'A'},
+            {'task_id': 'A', 'status': DONE},
+        ])
+        self.assertEqual(self.sch.get_work(worker=WORKER)['task_id'], 'B')
+        self.assertEqual({'A': DONE}, {task_id: t['status'] for task_id, t in self.sch.task_list(DONE, '').items()})
+
     def test_failed_dep(self):
         self.sch.add_task(worker=WORKER, task_id='B', deps=('A',))
         self.sch.add_task(worker=WORKER, task_id='A')
@@ -182,6 +192,36 @@ class SchedulerApiTest(unittest.TestCase):
         self.assertEqual({'a': ['1', '2', '3']}, response['task_params'])
         self.assertEqual('A', response['task_family'])
 
+    def test_get_work_slots(self):
+        for task_id in 'ABC':
+            self.sch.add_task(worker=WORKER, task_id=task_id)
+        self.assertNotIn('tasks', self.sch.get_work(worker=WORKER))
+
+        response = self.sch.get_work(worker=WORKER, slots=3)
+        self.assertEqual(response['task_id'], response['tasks'][0]['task_id'])
+        self.assertEqual(['B', 'C'], sorted(work['task_id'] for work in response['tasks']))
+        self.assertEqual(['A', 'B', 'C'], sorted(self.sch.task_list(RUNNING, '')))
+        self.assertEqual([], self.sch.get_work(worker=WORKER, slots=3)['tasks'])
+
+    def test_get_work_slots_share_resources(self):
+        self.sch.update_resources(r=2)
+        self.sch.add_task(worker=WORKER, task_id='A', resources={'r': 1}, priority=3)
+        self.sch.add_task(worker=WORKER, task_id='B', resources={'r': 2}, priority=2)
+        self.sch.add_task(worker=WORKER, task_id='C', resources={'r': 1}, priority=1)
+        response = self.sch.get_work(worker=WORKER, slots=3)
+        self.assertEqual(['A', 'C'], [work['task_id'] for work in response['tasks']])
+
+    def test_get_work_slots_with_batch(self):
+        self.sch.add_task_batcher(worker=WORKER, task_family='A', batched_args=['a'])
+        self.sch.add_task(worker=WORKER, task_id='A_a_1', family='A', params={'a': '1'}, batchable=True)
+        self.sch.add_task(worker=WORKER, task_id='A_a_2', family='A', params={'a': '2'}, batchable=True)
+        self.sch.add_task(worker=WORKER, task_id='B', family='B')
+
+        batch, work = self.sch.get_work(worker=WORKER, slots=3)['tasks']
+        self.assertEqual(['A_a_1', 'A_a_2'], batch['batch_task_ids'])
+        self.assertEqual({'a': ['1', '2']}, batch['task_params'])
+        self.assertEqual('B', work['task_id'])
+
     def test_batch_time_running(self):
         self.setTime(1234)
         self.sch.add_task_batcher(worker=WORKER, task_family='A', batched_args=['a'])
@@ -311,6 +351,19 @@ class SchedulerApiTest(unittest.TestCase):
             self.assertEqual({'a': a, 'b': ['2', '1'], 'c': c}, response['task_params'])
             self.assertEqual('A', response['task_family'])
 
+    def test_get_work_group_on_all_non_batch_params(self):
+        self.sch.add_task_batcher(worker=WORKER, task_family='A', batched_args=['b'])
+        self.sch.add_task(worker=WORKER, task_id='A_1_1', family='A', params={'a': '1', 'b': '1'},
+                          batchable=True, priority=3)
+        self.sch.add_task(worker=WORKER, task_id='A_1_2_1', family='A', params={'a': '1', 'b': '2', 'c': '1'},
+                          batchable=True, priority=2)
+        self.sch.add_task(worker=WORKER, task_id='A_1_3', family='A', params={'a': '1', 'b': '3'},
+                          batchable=True, priority=1)
+
+        response = self.sch.get_work(worker=WORKER)
+        self.assertEqual({'a': '1', 'b': ['1', '3']}, response['task_params'])
+        self.assertEqual('A_1_2_1', self.sch.get_work(worker=WORKER)['task_id'])
+
     def test_get_work_multiple_batched_params(self):
         self.sch.add_task_batcher(worker=WORKER, task_family='A', batched_args=['a', 'b'])
         self.sch.add_task(
@@ -1039,6 +1092,21 @@ class SchedulerApiTest(unittest.TestCase):
         self.sch.update_resources(R1=1)
         self.assertFalse(self.sch.get_work(worker='Y')['task_id'])
 
+    def test_resources_of_running_task_whose_dep_is_done_again(self):
+        self.sch.update_resources(R1=1)
+        self.sch.add_task(worker='X', task_id='B', status=DONE)
+        self.sch.add_task(worker='X', task_id='A', deps=['B'], resources={'R1': 1})
+        self.assertEqual(self.sch.get_work(worker='X')['task_id'], 'A')
+
+        self.sch.add_task(worker='Y', task_id='B', status=PENDING)
+        self.sch.add_task(worker='Y', task_id='B', status=DONE)
+        self.assertEqual({'R1': 1}, self.sch._state.get_used_resources())
+
+        self.sch.add_task(worker='X', task_id='A', status=DONE)
+        self.assertEqual({}, self.sch._state.get_used_resources())
+        self.sch.add_task(worker='Y', task_id='C', resources={'R1': 1})
+        self.assertEqual(self.sch.get_work(worker='Y')['task_id'], 'C')
+
     def test_scheduler_overprovisioned_on_other_resource(self):
         self.sch.add_task(worker='X', task_id='A', resources={'R1': 2})
         self.sch.update_resources(R1=2)
@@ -1535,6 +1603,92 @@ class SchedulerApiTest(unittest.TestCase):
         self.assertEqual({'num_tasks': 4}, sch.task_list('DONE', ''))
         self.assertEqual(set('ABCD'), set(sch.task_list('DONE', '', max_shown_tasks=4).keys()))
 
+    def test_task_list_beyond_limit_with_search(self):
+        sch = Scheduler(max_shown_tasks=2)
+        for task_id in ('A1', 'A2', 'A3', 'B1'):
+            sch.add_task(worker=WORKER, task_id=task_id, family=task_id[0], params={'n': task_id[1]})
+        self.assertEqual({'num_tasks': 3}, sch.task_list('PENDING', '', search='A'))
+        self.assertEqual({'A1', 'B1'}, set(sch.task_list('PENDING', '', search='n=1').keys()))
+
+    def test_task_list_count_only(self):
+        for task_id in 'ABC':
+            self.sch.add_task(worker=WORKER, task_id=task_id)
+        self.sch.add_task(worker=WORKER, task_id='D', deps=['E'])
+        self.sch.add_task(worker=WORKER, task_id='E', status=FAILED)
+        self.assertEqual({'num_tasks': 4}, self.sch.task_list('PENDING', '', count_only=True))
+        self.assertEqual({'num_tasks': 5}, self.sch.task_list('', '', count_only=True))
+        self.assertEqual({'num_tasks': 1}, self.sch.task_list('PENDING', UPSTREAM_FAILED, count_only=True))
+        self.assertEqual({'num_tasks': 2}, self.sch.task_list('', UPSTREAM_FAILED, count_only=True))
+        self.assertEqual({'num_tasks': 0}, self.sch.task_list(DISABLED, '', count_only=True))
+
+    def test_task_list_pages(self):
+        for i, task_id in enumerate('CADBE'):
+            self.setTime(i)
+            self.sch.add_task(worker=WORKER, task_id=task_id)
+        self.sch.add_task(worker=WORKER, task_id='F', status=DONE)
+
+        pages, cursor = [], None
+        while True:
+            response = json.loads(json.dumps(self.sch.task_list('PENDING', '', page_size=2, cursor=cursor)))
+            pages.append(sorted(response['tasks'], key=lambda task_id: response['tasks'][task_id]['last_updated']))
+            cursor = response['cursor']
+            if cursor is None:
+                break
+        self.assertEqual([['C', 'A'], ['D', 'B'], ['E']], pages)
+
+        # Pages ignore max_shown_tasks, and tasks are ordered by status first
+        self.assertEqual(['F'], list(self.sch.task_list('', '', page_size=1, max_shown_tasks=1)['tasks']))
+
+    def test_worker_list_pages(self):
+        for i, worker in enumerate(['X', 'Y', 'Z']):
+            self.setTime(i)
+            self.sch.add_worker(worker, {})
+        self.setTime(3)
+        self.assertEqual(['Z', 'Y', 'X'], [worker['name'] for worker in self.sch.worker_list()])
+
+        response = self.sch.worker_list(page_size=2)
+        self.assertEqual(['Z', 'Y'], [worker['name'] for worker in response['workers']])
+        response = self.sch.worker_list(page_size=2, cursor=response['cursor'])
+        self.assertEqual(['X'], [worker['name'] for worker in response['workers']])
+        self.assertIsNone(response['cursor'])
+
+    def test_graph_changes(self):
+        self.sch.add_task(worker=WORKER, task_id='A', deps=['B'])
+        self.sch.add_task(worker=WORKER, task_id='B')
+        self.sch.add_task(worker=WORKER, task_id='C')
+        first = self.sch.graph_changes()
+        self.assertTrue(first['reset'])
+
+        self.sch.add_task(worker=WORKER, task_id='B', status=DONE)
+        self.sch.add_task(worker=WORKER, task_id='C', priority=5)
+        self.sch.add_task(worker=WORKER, task_id='D', deps=['A'])
+        changes = self.sch.graph_changes(since=first['version'])
+        self.assertFalse(changes['reset'])
+        self.assertEqual({'B', 'C', 'D'}, set(changes['tasks']))
+        self.assertEqual(DONE, changes['tasks']['B']['status'])
+        self.assertEqual(5, changes['tasks']['C']['priority'])
+        self.assertEqual(['A'], changes['tasks']['D']['deps'])
+        self.assertEqual([], changes['removed'])
+
+        self.sch.add_task(worker=WORKER, task_id='D', deps=['A'])
+        self.assertEqual({}, self.sch.graph_changes(since=changes['version'])['tasks'])
+
+    def test_graph_changes_removed(self):
+        self.setTime(0)
+        self.sch.add_task(worker=WORKER, task_id='A')
+        version = self.sch.graph_changes()['version']
+        self.setTime(100)
+        self.sch.prune()  # the worker is gone, A will be removed
+        self.setTime(2000)
+        self.sch.prune()
+
+        changes = self.sch.graph_changes(since=version)
+        self.assertEqual({}, changes['tasks'])
+        self.assertEqual(['A'], changes['removed'])
+
+    def test_graph_changes_unknown_version(self):
+        self.assertTrue(self.sch.graph_changes(since='0123abcd:0')['reset'])
+
     def add_task(self, family, **params):
         task_id = str(hash((family, str(params))))  # use an unhelpful task id
         self.sch.add_task(worker=WORKER, family=family, params=params, task_id=task_id)
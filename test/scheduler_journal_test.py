@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2017 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import os
+import shutil
+import tempfile
+from helpers import unittest
+
+import luigi.scheduler
+from luigi import scheduler_journal
+
+
+class SchedulerJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.state_path = os.path.join(self.tempdir, 'state')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def start_scheduler(self):
+        sch = luigi.scheduler.Scheduler(state_path=self.state_path)
+        sch.load()
+        return sch
+
+    def journal_files(self):
+        return sorted(name for name in os.listdir(self.tempdir) if '.journal.' in name)
+
+    def test_replay_without_dump(self):
+        sch = self.start_scheduler()
+        sch.add_task(worker='X', task_id='A', deps=['B'], family='F', params={'p': '1'})
+        sch.add_task(worker='X', task_id='B')
+        sch.add_task_batcher(worker='X', task_family='F', batched_args=['p'])
+        self.assertEqual('B', sch.get_work(worker='X')['task_id'])
+        sch.add_task(worker='X', task_id='B', status='DONE')
+        # no dump, as if the scheduler crashed
+
+        sch = self.start_scheduler()
+        self.assertEqual('DONE', sch._state.get_task('B').status)
+        self.assertEqual({'p': '1'}, sch._state.get_task('A').params)
+        self.assertEqual((['p'], float('inf')), sch._state.get_batcher('X', 'F'))
+        self.assertEqual('A', sch.get_work(worker='X')['task_id'])
+
+    def test_replay_removed_tasks_and_workers(self):
+        sch = self.start_scheduler()
+        sch.add_task(worker='X', task_id='A')
+        sch.add_task(worker='Y', task_id='B')
+        sch._state.inactivate_tasks(['A'])
+        sch._state.inactivate_workers(['Y'])
+        sch._state.flush_journal()
+
+        sch = self.start_scheduler()
+        self.assertFalse(sch._state.has_task('A'))
+        self.assertTrue(sch._state.has_task('B'))
+        self.assertEqual(['X'], list(sch._state.get_worker_ids()))
+
+    def test_snapshot_truncates_journal(self):
+        sch = self.start_scheduler()
+        sch.add_task(worker='X', task_id='A')
+        self.assertEqual(['state.journal.1'], self.journal_files())
+
+        sch.snapshot()
+        sch.add_task(worker='X', task_id='B')
+        sch._state._journal.wait()
+        self.assertTrue(scheduler_journal.is_snapshot(self.state_path))
+        self.assertEqual(1, len(self.journal_files()))
+        self.assertNotEqual(['state.journal.1'], self.journal_files())
+
+        sch.dump()
+        self.assertEqual([], self.journal_files())
+        sch.add_task(worker='X', task_id='C')
+        self.assertEqual(1, len(self.journal_files()))
+
+        sch = self.start_scheduler()
+        self.assertTrue(sch._state.has_task('A'))
+        self.assertTrue(sch._state.has_task('B'))
+        self.assertTrue(sch._state.has_task('C'))
+
+    def test_dump_without_journal_writes_snapshot(self):
+        sch = luigi.scheduler.Scheduler(state_path=self.state_path)
+        sch.add_task(worker='X', task_id='A')
+        sch.dump()
+        self.assertTrue(scheduler_journal.is_snapshot(self.state_path))
+        self.assertEqual([], self.journal_files())
+
+        self.assertTrue(self.start_scheduler()._state.has_task('A'))
+
+    def test_truncated_last_record_is_dropped(self):
+        sch = self.start_scheduler()
+        sch.add_task(worker='X', task_id='A')
+        with open(self.state_path + '.journal.1', 'a') as fobj:
+            fobj.write('[1000, "task", {"id": "B"')
+
+        sch = self.start_scheduler()
+        self.assertTrue(sch._state.has_task('A'))
+        self.assertFalse(sch._state.has_task('B'))
+        sch.add_task(worker='X', task_id='C')
+
+        sch = self.start_scheduler()
+        self.assertTrue(sch._state.has_task('C'))
+
+    def test_newer_version_is_refused(self):
+        with open(self.state_path, 'w') as fobj:
+            fobj.write(json.dumps({'format': scheduler_journal.SNAPSHOT_FORMAT, 'version': 1000, 'sequence': 0}) + '\n')
+            fobj.write(json.dumps(['worker', {'id': 'X'}]) + '\n')
+        self.assertRaises(scheduler_journal.StateFormatError, scheduler_journal.read_snapshot, self.state_path)
+
+        sch = self.start_scheduler()
+        self.assertEqual([], list(sch._state.get_worker_ids()))
+
+    def test_corrupt_record_in_middle_is_refused(self):
+        sch = self.start_scheduler()
+        sch.add_task(worker='X', task_id='A')
+        with open(self.state_path + '.journal.1', 'a') as fobj:
+            fobj.write('b0rk\n')
+        sch.add_task(worker='X', task_id='B')
+
+        sch = self.start_scheduler()
+        self.assertFalse(sch._state.has_task('A'))
+        self.assertEqual(['state.journal.1.unreadable'], self.journal_files())
+        sch.add_task(worker='X', task_id='C')
+        self.assertEqual(['state.journal.1.unreadable', 'state.journal.3'], self.journal_files())
+
+        sch = self.start_scheduler()
+        self.assertEqual(['C'], [task.id for task in sch._state.get_active_tasks()])
+
+    def test_unreadable_snapshot_is_moved_away(self):
+        sch = self.start_scheduler()
+        sch.add_task(worker='X', task_id='A')
+        sch.dump()
+        with open(self.state_path, 'a') as fobj:
+            fobj.write('b0rk\n')
+        sch.add_task(worker='X', task_id='B')
+
+        sch = self.start_scheduler()
+        self.assertEqual([], list(sch._state.get_active_tasks()))
+        self.assertTrue(os.path.exists(self.state_path + '.unreadable'))
+        self.assertFalse(os.path.exists(self.state_path))
+        self.assertEqual(1, len(self.journal_files()))
+        self.assertTrue(self.journal_files()[0].endswith('.unreadable'))
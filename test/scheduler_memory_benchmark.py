@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2017 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Measure how much memory the scheduler needs per task.
+
+Adds a large graph of tasks to a :py:class:`~luigi.scheduler.Scheduler` the way
+workers do, then prints the bytes allocated per task and the size of the pickled
+state per task. Not collected as a test, run it directly (Python 3 only)::
+
+    python test/scheduler_memory_benchmark.py --tasks 1000000
+
+With ``--shared-params`` the tasks of different families get the same params,
+which the scheduler stores once.
+"""
+
+import argparse
+import gc
+import pickle
+import time
+import tracemalloc
+
+import luigi.scheduler
+
+
+def task_id(i, num_families):
+    return 'Family%d_%d_%s' % (i % num_families, i, '0123456789abcdef' * 2)
+
+
+def add_tasks(sch, num_tasks, num_workers, num_families, shared_params=False):
+    for i in range(num_tasks):
+        family = 'Family%d' % (i % num_families)
+        # With shared_params every family has a task for each shard, like a pipeline run per shard
+        shard = i // num_families if shared_params else i
+        params = {'date': '2017-01-%02d' % (shard % 28 + 1), 'shard': str(shard)}
+        deps = [task_id(i - num_families, num_families)] if i >= num_families else []
+        sch.add_task(worker='worker-%d' % (i % num_workers), task_id=task_id(i, num_families), deps=deps,
+                     family=family, module='benchmark.module', params=params,
+                     resources={'cpu': 1} if i % 10 == 0 else None, priority=i % 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=1000000)
+    parser.add_argument('--workers', type=int, default=100)
+    parser.add_argument('--families', type=int, default=50)
+    parser.add_argument('--shared-params', action='store_true',
+                        help='give tasks of different families the same params')
+    args = parser.parse_args()
+
+    sch = luigi.scheduler.Scheduler()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.time()
+    add_tasks(sch, args.tasks, args.workers, args.families, args.shared_params)
+    elapsed = time.time() - start
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    pickled = len(pickle.dumps(sch._state.get_state(), protocol=pickle.HIGHEST_PROTOCOL))
+
+    print('tasks:               %d' % args.tasks)
+    print('add_task time:       %.1fs' % elapsed)
+    print('memory per task:     %d bytes' % (used // args.tasks))
+    print('pickled per task:    %d bytes' % (pickled // args.tasks))
+
+
+if __name__ == '__main__':
+    main()
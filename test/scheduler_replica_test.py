@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2017 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import os
+import shutil
+import tempfile
+
+import tornado.testing
+from tornado.testing import gen_test
+
+import luigi.scheduler
+import luigi.server
+from luigi.scheduler_replica import SchedulerReplica
+from luigi.six.moves.urllib.parse import urlencode
+
+
+class SchedulerReplicaTest(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(SchedulerReplicaTest, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.replicas = []
+
+    def tearDown(self):
+        for replica in self.replicas:
+            replica.stop()
+        super(SchedulerReplicaTest, self).tearDown()
+
+    def start(self, staleness=0, **kwargs):
+        self.sch = luigi.scheduler.Scheduler(state_path=os.path.join(self.tempdir, 'state'),
+                                             query_replica_staleness=staleness, **kwargs)
+        self.sch.load()
+        self.sch.add_task(worker='X', task_id='A', family='A', deps=['B'])
+        self.sch.add_task(worker='X', task_id='B', family='B', status='DONE')
+        replica = SchedulerReplica(self.sch)
+        replica.start()
+        self.replicas.append(replica)
+        return replica
+
+    @gen_test
+    def test_answers_from_state(self):
+        replica = self.start()
+        self.assertEqual(['A'], list((yield replica.query('task_list', {'status': 'PENDING'}))))
+        self.assertEqual(['B'], list((yield replica.query('task_list', {'status': 'DONE'}))))
+        self.assertEqual(['A', 'B'], sorted((yield replica.query('dep_graph', {'task_id': 'A'}))))
+
+    @gen_test
+    def test_follows_changes(self):
+        replica = self.start()
+        self.sch.add_task(worker='X', task_id='C')
+        self.sch.add_task(worker='X', task_id='A', status='DONE')
+        self.sch._state.inactivate_tasks(['B'])
+        self.sch._state.flush_journal()
+
+        self.assertEqual(['C'], list((yield replica.query('task_list', {'status': 'PENDING'}))))
+        self.assertEqual(['A'], list((yield replica.query('task_list', {'status': 'DONE'}))))
+
+    @gen_test
+    def test_graph_changes(self):
+        replica = self.start()
+        version = (yield replica.query('graph_changes', {}))['version']
+        self.sch.add_task(worker='X', task_id='A', status='DONE')
+        self.sch._state.inactivate_tasks(['B'])
+        self.sch._state.flush_journal()
+
+        changes = yield replica.query('graph_changes', {'since': version})
+        self.assertEqual({'A': 'DONE'}, dict((task_id, task['status']) for task_id, task in changes['tasks'].items()))
+        self.assertEqual(['B'], changes['removed'])
+
+    @gen_test
+    def test_staleness(self):
+        replica = self.start(staleness=3600)
+        self.assertEqual(['A'], list((yield replica.query('task_list', {'status': 'PENDING'}))))
+        self.sch.add_task(worker='X', task_id='C')
+        self.assertEqual(['A'], list((yield replica.query('task_list', {'status': 'PENDING'}))))
+
+    @gen_test
+    def test_does_not_prune(self):
+        replica = self.start(remove_delay=0)
+        self.sch._state.inactivate_workers(['X'])
+        self.sch._state.flush_journal()
+        self.assertEqual(['A'], list((yield replica.query('task_list', {'status': 'PENDING'}))))
+
+        # The scheduler's own prune removes the tasks, and the replica follows
+        self.assertEqual([], list(self.sch.task_list('PENDING', '')))
+        self.assertEqual([], list((yield replica.query('task_list', {'status': 'PENDING'}))))
+
+    @gen_test
+    def test_sqlite_state_store(self):
+        replica = self.start(state_store='sqlite', state_cache_size=0)
+        self.assertNotIn('B', self.sch._state._tasks)
+        self.assertEqual(['B'], list((yield replica.query('task_list', {'status': 'DONE'}))))
+        self.sch._state._store.close()
+
+    @gen_test
+    def test_errors(self):
+        replica = self.start()
+        with self.assertRaises(TypeError):
+            yield replica.query('dep_graph', {})
+
+
+class ReplicaServerTest(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.sch = luigi.scheduler.Scheduler(state_path=os.path.join(self.tempdir, 'state'),
+                                             query_replica=True, query_replica_staleness=3600)
+        self.sch.load()
+        self.sch.add_task(worker='X', task_id='A')
+        self.replica = SchedulerReplica(self.sch)
+        self.replica.start()
+        return luigi.server.app(self.sch, self.replica)
+
+    def tearDown(self):
+        self.replica.stop()
+        shutil.rmtree(self.tempdir)
+        super(ReplicaServerTest, self).tearDown()
+
+    def rpc(self, method, **kwargs):
+        response = self.fetch('/api/{}?{}'.format(method, urlencode({'data': json.dumps(kwargs)})))
+        return json.loads(response.body.decode('utf-8'))['response']
+
+    def test_queries_go_to_replica(self):
+        self.sch.add_task(worker='X', task_id='B')
+        self.assertEqual(['A'], list(self.rpc('task_list', status='PENDING')))
+        self.assertEqual(['A', 'B'], sorted(self.sch.task_list('PENDING', '')))
+
+    def test_other_calls_go_to_scheduler(self):
+        self.rpc('add_task', worker='X', task_id='B')
+        self.assertEqual(2, self.rpc('count_pending', worker='X')['n_pending_tasks'])
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2017 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import itertools
+from helpers import unittest
+
+import luigi.scheduler
+from luigi.rpc import ShardedRemoteScheduler
+from luigi.scheduler_sharding import HashRing
+
+SHARD_URLS = ['http://shard0:8082/', 'http://shard1:8082/']
+
+
+class HashRingTest(unittest.TestCase):
+    def test_same_shard_for_same_key(self):
+        ring = HashRing(3)
+        for i in range(100):
+            self.assertEqual(ring.get_shard('Task_%d' % i), HashRing(3).get_shard('Task_%d' % i))
+
+    def test_keys_are_spread_over_shards(self):
+        ring = HashRing(3)
+        counts = [0, 0, 0]
+        for i in range(3000):
+            counts[ring.get_shard('Task_%d' % i)] += 1
+        for count in counts:
+            self.assertGreater(count, 700)
+
+    def test_added_shard_only_takes_keys(self):
+        ring, bigger_ring = HashRing(3), HashRing(4)
+        for i in range(1000):
+            key = 'Task_%d' % i
+            self.assertIn(bigger_ring.get_shard(key), (ring.get_shard(key), 3))
+
+    def test_unicode_keys(self):
+        self.assertIn(HashRing(2).get_shard(u'Task_\xe9'), (0, 1))
+
+
+class ShardedSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.shards = [luigi.scheduler.Scheduler(shard_urls=SHARD_URLS, shard=i, disable_persist=10, retry_count=3)
+                       for i in range(len(SHARD_URLS))]
+        self.sch = ShardedRemoteScheduler(self.shards)
+        self.ring = HashRing(len(SHARD_URLS))
+        self.counter = itertools.count()
+
+    def task_on(self, shard, prefix='Task'):
+        while True:
+            task_id = '%s_%d' % (prefix, next(self.counter))
+            if self.ring.get_shard(task_id) == shard:
+                return task_id
+
+    def sync(self):
+        # What luigi.server.sync_shard_statuses does over HTTP
+        for sch in self.shards:
+            for shard, task_ids in sch.foreign_dependencies().items():
+                sch.update_foreign_statuses(self.shards[shard].get_task_statuses(task_ids))
+
+    def test_add_task_goes_to_owning_shard(self):
+        a, b = self.task_on(0), self.task_on(1)
+        self.sch.add_task(worker='X', task_id=a)
+        self.sch.add_task(worker='X', task_id=b)
+        self.assertEqual({a: 'PENDING'}, self.shards[0].get_task_statuses([a, b]))
+        self.assertEqual({b: 'PENDING'}, self.shards[1].get_task_statuses([a, b]))
+
+    def test_add_tasks_go_to_owning_shards(self):
+        a, b, c = self.task_on(0), self.task_on(1), self.task_on(0)
+        self.sch.add_tasks(worker='X', tasks=[{'task_id': a}, {'task_id': b}, {'task_id': c, 'status': 'DONE'}])
+        self.assertEqual({a: 'PENDING', c: 'DONE'}, self.shards[0].get_task_statuses([a, b, c]))
+        self.assertEqual({b: 'PENDING'}, self.shards[1].get_task_statuses([a, b, c]))
+
+    def test_get_work_asks_every_shard(self):
+        self.sch.add_task(worker='X', task_id=self.task_on(1))
+        for _ in range(2):
+            reply = self.sch.get_work(worker='X')
+            if reply['task_id'] is not None:
+                break
+        self.assertEqual(1, self.ring.get_shard(reply['task_id']))
+
+    def test_pending_counts_add_up(self):
+        self.sch.add_task(worker='X', task_id=self.task_on(0), deps=[self.task_on(0)])
+        self.sch.add_task(worker='X', task_id=self.task_on(1), deps=[self.task_on(1)])
+        reply = self.sch.get_work(worker='X')
+        self.assertIsNone(reply['task_id'])
+        self.assertEqual(2, reply['n_pending_tasks'])
+        self.assertEqual(2, self.sch.count_pending(worker='X')['n_pending_tasks'])
+
+    def test_dependency_on_other_shard(self):
+        a, b = self.task_on(0), self.task_on(1)
+        self.sch.add_task(worker='X', task_id=a, deps=[b])
+        self.sch.add_task(worker='X', task_id=b)
+        self.assertEqual({1: [b]}, self.shards[0].foreign_dependencies())
+
+        self.assertEqual(b, self.sch.get_work(worker='X')['task_id'])
+        self.sch.add_task(worker='X', task_id=b, status='DONE')
+        self.assertIsNone(self.sch.get_work(worker='X')['task_id'])
+
+        self.sync()
+        self.assertEqual({}, self.shards[0].foreign_dependencies())
+        self.assertEqual(a, self.sch.get_work(worker='X')['task_id'])
+
+    def test_failed_dependency_on_other_shard(self):
+        a, b = self.task_on(0), self.task_on(1)
+        self.sch.add_task(worker='X', task_id=a, deps=[b])
+        self.sch.add_task(worker='X', task_id=b, status='FAILED')
+        self.sync()
+        self.assertEqual({b: 'FAILED'}, self.shards[0].get_task_statuses([b]))
+        self.assertEqual('UPSTREAM_FAILED', self.shards[0]._upstream_status(a))
+        self.assertEqual({1: [b]}, self.shards[0].foreign_dependencies())
+        self.assertIsNone(self.sch.get_work(worker='X')['task_id'])
+
+        # Failures are only counted, and retried, by the shard owning the task
+        self.shards[0].prune()
+        self.assertEqual(0, self.shards[0]._state.get_task(b).failures.num_failures())
+
+        self.sch.add_task(worker='X', task_id=b, status='DISABLED')
+        self.sync()
+        self.assertEqual('UPSTREAM_DISABLED', self.shards[0]._upstream_status(a))
+
+        self.sch.add_task(worker='X', task_id=b, status='PENDING')
+        self.sync()
+        self.assertEqual({b: 'UNKNOWN'}, self.shards[0].get_task_statuses([b]))
+        self.sch.add_task(worker='X', task_id=b, status='DONE')
+        self.sync()
+        self.assertEqual(a, self.sch.get_work(worker='X')['task_id'])
+
+    def test_own_tasks_are_not_updated_from_other_shards(self):
+        a, b = self.task_on(0), self.task_on(0)
+        self.sch.add_task(worker='X', task_id=a, deps=[b])
+        self.shards[0].update_foreign_statuses({b: 'DONE'})
+        self.assertEqual({b: 'UNKNOWN'}, self.shards[0].get_task_statuses([b]))
+
+    def test_batch_stays_on_its_shard(self):
+        self.sch.add_task_batcher(worker='X', task_family='A', batched_args=['a'])
+        tasks = [self.task_on(1, 'A'), self.task_on(1, 'A')]
+        for task_id in tasks:
+            self.sch.add_task(worker='X', task_id=task_id, family='A', params={'a': task_id}, batchable=True)
+        for _ in range(2):
+            reply = self.sch.get_work(worker='X')
+            if 'batch_id' in reply:
+                break
+        self.assertEqual(sorted(tasks), sorted(reply['batch_task_ids']))
+
+        batch_task = self.task_on(0, 'A')
+        self.sch.add_task(worker='X', task_id=batch_task, family='A', params={'a': 'both'},
+                          status='RUNNING', batch_id=reply['batch_id'])
+        self.sch.set_task_status_message(batch_task, 'halfway')
+        self.sch.add_task(worker='X', task_id=batch_task, status='DONE')
+
+        self.assertEqual({}, self.shards[0].get_task_statuses([batch_task]))
+        self.assertEqual(dict.fromkeys(tasks, 'DONE'), self.shards[1].get_task_statuses(tasks))
+        self.assertEqual('halfway', self.shards[1].get_task_status_message(tasks[0])['statusMessage'])
+
+    def test_worker_messages_are_sent_once(self):
+        self.sch.add_worker('X', {'workers': 1})
+        self.sch.set_worker_processes('X', 2)
+        self.assertEqual([{'name': 'set_worker_processes', 'kwargs': {'n': 2}}],
+                         self.sch.ping(worker='X')['rpc_messages'])
+
+    def test_disabled_worker(self):
+        self.sch.add_task(worker='X', task_id=self.task_on(1))
+        self.sch.disable_worker('X')
+        self.assertEqual('disabled', self.sch.count_pending(worker='X')['worker_state'])
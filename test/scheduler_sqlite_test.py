@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012-2017 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import mock
+import os
+import shutil
+import sqlite3
+import tempfile
+from helpers import unittest
+
+import luigi.scheduler
+from luigi import scheduler_sqlite
+from luigi.scheduler_journal import StateFormatError
+
+
+class SqliteTaskStateTest(unittest.TestCase):
+    def setUp(self):
+        self.time = 1000.0
+        patcher = mock.patch('time.time', side_effect=lambda: self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tempdir = tempfile.mkdtemp()
+        self.state_path = os.path.join(self.tempdir, 'state.db')
+        self.sch = self.start_scheduler()
+
+    def tearDown(self):
+        self.sch._state._store.close()
+        shutil.rmtree(self.tempdir)
+
+    def start_scheduler(self, cache_size=1):
+        sch = luigi.scheduler.Scheduler(state_path=self.state_path, state_store='sqlite',
+                                        state_cache_size=cache_size)
+        sch.load()
+        return sch
+
+    def restart(self):
+        self.sch._state._store.close()
+        self.sch = self.start_scheduler()
+
+    def in_memory(self, task_id):
+        return task_id in self.sch._state._tasks
+
+    def add_done_tasks(self, *task_ids):
+        for task_id in task_ids:
+            self.sch.add_task(worker='X', task_id=task_id, status='DONE')
+
+    def test_idle_done_tasks_are_evicted(self):
+        self.add_done_tasks('A', 'B', 'C')
+        self.sch.add_task(worker='X', task_id='D')
+        self.assertFalse(self.in_memory('A'))
+        self.assertFalse(self.in_memory('B'))
+        self.assertTrue(self.in_memory('C'))
+        self.assertTrue(self.in_memory('D'))
+
+        self.assertTrue(self.sch._state.has_task('A'))
+        self.assertEqual('DONE', self.sch._state.get_task('A').status)
+        self.assertEqual(['A', 'B', 'C'], sorted(self.sch.task_list('DONE', '')))
+
+    def test_evicted_tasks_are_searched(self):
+        for task_id in 'ABC':
+            self.sch.add_task(worker='X', task_id=task_id, family='Foo', params={'p': task_id}, status='DONE')
+        self.sch.add_task(worker='X', task_id='D', family='Foo', params={'p': 'D'})
+        self.assertFalse(self.in_memory('A'))
+        self.assertEqual(['A', 'B', 'C', 'D'], sorted(self.sch.task_list('', '', search='Foo')))
+        self.assertEqual(['A'], sorted(self.sch.task_list('DONE', '', search='p=A')))
+        self.assertEqual(['D'], sorted(self.sch.task_list('PENDING', '', search='Foo')))
+
+    def test_evicted_tasks_are_counted(self):
+        self.add_done_tasks('A', 'B', 'C')
+        self.sch.add_task(worker='X', task_id='D')
+        self.assertEqual({'num_tasks': 3}, self.sch.task_list('DONE', '', count_only=True))
+        self.assertEqual({'num_tasks': 4}, self.sch.task_list('', '', count_only=True))
+        self.assertEqual({'num_tasks': 1}, self.sch.task_list('PENDING', '', count_only=True))
+        self.assertEqual({'num_tasks': 3}, self.sch.task_list('DONE', '', max_shown_tasks=2))
+
+    def test_cached_changed_and_removed_tasks_are_counted_once(self):
+        self.sch._state._cache_size = 2
+        self.add_done_tasks('A', 'B', 'C', 'D')
+        state = self.sch._state
+        self.assertEqual(['C', 'D'], list(state._idle_tasks))
+        self.assertEqual(4, state.num_active_tasks('DONE'))
+
+        # Changes that aren't flushed to the database yet
+        state.set_status(state.get_task('C'), 'PENDING')
+        state.inactivate_tasks(['D'])
+        state.set_status(state.get_task('A'), 'PENDING')
+        self.assertFalse(state.has_task('D'))
+        self.assertEqual(1, state.num_active_tasks('DONE'))
+        self.assertEqual(3, state.num_active_tasks())
+
+        state.flush_journal()
+        self.assertEqual(1, state.num_active_tasks('DONE'))
+        self.assertEqual(3, state.num_active_tasks())
+
+    def test_restart_only_loads_tasks_that_need_attention(self):
+        self.add_done_tasks('A', 'B')
+        self.sch.add_task(worker='X', task_id='C', deps=['A'])
+        self.sch.add_worker('X', {'host': 'foo'})
+        self.restart()
+
+        self.assertFalse(self.in_memory('A'))
+        self.assertFalse(self.in_memory('B'))
+        self.assertTrue(self.in_memory('C'))
+        self.assertEqual('foo', self.sch._state.get_worker('X').info['host'])
+        self.assertEqual('C', self.sch.get_work(worker='X')['task_id'])
+
+    def test_dependency_on_evicted_task_is_met(self):
+        self.add_done_tasks('A', 'B')
+        self.assertFalse(self.in_memory('A'))
+        self.sch.add_task(worker='Y', task_id='C', deps=['A'])
+        self.assertEqual('C', self.sch.get_work(worker='Y')['task_id'])
+
+    def test_rescheduled_evicted_task(self):
+        self.add_done_tasks('A', 'B')
+        self.sch.add_task(worker='X', task_id='C', deps=['A'])
+        self.sch.add_task(worker='X', task_id='A', status='PENDING')
+        self.assertEqual('A', self.sch.get_work(worker='X')['task_id'])
+
+    def test_evicted_tasks_are_pruned_with_their_stakeholder(self):
+        self.sch._config.worker_disconnect_delay = 10
+        self.sch._config.remove_delay = 10
+        self.add_done_tasks('A', 'B')
+        self.sch.add_task(worker='Y', task_id='C')
+        self.assertFalse(self.in_memory('A'))
+
+        for _ in range(2):
+            self.time += 11
+            self.sch.add_task(worker='Y', task_id='C')
+            self.sch.prune()
+
+        self.assertFalse(self.sch._state.has_task('A'))
+        self.assertFalse(self.sch._state.has_task('B'))
+        self.restart()
+        self.assertFalse(self.sch._state.has_task('A'))
+        self.assertTrue(self.sch._state.has_task('C'))
+
+    def test_evicted_task_forgets_removed_workers(self):
+        self.sch.add_task(worker='X', task_id='A', status='DONE')
+        self.sch.add_task(worker='Y', task_id='A', status='DONE')
+        self.add_done_tasks('B')
+        self.sch.disable_worker('Y')
+        self.assertFalse(self.in_memory('A'))
+        self.assertEqual(['X'], list(self.sch._state.get_task('A').workers))
+
+    def test_dump_without_load(self):
+        sch = luigi.scheduler.Scheduler(state_path=os.path.join(self.tempdir, 'other.db'), state_store='sqlite')
+        sch.add_task(worker='X', task_id='A')
+        sch.dump()
+
+        store = scheduler_sqlite.SqliteStateStore(os.path.join(self.tempdir, 'other.db'))
+        self.assertEqual(['A'], [payload['id'] for kind, payload in store.load() if kind == 'task'])
+        store.close()
+
+    def test_unreadable_database_is_moved_away(self):
+        path = os.path.join(self.tempdir, 'broken.db')
+        with open(path, 'w') as fobj:
+            fobj.write('b0rk' * 1000)
+        sch = luigi.scheduler.Scheduler(state_path=path, state_store='sqlite')
+        sch.load()
+        self.assertTrue(os.path.exists(path + '.unreadable'))
+        sch.add_task(worker='X', task_id='A')
+        self.assertTrue(sch._state._store.has_task('A'))
+        sch._state._store.close()
+
+    def test_newer_version_is_refused(self):
+        path = os.path.join(self.tempdir, 'newer.db')
+        scheduler_sqlite.SqliteStateStore(path).close()
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute("UPDATE meta SET value = '1000' WHERE key = 'version'")
+        connection.close()
+        self.assertRaises(StateFormatError, scheduler_sqlite.SqliteStateStore, path)
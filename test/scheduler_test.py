@@ -16,12 +16,17 @@
 #
 from __future__ import print_function
 
+import collections
+import mock
+import os
 import pickle
+import shutil
 import tempfile
 import time
 from helpers import unittest
 
 import luigi.scheduler
+import luigi.task_history
 from helpers import with_config
 
 
@@ -44,15 +49,22 @@ class SchedulerIoTest(unittest.TestCase):
                              set(['Worker1', 'Worker2']))
 
     def test_load_broken_state(self):
-        with tempfile.NamedTemporaryFile(delete=True) as fn:
-            with open(fn.name, 'w') as fobj:
+        tempdir = tempfile.mkdtemp()
+        try:
+            state_path = os.path.join(tempdir, 'state')
+            with open(state_path, 'w') as fobj:
                 print("b0rk", file=fobj)
 
             state = luigi.scheduler.SimpleTaskState(
-                state_path=fn.name)
+                state_path=state_path)
             state.load()  # bad if this crashes
 
             self.assertEqual(list(state.get_worker_ids()), [])
+            self.assertFalse(os.path.exists(state_path))
+            with open(state_path + '.unreadable') as fobj:
+                self.assertEqual("b0rk\n", fobj.read())
+        finally:
+            shutil.rmtree(tempdir)
 
     @with_config({'scheduler': {'retry_count': '44', 'worker-disconnect-delay': '55'}})
     def test_scheduler_with_config(self):
@@ -99,6 +111,63 @@ class SchedulerIoTest(unittest.TestCase):
             scheduler = reload_from_disk(scheduler=scheduler)
             self.assertEqual(scheduler.get_work(worker='D')['task_id'], '4')
 
+    def test_dump_and_load_compact_tasks(self):
+        scheduler = luigi.scheduler.Scheduler(retry_count=5)
+        scheduler.add_task(worker='X', task_id='A', deps=['B', 'C'], family='F', params={'p': '1'})
+        scheduler.add_task(worker='Y', task_id='A')
+        scheduler.add_task(worker='X', task_id='D', status='FAILED')
+        scheduler.add_worker('X', {'host': 'foo'})
+
+        with tempfile.NamedTemporaryFile(delete=True) as fn:
+            scheduler._state._state_path = fn.name
+            scheduler.dump()
+            scheduler = luigi.scheduler.Scheduler(retry_count=5)
+            scheduler._state._state_path = fn.name
+            scheduler.load()
+
+        task = scheduler._state.get_task('A')
+        self.assertEqual(('B', 'C'), task.deps)
+        self.assertEqual(['X', 'Y'], list(task.workers))
+        self.assertEqual({'X', 'Y'}, task.stakeholders)
+        self.assertEqual({'p': '1'}, task.params)
+        self.assertIsNone(task.expl)
+        self.assertEqual(1, scheduler._state.get_task('D').failures.num_failures())
+        self.assertEqual('foo', scheduler._state.get_worker('X').info['host'])
+
+    def test_equal_params_are_shared(self):
+        scheduler = luigi.scheduler.Scheduler()
+        scheduler.add_task(worker='X', task_id='A', family='F', params={'date': '2017-01-01'})
+        scheduler.add_task(worker='X', task_id='B', family='G', params={'date': '2017-01-01'})
+        scheduler.add_task(worker='X', task_id='C', family='G', params={'date': '2017-01-02'})
+        scheduler.add_task(worker='X', task_id='D', family='H', params={'dates': ['2017-01-01']})
+        a, b, c, d = (scheduler._state.get_task(task_id) for task_id in 'ABCD')
+        self.assertIs(a.params, b.params)
+        self.assertIsNot(a.params, c.params)
+        self.assertEqual({'dates': ['2017-01-01']}, d.params)
+
+        params = pickle.loads(pickle.dumps(a.params))
+        self.assertEqual(dict, type(params))
+        self.assertEqual({'date': '2017-01-01'}, params)
+
+    def test_load_task_pickled_before_slots(self):
+        retry_policy = luigi.scheduler._get_empty_retry_policy()
+        failures = luigi.scheduler.Failures.__new__(luigi.scheduler.Failures)
+        failures.__setstate__({'window': 10, 'failures': collections.deque([1.0]), 'first_failure_time': 1.0})
+
+        task = luigi.scheduler.Task.__new__(luigi.scheduler.Task)
+        task.__setstate__({
+            'id': 'A', 'status': 'PENDING', 'deps': set(['B']), 'stakeholders': set(['X']),
+            'workers': luigi.scheduler.OrderedSet(['X', 'Y']), 'retry_policy': retry_policy,
+            'failures': failures, 'family': 'F', 'params': {'p': '1'},
+        })
+
+        self.assertEqual(('B',), task.deps)
+        self.assertEqual('Y', task.workers.peek())
+        self.assertIsNone(task.module)
+        self.assertFalse(task.batchable)
+        self.assertEqual({}, task.resources)
+        self.assertEqual(10, task.failures.window)
+
     def test_worker_prune_after_init(self):
         """
         See https://github.com/spotify/luigi/pull/1019
@@ -242,3 +311,677 @@ class SchedulerWorkerTest(unittest.TestCase):
 
         non_trivial_worker = scheduler_state.get_worker('NON_TRIVIAL')
         self.assertEqual({'A'}, self.get_pending_ids(non_trivial_worker, scheduler_state))
+
+
+class SchedulerReadyQueueTest(unittest.TestCase):
+    def ranked_ids(self, sch):
+        return [task.id for task in sch._state.get_ranked_tasks()]
+
+    def sorted_ids(self, sch):
+        def deps_done(task):
+            return all(sch._state.has_task(dep) and sch._state.get_task(dep).status == 'DONE' for dep in task.deps)
+        tasks = [task for task in sch._state.get_active_tasks_by_status('PENDING', 'RUNNING')
+                 if task.status == 'RUNNING' or deps_done(task)]
+        tasks.sort(key=sch._rank, reverse=True)
+        return [task.id for task in tasks]
+
+    def test_ranked_tasks_match_sorted_rank(self):
+        sch = luigi.scheduler.Scheduler()
+        sch.add_task(worker='X', task_id='A', priority=1, resources={'r': 1})
+        sch.add_task(worker='X', task_id='B', priority=5)
+        sch.add_task(worker='X', task_id='C', priority=1, resources={'s': 2})
+        sch.add_task(worker='X', task_id='D', deps=['E'], priority=3)
+        sch.add_task(worker='X', task_id='F', status='DONE', priority=10)
+        self.assertEqual(self.sorted_ids(sch), self.ranked_ids(sch))
+
+        self.assertEqual('B', sch.get_work(worker='X')['task_id'])
+        sch.add_task(worker='Y', task_id='C', priority=7)
+        sch.add_task(worker='X', task_id='A', resources={'s': 1})
+        self.assertEqual(self.sorted_ids(sch), self.ranked_ids(sch))
+
+        sch.add_task(worker='X', task_id='B', status='DONE')
+        self.assertEqual(self.sorted_ids(sch), self.ranked_ids(sch))
+        self.assertNotIn('B', self.ranked_ids(sch))
+
+    def test_ranked_tasks_tie_order(self):
+        sch = luigi.scheduler.Scheduler()
+        with mock.patch('time.time', return_value=1):
+            for task_id in 'ABCDE':
+                sch.add_task(worker='X', task_id=task_id, resources={'r': ord(task_id) % 2})
+            sch.add_task(worker='X', task_id='C', status='RUNNING')
+            sch.add_task(worker='X', task_id='C', status='FAILED')
+            sch.add_task(worker='X', task_id='C', status='PENDING')
+            sch.add_task(worker='X', task_id='B', status='RUNNING')
+        # sorted_ids can't be compared here, its order among tied tasks follows dict iteration order
+        self.assertEqual(['A', 'D', 'E', 'C', 'B'], self.ranked_ids(sch))
+
+    def test_ranked_tasks_rebuilt_on_load(self):
+        sch = luigi.scheduler.Scheduler()
+        sch.add_task(worker='X', task_id='A', priority=1)
+        sch.add_task(worker='X', task_id='B', priority=2)
+        sch.add_task(worker='X', task_id='C', priority=3, status='DONE')
+
+        with tempfile.NamedTemporaryFile(delete=True) as fn:
+            sch._state._state_path = fn.name
+            sch.dump()
+            sch = luigi.scheduler.Scheduler()
+            sch._state._state_path = fn.name
+            sch.load()
+        self.assertEqual(['B', 'A'], self.ranked_ids(sch))
+
+    def test_unmet_deps_follow_dependency_status(self):
+        sch = luigi.scheduler.Scheduler()
+        sch.add_task(worker='X', task_id='A', deps=['B', 'C'])
+        sch.add_task(worker='X', task_id='B')
+        sch.add_task(worker='X', task_id='C')
+        self.assertEqual(['B', 'C'], sorted(self.ranked_ids(sch)))
+
+        sch.add_task(worker='X', task_id='B', status='DONE')
+        self.assertEqual(['C'], self.ranked_ids(sch))
+        sch.add_task(worker='X', task_id='C', status='DONE')
+        self.assertEqual(['A'], self.ranked_ids(sch))
+
+        # A dependency that is no longer done makes the task unschedulable again
+        sch.add_task(worker='X', task_id='C', status='PENDING')
+        self.assertEqual(['C'], self.ranked_ids(sch))
+        sch.add_task(worker='X', task_id='C', status='DONE')
+        sch.add_task(worker='X', task_id='A', new_deps=['D'])
+        sch.add_task(worker='X', task_id='D')
+        self.assertEqual(['D'], self.ranked_ids(sch))
+
+    def test_unmet_deps_on_inactivated_dependency(self):
+        sch = luigi.scheduler.Scheduler()
+        sch.add_task(worker='X', task_id='A', deps=['B'])
+        sch.add_task(worker='X', task_id='B', status='DONE')
+        self.assertEqual(['A'], self.ranked_ids(sch))
+        self.assertEqual({'A'}, sch._state.get_dependents('B'))
+
+        sch._state.inactivate_tasks(['B'])
+        self.assertEqual([], self.ranked_ids(sch))
+        self.assertEqual({'A'}, sch._state.get_dependents('B'))
+
+        sch._state.inactivate_tasks(['A'])
+        self.assertEqual(set(), sch._state.get_dependents('B'))
+
+
+class SchedulerIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.sch = luigi.scheduler.Scheduler()
+        self.state = self.sch._state
+
+    def task_ids(self, tasks):
+        return sorted(task.id for task in tasks)
+
+    def test_worker_tasks_by_status(self):
+        self.sch.add_task(worker='X', task_id='A')
+        self.sch.add_task(worker='X', task_id='B', deps=['C'])
+        self.sch.add_task(worker='Y', task_id='C')
+        self.sch.add_task(worker='X', task_id='D', status='DONE')
+
+        self.assertEqual(['A', 'B'], self.task_ids(self.state.get_worker_tasks('X', 'PENDING')))
+        self.assertEqual(['C'], self.task_ids(self.state.get_worker_tasks('Y', 'PENDING')))
+
+        self.assertEqual('C', self.sch.get_work(worker='Y')['task_id'])
+        self.assertEqual(['C'], self.task_ids(self.state.get_worker_tasks('Y', 'RUNNING')))
+        self.assertEqual(['C'], self.task_ids(self.state.get_running_tasks('Y')))
+
+        self.sch.add_task(worker='Y', task_id='C', status='DONE')
+        self.assertEqual([], self.task_ids(self.state.get_running_tasks('Y')))
+        self.assertEqual(['C'], self.task_ids(self.state.get_worker_tasks('Y', 'DONE')))
+
+    def test_inactivate_workers_only_touches_their_tasks(self):
+        self.sch.add_task(worker='X', task_id='A', deps=['B'])
+        self.sch.add_task(worker='Y', task_id='B')
+        self.sch.add_task(worker='Y', task_id='C')
+
+        self.state.inactivate_workers(['X'])
+
+        self.assertEqual(set(), self.state.get_task('A').stakeholders)
+        self.assertEqual(set(), set(self.state.get_task('A').workers))
+        self.assertEqual({'Y'}, self.state.get_task('B').stakeholders)
+        self.assertEqual({'Y'}, set(self.state.get_task('B').workers))
+        self.assertEqual([], self.task_ids(self.state.get_worker_tasks('X', 'PENDING')))
+        self.assertEqual(['B', 'C'], self.task_ids(self.state.get_worker_tasks('Y', 'PENDING')))
+
+    def test_disable_workers_keeps_stakeholders(self):
+        self.sch.add_task(worker='X', task_id='A')
+        self.sch.disable_worker('X')
+        self.assertEqual({'X'}, self.state.get_task('A').stakeholders)
+        self.assertEqual(set(), set(self.state.get_task('A').workers))
+
+    def test_batch_tasks(self):
+        self.sch.add_task_batcher(worker='X', task_family='F', batched_args=['p'])
+        for p in ('1', '2', '3'):
+            self.sch.add_task(worker='X', task_id='F_%s' % p, family='F', params={'p': p}, batchable=True)
+        response = self.sch.get_work(worker='X')
+        batch_id = response['batch_id']
+        self.assertEqual(['F_1', 'F_2', 'F_3'], self.task_ids(self.state.get_batch_running_tasks(batch_id)))
+
+        self.sch.add_task(worker='X', task_id='F_1_2_3', family='F', params={'p': '1,2,3'},
+                          status='RUNNING', batch_id=batch_id)
+        self.assertEqual(['F_1', 'F_2', 'F_3'], self.task_ids(self.state.get_batch_running_tasks(batch_id)))
+
+        self.sch.add_task(worker='X', task_id='F_1_2_3', status='DONE')
+        self.assertEqual([], self.task_ids(self.state.get_batch_running_tasks(batch_id)))
+        self.assertEqual(['F_1', 'F_1_2_3', 'F_2', 'F_3'], self.task_ids(self.state.get_worker_tasks('X', 'DONE')))
+
+    def test_used_resources(self):
+        self.sch.update_resources(r=3, s=1)
+        self.sch.add_task(worker='X', task_id='A', resources={'r': 2})
+        self.sch.add_task(worker='X', task_id='B', resources={'r': 1, 's': 1})
+        self.assertEqual({}, self.state.get_used_resources())
+
+        self.assertEqual('A', self.sch.get_work(worker='X')['task_id'])
+        self.assertEqual('B', self.sch.get_work(worker='X')['task_id'])
+        self.assertEqual({'r': 3, 's': 1}, self.state.get_used_resources())
+
+        self.sch.add_task(worker='X', task_id='A', status='DONE')
+        self.assertEqual({'r': 1, 's': 1}, self.state.get_used_resources())
+        self.sch.add_task(worker='X', task_id='B', resources={'r': 1})
+        self.assertEqual({'r': 1}, self.state.get_used_resources())
+        self.sch.add_task(worker='X', task_id='B', status='FAILED')
+        self.assertEqual({}, self.state.get_used_resources())
+
+    def test_ranked_tasks_skip_saturated_resources(self):
+        self.sch.add_task(worker='X', task_id='A', priority=3, resources={'r': 1})
+        self.sch.add_task(worker='X', task_id='B', priority=2, resources={'s': 1})
+        self.sch.add_task(worker='X', task_id='C', priority=1, resources={'r': 1})
+        self.sch.add_task(worker='X', task_id='D', priority=0)
+
+        skipped = []
+
+        def skip_resources(resources):
+            skipped.append(resources)
+            return 'r' in resources
+
+        self.assertEqual(['B', 'D'], [task.id for task in self.state.get_ranked_tasks(skip_resources)])
+        self.assertEqual([{'r': 1}, {'s': 1}], skipped)
+
+    def batch_candidates(self, task_id):
+        return [task.id for task in self.state.get_batch_candidates(self.state.get_task(task_id), ['d'])]
+
+    def add_batchable_task(self, task_id, priority=0, **params):
+        self.sch.add_task(worker='X', task_id=task_id, family='F', params=params, priority=priority, batchable=True)
+
+    def test_batch_candidates(self):
+        self.sch.add_task_batcher(worker='X', task_family='F', batched_args=['d'])
+        self.add_batchable_task('A', d='1', p='x')
+        self.add_batchable_task('B', d='2', p='x', priority=1)
+        self.add_batchable_task('C', d='3', p='y')
+        self.add_batchable_task('D', d='4', p='x')
+        self.sch.add_task(worker='X', task_id='E', family='F', params={'d': '5', 'p': 'x'})
+        self.sch.add_task(worker='X', task_id='G', family='G', params={'d': '6', 'p': 'x'}, batchable=True)
+
+        self.assertEqual(['A', 'D'], self.batch_candidates('B'))
+        self.assertEqual(['D'], self.batch_candidates('A'))
+        self.assertEqual([], self.batch_candidates('C'))
+
+        self.sch.add_task(worker='X', task_id='E', batchable=True)
+        self.sch.add_task(worker='X', task_id='D', deps=['H'])
+        self.assertEqual(['A', 'E'], self.batch_candidates('B'))
+
+        self.assertEqual(['B', 'A', 'E'], self.sch.get_work(worker='X')['batch_task_ids'])
+        self.assertEqual(['C'], [task.id for group in self.state._batch_groups.values() for task in group])
+
+    def test_batch_candidates_for_new_batcher(self):
+        self.add_batchable_task('A', d='1', p='x')
+        self.add_batchable_task('B', d='2', p='x')
+        self.assertEqual({}, self.state._batch_groups)
+
+        self.sch.add_task_batcher(worker='X', task_family='F', batched_args=['d'])
+        self.assertEqual(['B'], self.batch_candidates('A'))
+
+    def test_batch_candidates_after_load(self):
+        self.sch.add_task_batcher(worker='X', task_family='F', batched_args=['d'])
+        self.add_batchable_task('A', d='1', p='x')
+        self.add_batchable_task('B', d='2', p='x')
+        with tempfile.NamedTemporaryFile(delete=True) as fn:
+            self.state._state_path = fn.name
+            self.sch.dump()
+            self.sch = luigi.scheduler.Scheduler()
+            self.sch._state._state_path = fn.name
+            self.sch.load()
+        self.state = self.sch._state
+        self.assertEqual(['B'], self.batch_candidates('A'))
+
+    def search(self, search, status=None):
+        return self.task_ids(self.state.search_tasks(search.split(), status))
+
+    def test_search_tasks(self):
+        self.sch.add_task(worker='X', task_id='A', family='Foo', params={'a': 'xyz', 'b': '1'})
+        self.sch.add_task(worker='X', task_id='B', family='Foo', params={'a': 'abc', 'b': '1'}, status='DONE')
+        self.sch.add_task(worker='X', task_id='C', family='Bar', params={'a': 'xyzzy'})
+
+        self.assertEqual(['A', 'C'], self.search('xyz'))
+        self.assertEqual(['A', 'B'], self.search('Foo(a='))
+        self.assertEqual(['A'], self.search('xyz b=1'))
+        self.assertEqual(['A', 'B', 'C'], self.search('a'))
+        self.assertEqual(['A', 'C'], self.search('y'))
+        self.assertEqual(['B'], self.search('abc,'))
+        self.assertEqual(['A'], self.search('z, b=1)'))
+        self.assertEqual(['B'], self.search('Foo', 'DONE'))
+        self.assertEqual([], self.search('xyzw'))
+
+    def test_search_index_follows_tasks(self):
+        self.sch.add_task(worker='X', task_id='A', deps=['B'], family='Foo', params={'a': 'xyz'})
+        self.assertEqual([], self.search('Bar'))
+
+        # Dependencies are created without family and params until they're added themselves
+        self.sch.add_task(worker='X', task_id='B', priority=1)
+        self.sch.add_task(worker='X', task_id='B', family='Bar', params={'a': 'xyz'})
+        self.assertEqual(['B'], self.search('Bar'))
+        self.assertEqual('Bar(a=xyz)', self.state.get_task('B').pretty_id)
+
+        self.state.inactivate_tasks(['A'])
+        self.assertEqual(['B'], self.search('xyz'))
+        self.state.inactivate_tasks(['B'])
+        self.assertEqual({}, self.state._search_parts)
+        self.assertEqual({}, self.state._search_trigrams)
+
+    def upstream_status(self, task_id):
+        return self.state.get_upstream_status(self.state.get_task(task_id))
+
+    def test_upstream_status(self):
+        self.sch.add_task(worker='X', task_id='A', deps=['B', 'C'])
+        self.sch.add_task(worker='X', task_id='B', deps=['D'])
+        self.sch.add_task(worker='X', task_id='C', status='DONE')
+        self.sch.add_task(worker='X', task_id='D')
+        self.assertEqual('UPSTREAM_MISSING_INPUT', self.upstream_status('A'))
+
+        self.assertEqual('D', self.sch.get_work(worker='X')['task_id'])
+        self.assertEqual('UPSTREAM_RUNNING', self.upstream_status('A'))
+        self.sch.add_task(worker='X', task_id='D', status='FAILED')
+        self.assertEqual('UPSTREAM_FAILED', self.upstream_status('A'))
+        self.sch.add_task(worker='X', task_id='C', status='DISABLED')
+        self.assertEqual('UPSTREAM_DISABLED', self.upstream_status('A'))
+        self.assertEqual('UPSTREAM_FAILED', self.upstream_status('B'))
+
+        self.sch.add_task(worker='X', task_id='C', status='DONE')
+        self.sch.add_task(worker='X', task_id='D', status='DONE')
+        self.assertEqual('', self.upstream_status('A'))
+        self.sch.add_task(worker='X', task_id='B', new_deps=['E'])
+        self.assertEqual('', self.upstream_status('A'))  # like DONE tasks, missing ones don't hold anything up
+        self.sch.add_task(worker='X', task_id='E')
+        self.assertEqual('UPSTREAM_MISSING_INPUT', self.upstream_status('A'))
+
+    def test_upstream_status_is_kept_until_upstream_status_changes(self):
+        self.sch.add_task(worker='X', task_id='A', deps=['B'])
+        self.sch.add_task(worker='X', task_id='B', deps=['C'])
+        self.sch.add_task(worker='X', task_id='C')
+        self.sch.add_task(worker='X', task_id='D', deps=['C'])
+        self.assertEqual('UPSTREAM_MISSING_INPUT', self.upstream_status('A'))
+        self.assertEqual({'A': 'UPSTREAM_MISSING_INPUT', 'B': 'UPSTREAM_MISSING_INPUT'}, self.state._upstream_statuses)
+
+        # Touching a task without changing its status keeps everything
+        self.sch.add_task(worker='Y', task_id='C')
+        self.assertEqual(['A', 'B'], sorted(self.state._upstream_statuses))
+
+        self.assertEqual('UPSTREAM_MISSING_INPUT', self.upstream_status('D'))
+        self.sch.add_task(worker='X', task_id='A', status='FAILED')
+        self.assertEqual(['B', 'D'], sorted(self.state._upstream_statuses))
+        self.sch.add_task(worker='X', task_id='C', status='FAILED')
+        self.assertEqual({}, self.state._upstream_statuses)
+
+    def test_upstream_status_with_dependency_cycle(self):
+        self.sch.add_task(worker='X', task_id='A', deps=['B'])
+        self.sch.add_task(worker='X', task_id='B', deps=['A', 'C'])
+        self.sch.add_task(worker='X', task_id='C', status='FAILED')
+        self.assertEqual('UPSTREAM_FAILED', self.upstream_status('A'))
+
+    def test_task_changes_are_bounded(self):
+        self.state = luigi.scheduler.SimpleTaskState('', max_task_changes=2)
+        for task_id in 'ABC':
+            self.state.task_changed(task_id)
+        self.assertEqual(['C', 'B'], self.state.get_changed_task_ids(1))
+        self.assertEqual(['C'], self.state.get_changed_task_ids(2))
+        self.assertIsNone(self.state.get_changed_task_ids(0))
+        self.assertIsNone(self.state.get_changed_task_ids(4))
+
+        self.state.task_changed('B')
+        self.assertEqual(['B', 'C'], self.state.get_changed_task_ids(1))
+
+    def test_invalid_page_size(self):
+        # Not in scheduler_api_test since the error doesn't make it through RPC
+        self.assertRaises(ValueError, self.sch.task_list, 'PENDING', '', page_size=0)
+        self.assertRaises(ValueError, self.sch.worker_list, page_size=0)
+
+
+class SchedulerPruneTest(unittest.TestCase):
+    def setUp(self):
+        self.time = 1000.0
+        patcher = mock.patch('time.time', side_effect=lambda: self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_scheduler(self, prune_everything=False):
+        sch = luigi.scheduler.Scheduler(retry_delay=10, remove_delay=100, worker_disconnect_delay=50,
+                                        disable_persist=30, disable_window=100, retry_count=2)
+        if prune_everything:
+            # How prune used to work: look at every task and every worker
+            state = sch._state
+            state.get_prune_candidates = lambda config: list(state.get_active_tasks())
+            state.get_prune_worker_candidates = lambda config: list(state.get_active_workers())
+        return sch
+
+    def snapshot(self, sch):
+        tasks = dict((task.id, (task.status, task.remove, task.retry, task.scheduler_disable_time))
+                     for task in sch._state.get_active_tasks())
+        return tasks, sorted(sch._state.get_worker_ids())
+
+    def test_worker_events(self):
+        sch = self.make_scheduler()
+        events = []
+        sch.add_event_listener(events.append)
+        sch.add_worker('X', {})
+        sch.ping(worker='X')
+        self.time += 60
+        sch.prune()
+        self.assertEqual([('worker_joined', 'X', 1000.0), ('worker_left', 'X', 1060.0)],
+                         [(event['type'], event['worker'], event['time']) for event in events])
+
+    def test_prune_matches_full_scan(self):
+        def scenario(sch):
+            sch.add_task(worker='X', task_id='A', status='FAILED')
+            sch.add_task(worker='X', task_id='B')
+            sch.add_task(worker='Y', task_id='C', deps=['B'])
+            sch.add_task(worker='Y', task_id='D', status='FAILED')
+            sch.add_task(worker='Y', task_id='D', status='FAILED')
+            sch.add_task(worker='Z', task_id='E')
+            sch.get_work(worker='Z')
+            yield
+            self.time += 20  # A and D may be retried, D is still disabled
+            yield
+            sch.ping(worker='X')
+            self.time += 40  # Y and Z timed out, E was running on Z, D is re-enabled
+            yield
+            self.time += 40
+            sch.ping(worker='X')
+            sch.add_task(worker='X', task_id='C')
+            yield
+            self.time += 60  # X timed out
+            yield
+            self.time -= 500  # the clock went backwards
+            sch.add_task(worker='W', task_id='F')
+            yield
+            self.time += 200
+            yield
+
+        def run(sch):
+            self.time = 1000.0
+            snapshots = []
+            for _ in scenario(sch):
+                sch.prune()
+                snapshots.append(self.snapshot(sch))
+            return snapshots
+
+        self.assertEqual(run(self.make_scheduler(prune_everything=True)), run(self.make_scheduler()))
+
+    def test_prune_skips_idle_tasks(self):
+        sch = self.make_scheduler()
+        for i in range(10):
+            sch.add_task(worker='X', task_id=str(i), status='DONE')
+        sch.prune()
+
+        with mock.patch.object(sch._state, 'update_status') as update_status:
+            self.time += 10
+            sch.ping(worker='X')
+            sch.prune()
+            self.assertFalse(update_status.called)
+
+            sch.add_task(worker='X', task_id='F', status='FAILED')
+            self.time += 11
+            sch.prune()
+            self.assertEqual(['F'], [call[0][0].id for call in update_status.call_args_list])
+
+    def test_retry_and_remove_timers(self):
+        sch = self.make_scheduler()
+        sch.add_task(worker='X', task_id='A', status='FAILED')
+        self.time += 10
+        sch.prune()
+        self.assertEqual('FAILED', sch._state.get_task('A').status)
+        self.time += 1
+        sch.prune()
+        self.assertEqual('PENDING', sch._state.get_task('A').status)
+
+        self.time += 51
+        sch.prune()  # X times out and A has no stakeholders left
+        self.assertEqual([], list(sch._state.get_worker_ids()))
+        self.assertEqual(self.time + 100, sch._state.get_task('A').remove)
+        self.time += 100
+        sch.prune()
+        self.assertFalse(sch._state.has_task('A'))
+
+    def test_worker_timer_when_clock_goes_backwards(self):
+        sch = self.make_scheduler()
+        sch.ping(worker='X')
+        self.time -= 100
+        sch.ping(worker='X')
+        self.time += 51
+        sch.prune()
+        self.assertEqual([], list(sch._state.get_worker_ids()))
+
+
+class CriticalPathTest(unittest.TestCase):
+    def make_scheduler(self, estimates=None):
+        history = luigi.task_history.NopHistory()
+        history.runtime_estimates = lambda: estimates or {}
+        return luigi.scheduler.Scheduler(critical_path_priority=True, task_history_impl=history)
+
+    def test_longest_chain_first(self):
+        sch = self.make_scheduler()
+        sch.add_task(worker='X', task_id='B1')
+        sch.add_task(worker='X', task_id='A3', deps=['A2'])
+        sch.add_task(worker='X', task_id='A2', deps=['A1'])
+        sch.add_task(worker='X', task_id='A1')
+        self.assertEqual(3, sch._state.path_length(sch._state.get_task('A1')))
+        self.assertEqual('A1', sch.get_work(worker='X')['task_id'])
+
+        # Without critical paths, tasks of the same priority go in the order they were added
+        sch = luigi.scheduler.Scheduler()
+        sch.add_task(worker='X', task_id='B1')
+        sch.add_task(worker='X', task_id='A2', deps=['A1'])
+        sch.add_task(worker='X', task_id='A1')
+        self.assertEqual('B1', sch.get_work(worker='X')['task_id'])
+
+    def test_priority_comes_first(self):
+        sch = self.make_scheduler()
+        sch.add_task(worker='X', task_id='B1', priority=1)
+        sch.add_task(worker='X', task_id='A2', deps=['A1'])
+        sch.add_task(worker='X', task_id='A1')
+        self.assertEqual('B1', sch.get_work(worker='X')['task_id'])
+
+    def test_runtime_estimates(self):
+        sch = self.make_scheduler({'Fast': 1.0, 'Slow': 100.0})
+        sch.add_task(worker='X', task_id='F2', family='Fast', deps=['F1'])
+        sch.add_task(worker='X', task_id='F1', family='Fast')
+        sch.add_task(worker='X', task_id='S1', family='Slow')
+        self.assertEqual('S1', sch.get_work(worker='X')['task_id'])
+
+        # Unknown families count as the median of the known ones
+        sch.add_task(worker='X', task_id='U1', family='Unknown')
+        self.assertEqual(100, sch._state.path_length(sch._state.get_task('U1')))
+
+    def test_estimates_follow_finished_tasks(self):
+        sch = self.make_scheduler({'A': 10.0, 'B': 10.0})
+        sch.add_task(worker='X', task_id='A1', family='A')
+        sch.add_task(worker='X', task_id='A2', family='A')
+        sch.add_task(worker='X', task_id='B1', family='B')
+        self.assertEqual(['A1', 'A2', 'B1'], [task.id for task in sch._state.get_ranked_tasks()])
+
+        with mock.patch('time.time', return_value=time.time() + 1000):
+            self.assertEqual('A1', sch.get_work(worker='X')['task_id'])
+        sch.add_task(worker='X', task_id='A1', family='A', status='DONE')
+        self.assertLess(10, sch._state.path_length(sch._state.get_task('B1')) - sch._state.path_length(sch._state.get_task('A2')))
+        self.assertEqual(['B1', 'A2'], [task.id for task in sch._state.get_ranked_tasks()])
+
+    def test_family_index(self):
+        sch = self.make_scheduler({'A': 10.0, 'B': 10.0})
+        sch.add_task(worker='X', task_id='A1', family='A', deps=['B1'])
+        self.assertEqual({'A': {'A1'}, '': {'B1'}}, sch._state._family_path_tasks)
+        sch.add_task(worker='X', task_id='B1', family='B')
+        self.assertEqual({'A': {'A1'}, 'B': {'B1'}}, sch._state._family_path_tasks)
+
+        # Only the tasks of the family, and those upstream of them, are updated
+        with mock.patch.object(sch._state, '_update_path_lengths') as update_path_lengths:
+            sch._state.record_runtime('A', 100.0)
+        update_path_lengths.assert_called_once_with(['A1'])
+
+        sch.add_task(worker='X', task_id='B1', status='DONE')
+        self.assertEqual({'A': {'A1'}}, sch._state._family_path_tasks)
+        sch._state.inactivate_tasks(['A1'])
+        self.assertEqual({}, sch._state._family_path_tasks)
+
+    def test_path_lengths_follow_the_graph(self):
+        sch = self.make_scheduler()
+        sch.add_task(worker='X', task_id='C', deps=['B'])
+        sch.add_task(worker='X', task_id='B', deps=['A'])
+        sch.add_task(worker='X', task_id='D', deps=['A'])
+        sch.add_task(worker='X', task_id='A')
+
+        def path_length(task_id):
+            return sch._state.path_length(sch._state.get_task(task_id))
+        self.assertEqual(3, path_length('A'))
+
+        sch.add_task(worker='X', task_id='C', deps=[])
+        self.assertEqual(2, path_length('A'))
+        sch.add_task(worker='X', task_id='B', status='DONE')
+        self.assertEqual(0, path_length('B'))
+        sch.add_task(worker='X', task_id='B', status='PENDING')
+        self.assertEqual(1, path_length('B'))
+        sch._state.inactivate_tasks(['D', 'B'])
+        self.assertEqual(1, path_length('A'))
+
+        with tempfile.NamedTemporaryFile() as fn:
+            sch._state._state_path = fn.name
+            sch.add_task(worker='X', task_id='E', deps=['A'])
+            sch.add_task(worker='X', task_id='F', deps=['E'])
+            sch.dump()
+            sch = self.make_scheduler()
+            sch._state._state_path = fn.name
+            sch.load()
+        self.assertEqual(3, path_length('A'))
+        self.assertEqual(['A', 'C'], [task.id for task in sch._state.get_ranked_tasks()])
+
+    def test_cycle(self):
+        sch = self.make_scheduler()
+        sch.add_task(worker='X', task_id='A', deps=['B'])
+        sch.add_task(worker='X', task_id='B', deps=['A'])
+        sch.add_task(worker='X', task_id='C')
+        self.assertEqual('C', sch.get_work(worker='X')['task_id'])
+
+
+class SpeculativeExecutionTest(unittest.TestCase):
+    def setUp(self):
+        history = luigi.task_history.NopHistory()
+        self.slow_runtimes = {'A': 10.0, 'B': 10.0}
+
+        def runtime_estimates(percentile=50):
+            return dict(self.slow_runtimes) if percentile == 95 else {}
+        history.runtime_estimates = runtime_estimates
+        self.sch = luigi.scheduler.Scheduler(speculative_execution=True, task_history_impl=history)
+        for worker in ('X', 'Y'):
+            self.sch.add_task(worker=worker, task_id='A1', family='A', idempotent=True)
+            self.sch.add_task(worker=worker, task_id='B1', family='B')
+        self.assertEqual('A1', self.sch.get_work(worker='X')['task_id'])
+        self.assertEqual('B1', self.sch.get_work(worker='X', current_tasks=['A1'])['task_id'])
+
+    def get_work(self, worker, after):
+        with mock.patch('time.time', return_value=time.time() + after):
+            return self.sch.get_work(worker=worker, current_tasks=[])['task_id']
+
+    def test_backup_of_straggler(self):
+        # Neither running for 2 times the 95th percentile of their family, nor for 60 seconds yet
+        self.assertIsNone(self.get_work('Y', 15))
+        self.assertIsNone(self.get_work('Y', 50))
+
+        # B1 isn't idempotent
+        self.assertEqual('A1', self.get_work('Y', 100))
+        self.assertEqual('Y', self.sch._state.get_task('A1').backup_worker)
+        self.assertEqual('X', self.sch._state.get_task('A1').worker_running)
+        self.assertIsNone(self.get_work('Y', 100))
+
+    def test_refresh_runtimes(self):
+        self.slow_runtimes = {'A': 1000.0}
+        self.sch.prune()
+        self.assertEqual('A1', self.get_work('Y', 100))  # not refreshed yet
+
+        with mock.patch('time.time', return_value=time.time() + 4000):
+            self.sch.prune()
+        self.assertEqual({'A': 1000.0}, self.sch._slow_runtimes)
+
+    def test_first_completion_wins(self):
+        self.assertEqual('A1', self.get_work('Y', 100))
+        self.sch.add_task(worker='Y', task_id='A1', status='DONE')
+        self.assertEqual('DONE', self.sch._state.get_task('A1').status)
+        self.assertEqual([{'name': 'stop_task', 'kwargs': {'task_id': 'A1'}}], self.sch.ping(worker='X')['rpc_messages'])
+        self.assertEqual([], self.sch.ping(worker='Y')['rpc_messages'])
+
+    def test_late_failure_of_stopped_copy(self):
+        self.assertEqual('A1', self.get_work('Y', 100))
+        self.sch.add_task(worker='Y', task_id='A1', status='DONE')
+        # X failed before it was told to stop, eg. because Y wrote the output it was writing
+        self.sch.add_task(worker='X', task_id='A1', status='FAILED')
+        self.assertEqual('DONE', self.sch._state.get_task('A1').status)
+
+        # Later failures are taken into account again
+        self.sch.add_task(worker='X', task_id='A1', status='FAILED')
+        self.assertEqual('FAILED', self.sch._state.get_task('A1').status)
+
+    def test_failed_copy(self):
+        self.assertEqual('A1', self.get_work('Y', 100))
+        self.sch.add_task(worker='X', task_id='A1', status='FAILED')
+        task = self.sch._state.get_task('A1')
+        self.assertEqual('RUNNING', task.status)
+        self.assertEqual('Y', task.worker_running)
+        self.assertIsNone(task.backup_worker)
+
+        self.sch.add_task(worker='Y', task_id='A1', status='DONE')
+        self.assertEqual('DONE', task.status)
+        self.assertEqual([], self.sch.ping(worker='X')['rpc_messages'])
+
+    def test_disconnected_worker(self):
+        self.assertEqual('A1', self.get_work('Y', 100))
+        with mock.patch('time.time', return_value=time.time() + 1000):
+            self.sch.ping(worker='Y')
+            self.sch.prune()
+        task = self.sch._state.get_task('A1')
+        self.assertEqual('RUNNING', task.status)
+        self.assertEqual('Y', task.worker_running)
+        self.assertIsNone(task.backup_worker)
+
+
+class CompactOrderedSetTest(unittest.TestCase):
+    def test_small_sets_are_tuples(self):
+        workers = luigi.scheduler.CompactOrderedSet()
+        self.assertEqual((), workers._items)
+        workers.add('X')
+        workers.add('X')
+        self.assertEqual(('X',), workers._items)
+        workers.discard('Y')
+        workers.discard('X')
+        self.assertEqual((), workers._items)
+
+    def test_order_is_kept_when_growing(self):
+        keys = [str(i) for i in range(20)]
+        workers = luigi.scheduler.CompactOrderedSet(keys)
+        self.assertIsInstance(workers._items, luigi.scheduler.OrderedSet)
+        self.assertEqual(keys, list(workers))
+        self.assertEqual('19', workers.peek())
+        self.assertEqual('0', workers.peek(last=False))
+        workers.discard('19')
+        self.assertEqual('18', workers.pop())
+        self.assertEqual(18, len(workers))
+
+    def test_peek_empty(self):
+        self.assertRaises(KeyError, luigi.scheduler.CompactOrderedSet().peek)
+
+    def test_set_operations(self):
+        workers = luigi.scheduler.CompactOrderedSet(['X', 'Y'])
+        self.assertEqual({'X', 'Y'}, workers)
+        self.assertEqual({'X', 'Y', 'Z'}, workers | {'Z'})
+        self.assertNotEqual(luigi.scheduler.CompactOrderedSet(['Y', 'X']), workers)
+
+    def test_pickle(self):
+        workers = luigi.scheduler.CompactOrderedSet(['X', 'Y'])
+        self.assertEqual(workers, pickle.loads(pickle.dumps(workers)))
+        self.assertEqual(luigi.scheduler.CompactOrderedSet(), pickle.loads(pickle.dumps(luigi.scheduler.CompactOrderedSet())))
@@ -427,21 +427,21 @@ class SchedulerVisualisationTest(unittest.TestCase):
 
         pa = missing_input.get(A().task_id)
         self.assertEqual(pa['status'], 'PENDING')
-        self.assertEqual(remote._upstream_status(A().task_id, {}), 'UPSTREAM_MISSING_INPUT')
+        self.assertEqual(remote._upstream_status(A().task_id), 'UPSTREAM_MISSING_INPUT')
 
         pc = missing_input.get(C().task_id)
         self.assertEqual(pc['status'], 'PENDING')
-        self.assertEqual(remote._upstream_status(C().task_id, {}), 'UPSTREAM_MISSING_INPUT')
+        self.assertEqual(remote._upstream_status(C().task_id), 'UPSTREAM_MISSING_INPUT')
 
         upstream_failed = remote.task_list('PENDING', 'UPSTREAM_FAILED')
         self.assertEqual(len(upstream_failed), 2)
         pe = upstream_failed.get(E().task_id)
         self.assertEqual(pe['status'], 'PENDING')
-        self.assertEqual(remote._upstream_status(E().task_id, {}), 'UPSTREAM_FAILED')
+        self.assertEqual(remote._upstream_status(E().task_id), 'UPSTREAM_FAILED')
 
         pe = upstream_failed.get(D().task_id)
         self.assertEqual(pe['status'], 'PENDING')
-        self.assertEqual(remote._upstream_status(D().task_id, {}), 'UPSTREAM_FAILED')
+        self.assertEqual(remote._upstream_status(D().task_id), 'UPSTREAM_FAILED')
 
         pending = dict(missing_input)
         pending.update(upstream_failed)
@@ -15,23 +15,26 @@
 # limitations under the License.
 #
 import functools
+import json
 import os
 import multiprocessing
 import shutil
 import signal
 import time
 import tempfile
-from helpers import unittest, skipOnTravis
+from helpers import unittest, skipOnTravis, with_config
 import luigi.rpc
 import luigi.server
 import luigi.cmdline
 from luigi.scheduler import Scheduler
+from luigi.scheduler_sharding import HashRing
 from luigi.six.moves.urllib.parse import (
     urlencode, ParseResult, quote as urlquote
 )
 
+import tornado.gen
 import tornado.ioloop
-from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import AsyncHTTPTestCase, gen_test
 from nose.plugins.attrib import attr
 
 try:
@@ -98,6 +101,11 @@ class ServerTest(ServerTestBase):
     def test_api_404(self):
         self._test_404('/api/foo')
 
+    def test_api_invalid_argument(self):
+        for method in ('task_list', 'worker_list'):
+            response = self.fetch('/api/%s?%s' % (method, urlencode({'data': json.dumps({'page_size': 0})})))
+            self.assertEqual(response.code, 400)
+
     def test_api_cors_headers(self):
         response = self.fetch('/api/graph')
         headers = dict(response.headers)
@@ -109,6 +117,206 @@ class ServerTest(ServerTestBase):
         self.assertSetEqual(_set("Access-Control-Allow-Methods"), {"GET", "OPTIONS"})
         self.assertEqual(headers["Access-Control-Allow-Origin"], "*")
 
+    def test_api_gzip_request(self):
+        body = luigi.rpc._gzip(urlencode({'data': json.dumps({'worker': 'X', 'task_id': 'A'})}).encode('utf-8'))
+        response = self.fetch('/api/add_task', method='POST', body=body, headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Accept-Encoding'], 'gzip')
+        self.assertIn('A', json.loads(self.fetch('/api/task_list').body.decode('utf-8'))['response'])
+
+
+class ShardSyncTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.owner = Scheduler(shard_urls=['http://shard0/', 'http://shard1/'], shard=1)
+        return luigi.server.app(self.owner)
+
+    def task_on(self, shard, prefix):
+        ring = HashRing(2)
+        return next('%s_%d' % (prefix, i) for i in range(1000) if ring.get_shard('%s_%d' % (prefix, i)) == shard)
+
+    @gen_test
+    def test_sync_shard_statuses(self):
+        a, b = self.task_on(0, 'A'), self.task_on(1, 'B')
+        sch = Scheduler(shard_urls=['http://shard0/', self.get_url('/')], shard=0)
+        sch.add_task(worker='X', task_id=a, deps=[b])
+        self.owner.add_task(worker='X', task_id=b, status='DONE')
+
+        yield luigi.server.sync_shard_statuses(sch)
+        self.assertEqual({b: 'DONE'}, sch.get_task_statuses([b]))
+
+    @gen_test
+    def test_sync_shard_statuses_unreachable(self):
+        a, b = self.task_on(0, 'A'), self.task_on(1, 'B')
+        sch = Scheduler(shard_urls=['http://shard0/', self.get_url('/nothing-here')], shard=0)
+        sch.add_task(worker='X', task_id=a, deps=[b])
+
+        yield luigi.server.sync_shard_statuses(sch)
+        self.assertEqual({b: 'UNKNOWN'}, sch.get_task_statuses([b]))
+
+
+class LongPollTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.sch = Scheduler()
+        return luigi.server.app(self.sch, work_waiters=luigi.server.WorkWaiters(self.sch))
+
+    def rpc(self, method, **kwargs):
+        body = urlencode({'data': json.dumps(kwargs)})
+        return self.http_client.fetch(self.get_url('/api/' + method), method='POST', body=body)
+
+    @gen_test
+    def test_held_until_there_is_work(self):
+        self.sch.add_task(worker='X', task_id='A', deps=['B'])
+        self.sch.add_task(worker='Y', task_id='B')
+        start = time.time()
+        reply = self.rpc('get_work', worker='X', wait=4)
+        yield tornado.gen.sleep(0.1)
+        yield self.rpc('add_task', worker='Y', task_id='B', status='DONE')
+
+        reply = json.loads((yield reply).body.decode('utf-8'))['response']
+        self.assertEqual('A', reply['task_id'])
+        self.assertLess(time.time() - start, 3)
+
+    @gen_test
+    def test_answered_when_time_is_up(self):
+        self.sch.add_task(worker='X', task_id='A', deps=['B'])
+        self.sch.add_task(worker='Y', task_id='B')
+        start = time.time()
+        reply = json.loads((yield self.rpc('get_work', worker='X', wait=0.2)).body.decode('utf-8'))['response']
+        self.assertIsNone(reply['task_id'])
+        self.assertTrue(reply['waited'])
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    @gen_test
+    def test_not_held_without_pending_tasks(self):
+        reply = json.loads((yield self.rpc('get_work', worker='X', wait=10)).body.decode('utf-8'))['response']
+        self.assertIsNone(reply['task_id'])
+        self.assertNotIn('waited', reply)
+
+    @gen_test
+    def test_not_held_without_wait(self):
+        self.sch.add_task(worker='X', task_id='A', deps=['B'])
+        reply = json.loads((yield self.rpc('get_work', worker='X')).body.decode('utf-8'))['response']
+        self.assertIsNone(reply['task_id'])
+        self.assertNotIn('waited', reply)
+
+
+class TaskHistoryTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        from luigi.db_task_history import DbTaskHistory
+        history = with_config({'task_history': {'db_connection': 'sqlite:///:memory:'}})(DbTaskHistory)()
+        self.sch = Scheduler(task_history_impl=history)
+        return luigi.server.app(self.sch)
+
+    def test_history_pages(self):
+        for i in range(3):
+            self.sch.add_task(worker='X', task_id='A_%d' % i, family='A', params={'i': str(i)})
+        self.sch.task_history.flush()
+
+        response = self.fetch('/history/by_name/A?page_size=2')
+        self.assertEqual(200, response.code)
+        body = response.body.decode('utf-8')
+        self.assertEqual(2, body.count('/history/by_id/'))
+        next_url = body.split('<a href="')[-1].split('"')[0].replace('&amp;', '&')
+        self.assertIn('cursor=', next_url)
+
+        body = self.fetch(next_url).body.decode('utf-8')
+        self.assertEqual(1, body.count('/history/by_id/'))
+        self.assertNotIn('Older runs', body)
+
+        self.assertEqual(400, self.fetch('/history?cursor=foo').code)
+        self.assertEqual(3, self.fetch('/history').body.decode('utf-8').count('/history/by_id/'))
+
+        body = self.fetch('/history/by_params/A?' + urlencode({'data': '{"i": "1"}', 'exact': 'true'})).body.decode('utf-8')
+        self.assertEqual(1, body.count('/history/by_id/'))
+        self.assertEqual(1, self.fetch('/tasklist').body.decode('utf-8').count('/tasklist/A'))
+
+    def test_task_stats(self):
+        self.sch.add_task(worker='X', task_id='A', family='A')
+        self.sch.add_task(worker='X', task_id='A', family='A', status='DONE')
+        self.sch.add_task(worker='X', task_id='B', family='B', status='FAILED')
+        self.sch.task_history.flush()
+
+        stats = json.loads(self.fetch('/history/stats').body.decode('utf-8'))['stats']
+        self.assertEqual([('A', 1, 0), ('B', 1, 1)], [(s['name'], s['runs'], s['failures']) for s in stats])
+        stats = json.loads(self.fetch('/history/stats/by_name/B?days=1').body.decode('utf-8'))['stats']
+        self.assertEqual([('B', 1, 1)], [(s['name'], s['runs'], s['failures']) for s in stats])
+        self.assertEqual(400, self.fetch('/history/stats?days=foo').code)
+
+    def test_writer_stats(self):
+        self.sch.add_task(worker='X', task_id='A', family='A')
+        self.sch.task_history.flush()
+        stats = json.loads(self.fetch('/history/writer_stats').body.decode('utf-8'))
+        self.assertEqual(1, stats['written'])
+
+
+class EventStreamTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.sch = Scheduler()
+        self.event_stream = luigi.server.EventStream(self.sch, max_buffered=100)
+        return luigi.server.app(self.sch, event_stream=self.event_stream)
+
+    def rpc(self, method, **kwargs):
+        body = urlencode({'data': json.dumps(kwargs)})
+        return self.http_client.fetch(self.get_url('/api/' + method), method='POST', body=body)
+
+    def subscribe(self):
+        chunks = []
+        response = self.http_client.fetch(self.get_url('/api/events'), streaming_callback=chunks.append)
+        return response, chunks
+
+    def events(self, chunks):
+        messages = b''.join(chunks).decode('utf-8').split('\n\n')
+        return [json.loads(line[len('data: '):]) for message in messages for line in message.split('\n')
+                if line.startswith('data: ')]
+
+    @tornado.gen.coroutine
+    def wait_for(self, chunks, num_events):
+        for _ in range(100):
+            if len(self.events(chunks)) >= num_events:
+                break
+            yield tornado.gen.sleep(0.01)
+
+    @gen_test
+    def test_events(self):
+        response, chunks = self.subscribe()
+        while not chunks:
+            yield tornado.gen.sleep(0.01)
+        yield self.rpc('add_task', worker='X', task_id='A', family='A')
+        yield self.rpc('get_work', worker='X', host='h')
+        yield self.rpc('update_resources', r=2)
+        yield self.wait_for(chunks, 4)
+
+        events = self.events(chunks)
+        self.assertEqual(['worker_joined', 'task_status', 'task_status', 'resources'], [e['type'] for e in events])
+        self.assertEqual('X', events[0]['worker'])
+        self.assertEqual(('A', 'PENDING'), (events[1]['task_id'], events[1]['status']))
+        self.assertEqual(('A', 'RUNNING', 'h'), (events[2]['task_id'], events[2]['status'], events[2]['host']))
+        self.assertEqual({'r': 2}, events[3]['resources'])
+
+        self.sch.update_resources(r=3)
+        for i in range(100):  # one more than fits in the buffer before it's written out
+            self.sch.add_task(worker='X', task_id='B%d' % i)
+        yield response
+        self.assertEqual('overflow', self.events(chunks)[-1]['type'])
+        self.assertEqual(set(), self.event_stream._subscribers)
+
+    @gen_test
+    def test_every_subscriber_gets_every_event(self):
+        first, first_chunks = self.subscribe()
+        second, second_chunks = self.subscribe()
+        while not (first_chunks and second_chunks):
+            yield tornado.gen.sleep(0.01)
+        for i in range(50):
+            self.sch.add_task(worker='X', task_id='A%d' % i)
+        yield self.wait_for(first_chunks, 51)
+        yield self.wait_for(second_chunks, 51)
+        self.assertEqual(51, len(self.events(first_chunks)))
+        self.assertEqual(51, len(self.events(second_chunks)))
+
 
 class _ServerTest(unittest.TestCase):
     """
@@ -158,6 +366,13 @@ class _ServerTest(unittest.TestCase):
         with self.assertRaises(luigi.rpc.RPCError):
             self.sch._request('/api/fdsfds', {'dummy': 1})
 
+    def test_large_request(self):
+        # The first response tells the client it may gzip what it sends next
+        self.sch.ping(worker='X')
+        self.assertTrue(self.sch._fetcher._compress)
+        self.sch.add_task(worker='X', task_id='A', params={'p': 'x' * 10 * luigi.rpc.GZIP_MIN_SIZE})
+        self.assertEqual({'p': 'x' * 10 * luigi.rpc.GZIP_MIN_SIZE}, self.sch.task_list()['A']['params'])
+
     @skipOnTravis('https://travis-ci.org/spotify/luigi/jobs/72953884')
     def test_save_state(self):
         self.sch.add_task(worker='X', task_id='B', deps=('A',))
@@ -241,6 +456,11 @@ class INETURLLibServerTest(INETProcessServerTest):
 
         self.assertNotEqual(fetcher1.__class__, fetcher2.__class__)
 
+    def test_reuses_connection(self):
+        self.sch.ping(worker='X')
+        self.sch.ping(worker='X')
+        self.assertEqual(1, len(self.sch._fetcher._idle[('http', 'localhost:%d' % self.server_client.port)]))
+
 
 class INETLuigidServerTest(_INETServerTest):
     class ServerClient(INETServerClient):
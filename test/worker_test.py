@@ -165,6 +165,72 @@ class WorkerTest(LuigiTestCase):
         self.assertTrue(a.has_run)
         self.assertTrue(b.has_run)
 
+    def _batched_tasks(self):
+        class A(DummyTask):
+            i = luigi.IntParameter()
+
+        class B(DummyTask):
+            def requires(self):
+                return [A(i) for i in range(4)]
+
+        return B()
+
+    def test_add_tasks_in_batches(self):
+        b = self._batched_tasks()
+        with Worker(scheduler=self.sch, worker_id='Z', add_task_batch_size=3) as w:
+            with mock.patch.object(self.sch, 'add_tasks', wraps=self.sch.add_tasks) as add_tasks:
+                self.assertTrue(w.add(b))
+            self.assertEqual([3, 2], [len(kwargs['tasks']) for args, kwargs in add_tasks.call_args_list])
+            self.assertEqual(b.task_id, add_tasks.call_args_list[0][1]['tasks'][0]['task_id'])
+            self.assertTrue(w.run())
+        self.assertTrue(b.complete())
+
+    def test_add_tasks_after_batch_interval(self):
+        b = self._batched_tasks()
+        with Worker(scheduler=self.sch, worker_id='Z', add_task_batch_size=3, add_task_batch_interval=0) as w:
+            with mock.patch.object(self.sch, 'add_tasks', wraps=self.sch.add_tasks) as add_tasks:
+                self.assertTrue(w.add(b))
+        self.assertEqual([1] * 5, [len(kwargs['tasks']) for args, kwargs in add_tasks.call_args_list])
+
+    def test_add_tasks_without_scheduler_support(self):
+        sch = mock.Mock(spec=['add_task', 'add_task_batcher'])
+        w = Worker(scheduler=sch, worker_id='Z', add_task_batch_size=3)
+        self.assertTrue(w.add(self._batched_tasks()))
+        self.assertEqual(5, sch.add_task.call_count)
+        self.assertEqual('Z', sch.add_task.call_args[1]['worker'])
+
+    def test_get_work_for_every_free_slot(self):
+        b = self._batched_tasks()
+        with Worker(scheduler=self.sch, worker_id='Z', worker_processes=4) as w:
+            self.assertTrue(w.add(b))
+            with mock.patch.object(self.sch, 'get_work', wraps=self.sch.get_work) as get_work:
+                response = w._get_work()
+        self.assertEqual(4, get_work.call_args[1]['slots'])
+        self.assertEqual(sorted(a.task_id for a in b.requires()), sorted(response.task_ids))
+        self.assertEqual(response.task_ids[0], response.task_id)
+
+    def _run_with_replies(self, replies, **kwargs):
+        with Worker(scheduler=self.sch, worker_id='Z', keep_alive=True, **kwargs) as w:
+            with mock.patch.object(self.sch, 'get_work', side_effect=replies) as get_work:
+                with mock.patch('time.sleep') as sleep:
+                    self.assertTrue(w.run())
+        return get_work, sleep
+
+    def test_long_poll_instead_of_sleeping(self):
+        get_work, sleep = self._run_with_replies([
+            {'task_id': None, 'n_pending_tasks': 1, 'n_unique_pending': 0, 'running_tasks': [], 'waited': True},
+            {'task_id': None, 'n_pending_tasks': 0, 'n_unique_pending': 0, 'running_tasks': []},
+        ], get_work_wait=5)
+        self.assertEqual([5, 5], [kwargs['wait'] for args, kwargs in get_work.call_args_list])
+        self.assertFalse(sleep.called)
+
+    def test_sleep_when_scheduler_does_not_long_poll(self):
+        get_work, sleep = self._run_with_replies([
+            {'task_id': None, 'n_pending_tasks': 1, 'n_unique_pending': 0, 'running_tasks': []},
+            {'task_id': None, 'n_pending_tasks': 0, 'n_unique_pending': 0, 'running_tasks': []},
+        ], get_work_wait=5)
+        self.assertEqual(1, sleep.call_count)
+
     def test_external_dep(self):
         class A(ExternalTask):
 
@@ -1765,6 +1831,24 @@ class WorkerPurgeEventHandlerTest(unittest.TestCase):
 
         self.assertEqual(result, [task])
 
+    @mock.patch('luigi.worker.TaskProcess')
+    def test_stopped_task(self, task_proc):
+        w = Worker()
+        task = HangTheWorkerTask()
+        task_process = mock.MagicMock(is_alive=lambda: True, timeout_time=None, task=task)
+        task_proc.return_value = task_process
+
+        w.add(task)
+        w._run_task(task.task_id)
+        w._handle_rpc_message({'name': 'stop_task', 'kwargs': {'task_id': task.task_id}})
+        with mock.patch.object(w._scheduler, 'add_task') as add_task:
+            w._handle_next_task()
+
+        self.assertTrue(task_process.terminate.called)
+        self.assertFalse(add_task.called)
+        self.assertEqual({}, w._running_tasks)
+        self.assertTrue(w.run_succeeded)
+
 
 class PerTaskRetryPolicyBehaviorTest(LuigiTestCase):
     def setUp(self):